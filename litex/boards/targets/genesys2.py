@@ -97,12 +97,15 @@ def main():
     soc_sdram_args(parser)
     parser.add_argument("--with-ethernet", action="store_true",
                         help="enable Ethernet support")
+    parser.add_argument("--strategies", type=int, default=None,
+                        help="implement with this number of Vivado strategies "
+                             "in parallel and keep the best timing")
     args = parser.parse_args()
 
     cls = EthernetSoC if args.with_ethernet else BaseSoC
     soc = cls(**soc_sdram_argdict(args))
     builder = Builder(soc, **builder_argdict(args))
-    builder.build()
+    builder.build(strategies=args.strategies)
 
 
 if __name__ == "__main__":
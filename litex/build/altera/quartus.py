@@ -9,6 +9,7 @@ from migen.fhdl.structure import _Fragment
 
 from litex.build.generic_platform import Pins, IOStandard, Misc
 from litex.build import tools
+from litex.build.cache import cached_run, tool_version
 
 
 def _format_constraint(c, signame, fmt_r):
@@ -70,7 +71,7 @@ def _build_qsf(named_sc, named_pc, build_name):
     return "\n".join(lines)
 
 
-def _build_sdc(clocks, false_paths, vns, build_name):
+def _build_sdc(clocks, false_paths, vns, build_dir, build_name):
     lines = []
     for clk, period in sorted(clocks.items(), key=lambda x: x[0].duid):
         lines.append(
@@ -83,10 +84,10 @@ def _build_sdc(clocks, false_paths, vns, build_name):
             "-from [get_clocks {{{from_}}}] "
             "-to [get_clocks {{{to}}}]".format(
             from_=vns.get_name(from_), to=vns.get_name(to)))
-    tools.write_to_file("{}.sdc".format(build_name), "\n".join(lines))
+    tools.write_to_file(os.path.join(build_dir, "{}.sdc".format(build_name)), "\n".join(lines))
 
 
-def _build_files(device, sources, vincpaths, named_sc, named_pc, build_name):
+def _build_files(device, sources, vincpaths, named_sc, named_pc, build_dir, build_name):
     lines = []
     for filename, language, library in sources:
         # Enforce use of SystemVerilog
@@ -107,10 +108,10 @@ def _build_files(device, sources, vincpaths, named_sc, named_pc, build_name):
 
     lines.append(_build_qsf(named_sc, named_pc, build_name))
     lines.append("set_global_assignment -name DEVICE {}".format(device))
-    tools.write_to_file("{}.qsf".format(build_name), "\n".join(lines))
+    tools.write_to_file(os.path.join(build_dir, "{}.qsf".format(build_name)), "\n".join(lines))
 
 
-def _run_quartus(build_name, quartus_path):
+def _run_quartus(build_dir, build_name, quartus_path):
     build_script_contents = "# Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n"
     build_script_contents += """
 
@@ -127,11 +128,11 @@ fi
 
 """.format(build_name=build_name)  # noqa
     build_script_file = "build_" + build_name + ".sh"
-    tools.write_to_file(build_script_file,
+    tools.write_to_file(os.path.join(build_dir, build_script_file),
                         build_script_contents,
                         force_unix=True)
 
-    if subprocess.call(["bash", build_script_file]):
+    if subprocess.call(["bash", build_script_file], cwd=build_dir):
         raise OSError("Subprocess failed")
 
 
@@ -141,34 +142,38 @@ class AlteraQuartusToolchain:
         self.false_paths = set()
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
-              toolchain_path=None, run=True, **kwargs):
+              toolchain_path=None, run=True, build_cache_dir=None, **kwargs):
         if toolchain_path is None:
             toolchain_path="/opt/Altera"
-        cwd = os.getcwd()
         os.makedirs(build_dir, exist_ok=True)
-        os.chdir(build_dir)
 
         if not isinstance(fragment, _Fragment):
             fragment = fragment.get_fragment()
         platform.finalize(fragment)
 
-        v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         v_file = build_name + ".v"
-        v_output.write(v_file)
+        v_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, v_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         sources = platform.sources | {(v_file, "verilog", "work")}
         _build_files(platform.device,
                      sources,
                      platform.verilog_include_paths,
                      named_sc,
                      named_pc,
+                     build_dir,
                      build_name)
 
-        _build_sdc(self.clocks, self.false_paths, v_output.ns, build_name)
+        _build_sdc(self.clocks, self.false_paths, v_output.ns, build_dir, build_name)
         if run:
-            _run_quartus(build_name, toolchain_path)
-
-        os.chdir(cwd)
+            cached_run(build_cache_dir, lambda: _run_quartus(build_dir, build_name, toolchain_path), build_dir,
+                generated=[v_file, build_name + ".qsf", build_name + ".sdc"]
+                    + list(v_output.data_files),
+                outputs=[build_name + ".sof", build_name + ".rbf",
+                         build_name + ".*.rpt", build_name + ".*.summary"],
+                sources=[filename for filename, language, library in platform.sources],
+                include_paths=platform.verilog_include_paths,
+                toolchain=[tool_version("quartus_sh", "--version"), toolchain_path])
 
         return v_output.ns
 
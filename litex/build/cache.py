@@ -0,0 +1,113 @@
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+
+
+# Toolchain runs are cached in a directory, under a hash of everything they
+# depend on: the generated files (top level Verilog, memory initialization,
+# constraints, scripts), the contents of the platform sources and the
+# versions of the tools. A build whose inputs were already seen gets the
+# bitstreams and reports of the previous run instead of running the tools.
+
+
+_banner = b"//" + b"-"*80 + b"\n"
+
+
+def tool_version(*command):
+    # output of a version command, empty when the tool is not found
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    return output.decode(errors="replace")
+
+
+def _path_replacements(directory, sources, include_paths):
+    # generated scripts refer to the build directory and to the sources by
+    # absolute paths, which do not matter: sources are replaced by their name
+    # and include paths by their position, longest paths first
+    r = [(os.path.abspath(directory), "")]
+    for filename in sources:
+        r.append((os.path.abspath(os.path.join(directory, filename)),
+                  "<source>/" + os.path.basename(filename)))
+    for i, path in enumerate(include_paths):
+        r.append((os.path.abspath(os.path.join(directory, path)), "<include{}>".format(i)))
+    # scripts of Windows tools may use forward slashes
+    r += [(path.replace("\\", "/"), replacement) for path, replacement in r if "\\" in path]
+    return sorted(((path.encode(), replacement.encode()) for path, replacement in r),
+                  key=lambda x: -len(x[0]))
+
+
+def _hash_file(h, filename, replacements=[]):
+    with open(filename, "rb") as f:
+        data = f.read()
+    # the banner of generated Verilog holds the generation time
+    if data.startswith(_banner):
+        data = data.split(b"\n", 3)[-1]
+    for path, replacement in replacements:
+        data = data.replace(path, replacement)
+    h.update(str(len(data)).encode() + b"\n")
+    h.update(data)
+
+
+class BuildCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, directory, generated, sources=[], include_paths=[], toolchain=[]):
+        h = hashlib.sha256()
+        include_paths = sorted(include_paths)
+        replacements = _path_replacements(directory, sources, include_paths)
+        for filename in sorted(set(generated)):
+            h.update(filename.encode() + b"\n")
+            _hash_file(h, os.path.join(directory, filename), replacements)
+        # sources are identified by name and content, not by location
+        for filename in sorted(set(sources), key=os.path.basename):
+            h.update(os.path.basename(filename).encode() + b"\n")
+            _hash_file(h, os.path.join(directory, filename))
+        for path in include_paths:
+            for filename in sorted(glob.glob(os.path.join(directory, path, "*"))):
+                if os.path.isfile(filename):
+                    h.update(os.path.basename(filename).encode() + b"\n")
+                    _hash_file(h, filename)
+        for item in toolchain:
+            h.update(repr(item).encode() + b"\n")
+        return h.hexdigest()
+
+    def fetch(self, key, directory):
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        for filename in os.listdir(entry):
+            shutil.copy2(os.path.join(entry, filename), os.path.join(directory, filename))
+        return True
+
+    def store(self, key, directory, outputs):
+        entry = os.path.join(self.cache_dir, key)
+        tmp = entry + ".tmp" + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for pattern in outputs:
+            for filename in glob.glob(os.path.join(directory, pattern)):
+                shutil.copy2(filename, tmp)
+        # entries appear complete, concurrent builds keep the first one
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp)
+
+
+def cached_run(cache_dir, run, directory, generated, outputs, sources=[],
+               include_paths=[], toolchain=[]):
+    # runs the toolchain unless cache_dir has its outputs for these inputs
+    if cache_dir is None:
+        run()
+        return
+    cache = BuildCache(cache_dir)
+    key = cache.key(directory, generated, sources, include_paths, toolchain)
+    if cache.fetch(key, directory):
+        print("Build outputs restored from cache ({})".format(key[:16]))
+        return
+    run()
+    cache.store(key, directory, outputs)
@@ -50,7 +50,7 @@ def _build_lpf(named_sc, named_pc):
     return r
 
 
-def _build_files(device, sources, vincpaths, build_name):
+def _build_files(build_dir, device, sources, vincpaths, build_name):
     tcl = []
     tcl.append("prj_project new -name \"{}\" -impl \"impl\" -dev {} -synthesis \"synplify\"".format(build_name, device))
     for path in vincpaths:
@@ -66,10 +66,10 @@ def _build_files(device, sources, vincpaths, build_name):
     tcl.append("prj_run Export -impl impl -task Bitgen")
     if _produces_jedec(device):
         tcl.append("prj_run Export -impl impl -task Jedecgen")
-    tools.write_to_file(build_name + ".tcl", "\n".join(tcl))
+    tools.write_to_file(os.path.join(build_dir, build_name + ".tcl"), "\n".join(tcl))
 
 
-def _build_script(build_name, device, toolchain_path, ver=None):
+def _build_script(build_dir, build_name, device, toolchain_path, ver=None):
     if sys.platform in ("win32", "cygwin"):
         script_ext = ".bat"
         build_script_contents = "@echo off\nrem Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n\n"
@@ -100,18 +100,18 @@ def _build_script(build_name, device, toolchain_path, ver=None):
             migen_product=build_name + ext)
 
     build_script_file = "build_" + build_name + script_ext
-    tools.write_to_file(build_script_file, build_script_contents,
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents,
                         force_unix=False)
     return build_script_file
 
 
-def _run_script(script):
+def _run_script(script, build_dir):
     if sys.platform in ("win32", "cygwin"):
         shell = ["cmd", "/c"]
     else:
         shell = ["bash"]
 
-    if subprocess.call(shell + [script]) != 0:
+    if subprocess.call(shell + [script], cwd=build_dir) != 0:
         raise OSError("Subprocess failed")
 
 
@@ -132,31 +132,29 @@ class LatticeDiamondToolchain:
     special_overrides = common.lattice_ecpx_special_overrides
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
-              toolchain_path=None, run=True, **kwargs):
+              toolchain_path=None, run=True, build_cache_dir=None, **kwargs):
+        # build_cache_dir: Diamond runs are not cached
         if toolchain_path is None:
             toolchain_path = "/opt/Diamond"
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
 
         if not isinstance(fragment, _Fragment):
             fragment = fragment.get_fragment()
         platform.finalize(fragment)
 
-        v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         v_file = build_name + ".v"
-        v_output.write(v_file)
+        v_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, v_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         sources = platform.sources | {(v_file, "verilog", "work")}
-        _build_files(platform.device, sources, platform.verilog_include_paths, build_name)
+        _build_files(build_dir, platform.device, sources, platform.verilog_include_paths, build_name)
 
-        tools.write_to_file(build_name + ".lpf", _build_lpf(named_sc, named_pc))
+        tools.write_to_file(os.path.join(build_dir, build_name + ".lpf"),
+                            _build_lpf(named_sc, named_pc))
 
-        script = _build_script(build_name, platform.device, toolchain_path)
+        script = _build_script(build_dir, build_name, platform.device, toolchain_path)
         if run:
-            _run_script(script)
-
-        os.chdir(cwd)
+            _run_script(script, build_dir)
 
         return v_output.ns
 
@@ -9,6 +9,7 @@ from migen.fhdl.structure import _Fragment
 
 from litex.build.generic_platform import *
 from litex.build import tools
+from litex.build.cache import cached_run, tool_version
 from litex.build.lattice import common
 
 
@@ -32,7 +33,7 @@ def _build_pre_pack(vns, freq_cstrs):
     return r
 
 
-def _build_script(source, build_template, build_name, **kwargs):
+def _build_script(build_dir, source, build_template, build_name, **kwargs):
     if sys.platform in ("win32", "cygwin"):
         script_ext = ".bat"
         build_script_contents = "@echo off\nrem Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n\n"
@@ -49,18 +50,18 @@ def _build_script(source, build_template, build_name, **kwargs):
                                                **kwargs)
 
     build_script_file = "build_" + build_name + script_ext
-    tools.write_to_file(build_script_file, build_script_contents,
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents,
                         force_unix=False)
     return build_script_file
 
 
-def _run_script(script):
+def _run_script(script, build_dir):
     if sys.platform in ("win32", "cygwin"):
         shell = ["cmd", "/c"]
     else:
         shell = ["bash"]
 
-    if subprocess.call(shell + [script]) != 0:
+    if subprocess.call(shell + [script], cwd=build_dir) != 0:
         raise OSError("Subprocess failed")
 
 
@@ -123,19 +124,18 @@ class LatticeIceStormToolchain:
 
     # platform.device should be of the form "ice40-{lp384, hx1k, etc}-{tq144, etc}"
     def build(self, platform, fragment, build_dir="build", build_name="top",
-              toolchain_path=None, use_nextpnr=True, synth_opts="", run=True, **kwargs):
+              toolchain_path=None, use_nextpnr=True, synth_opts="", run=True,
+              build_cache_dir=None, **kwargs):
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
 
         if not isinstance(fragment, _Fragment):
             fragment = fragment.get_fragment()
         platform.finalize(fragment)
 
-        v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         v_file = build_name + ".v"
-        v_output.write(v_file)
+        v_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, v_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(v_output.ns)
 
         if use_nextpnr:
             chosen_yosys_template = self.nextpnr_yosys_template
@@ -147,9 +147,9 @@ class LatticeIceStormToolchain:
                                 for _ in chosen_yosys_template)
 
         ys_name = build_name + ".ys"
-        tools.write_to_file(ys_name, ys_contents)
+        tools.write_to_file(os.path.join(build_dir, ys_name), ys_contents)
 
-        tools.write_to_file(build_name + ".pcf",
+        tools.write_to_file(os.path.join(build_dir, build_name + ".pcf"),
                             _build_pcf(named_sc, named_pc))
         (family, series_size, package) = self.parse_device_string(platform.device)
         if use_nextpnr:
@@ -160,7 +160,7 @@ class LatticeIceStormToolchain:
         icetime_pkg_opts = "-P " + package + " -d " + series_size
 
         if use_nextpnr:
-            tools.write_to_file(build_name + "_pre_pack.py",
+            tools.write_to_file(os.path.join(build_dir, build_name + "_pre_pack.py"),
                                 _build_pre_pack(v_output.ns, self.freq_constraints))
         # icetime can only handle a single global constraint, so we test against the fastest
         # clock; though imprecise, if the global design satisfies the fastest clock, we can
@@ -172,7 +172,8 @@ class LatticeIceStormToolchain:
             chosen_build_template = self.nextpnr_build_template
         else:
             chosen_build_template = self.build_template
-        script = _build_script(source=False,
+        script = _build_script(build_dir=build_dir,
+                               source=False,
                                build_template=chosen_build_template,
                                build_name=build_name,
                                pnr_pkg_opts=pnr_pkg_opts,
@@ -180,9 +181,18 @@ class LatticeIceStormToolchain:
                                freq_constraint=freq_constraint)
 
         if run:
-            _run_script(script)
-
-        os.chdir(cwd)
+            generated = [v_file, ys_name, build_name + ".pcf", script] + list(v_output.data_files)
+            if use_nextpnr:
+                generated.append(build_name + "_pre_pack.py")
+                pnr = tool_version("nextpnr-ice40", "--version")
+            else:
+                pnr = tool_version("arachne-pnr", "--version")
+            cached_run(build_cache_dir, lambda: _run_script(script, build_dir), build_dir,
+                generated=generated,
+                outputs=[build_name + ".bin", build_name + ".rpt", build_name + ".tim"],
+                sources=[filename for filename, language, library in platform.sources],
+                include_paths=platform.verilog_include_paths,
+                toolchain=[tool_version("yosys", "-V"), pnr])
 
         return v_output.ns
 
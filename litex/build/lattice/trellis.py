@@ -10,6 +10,7 @@ from migen.fhdl.structure import _Fragment
 
 from litex.build.generic_platform import *
 from litex.build import tools
+from litex.build.cache import cached_run, tool_version
 from litex.build.lattice import common
 
 # TODO:
@@ -71,7 +72,7 @@ def _build_lpf(named_sc, named_pc):
     return r
 
 
-def _build_script(source, build_template, build_name, architecture,
+def _build_script(build_dir, source, build_template, build_name, architecture,
                   package, freq_constraint):
     if sys.platform in ("win32", "cygwin"):
         script_ext = ".bat"
@@ -91,18 +92,18 @@ def _build_script(source, build_template, build_name, architecture,
                                                fail_stmt=fail_stmt)
 
     build_script_file = "build_" + build_name + script_ext
-    tools.write_to_file(build_script_file, build_script_contents,
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents,
                         force_unix=False)
     return build_script_file
 
 
-def _run_script(script):
+def _run_script(script, build_dir):
     if sys.platform in ("win32", "cygwin"):
         shell = ["cmd", "/c"]
     else:
         shell = ["bash"]
 
-    if subprocess.call(shell + [script]) != 0:
+    if subprocess.call(shell + [script], cwd=build_dir) != 0:
         raise OSError("Subprocess failed")
 
 
@@ -149,26 +150,24 @@ class LatticeTrellisToolchain:
         self.freq_constraints = dict()
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
-              toolchain_path=None, run=True, **kwargs):
+              toolchain_path=None, run=True, build_cache_dir=None, **kwargs):
         if toolchain_path is None:
             toolchain_path = "/usr/share/trellis/"
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
 
         # generate verilog
         if not isinstance(fragment, _Fragment):
             fragment = fragment.get_fragment()
         platform.finalize(fragment)
 
-        top_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(top_output.ns)
         top_file = build_name + ".v"
-        top_output.write(top_file)
-        platform.add_source(top_file)
+        top_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, top_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(top_output.ns)
+        platform.add_source(os.path.join(build_dir, top_file))
 
         # generate constraints
-        tools.write_to_file(build_name + ".lpf",
+        tools.write_to_file(os.path.join(build_dir, build_name + ".lpf"),
                             _build_lpf(named_sc, named_pc))
 
         # generate yosys script
@@ -176,7 +175,7 @@ class LatticeTrellisToolchain:
         yosys_script_contents = "\n".join(_.format(build_name=build_name,
                                                    read_files=yosys_import_sources(platform))
                                           for _ in self.yosys_template)
-        tools.write_to_file(yosys_script_file, yosys_script_contents)
+        tools.write_to_file(os.path.join(build_dir, yosys_script_file), yosys_script_contents)
 
         # transform platform.device to nextpnr's architecture
         (family, size, package) = platform.device.split("-")
@@ -185,14 +184,19 @@ class LatticeTrellisToolchain:
         freq_constraint = str(max(self.freq_constraints.values(),
                                   default=0.0))
 
-        script = _build_script(False, self.build_template, build_name,
+        script = _build_script(build_dir, False, self.build_template, build_name,
                                architecture, package, freq_constraint)
 
         # run scripts
         if run:
-            _run_script(script)
-
-        os.chdir(cwd)
+            cached_run(build_cache_dir, lambda: _run_script(script, build_dir), build_dir,
+                generated=[top_file, build_name + ".lpf", yosys_script_file, script]
+                    + list(top_output.data_files),
+                outputs=[build_name + ".bit", build_name + ".svf", build_name + ".rpt"],
+                sources=[filename for filename, language, library in platform.sources],
+                include_paths=platform.verilog_include_paths,
+                toolchain=[tool_version("yosys", "-V"),
+                           tool_version("nextpnr-ecp5", "--version")])
 
         return top_output.ns
 
@@ -39,7 +39,7 @@ def _format_io_pdc(signame, pin, others):
     return r
 
 
-def _build_io_pdc(named_sc, named_pc, build_name, additional_io_constraints):
+def _build_io_pdc(named_sc, named_pc, build_dir, build_name, additional_io_constraints):
     pdc = ""
     for sig, pins, others, resname in named_sc:
         if len(pins) > 1:
@@ -48,12 +48,12 @@ def _build_io_pdc(named_sc, named_pc, build_name, additional_io_constraints):
         else:
             pdc += _format_io_pdc(sig, pins[0], others)
     pdc += "\n".join(additional_io_constraints)
-    tools.write_to_file(build_name + "_io.pdc", pdc)
+    tools.write_to_file(os.path.join(build_dir, build_name + "_io.pdc"), pdc)
 
 
-def _build_fp_pdc(build_name, additional_fp_constraints):
+def _build_fp_pdc(build_dir, build_name, additional_fp_constraints):
     pdc = "\n".join(additional_fp_constraints)
-    tools.write_to_file(build_name + "_fp.pdc", pdc)
+    tools.write_to_file(os.path.join(build_dir, build_name + "_fp.pdc"), pdc)
 
 
 def _build_tcl(platform, sources, build_dir, build_name):
@@ -155,10 +155,10 @@ def _build_tcl(platform, sources, build_dir, build_name):
     tcl.append("run_tool -name {GENERATEPROGRAMMINGFILE}")
 
     # generate tcl
-    tools.write_to_file(build_name + ".tcl", "\n".join(tcl))
+    tools.write_to_file(os.path.join(build_dir, build_name + ".tcl"), "\n".join(tcl))
 
 
-def _build_timing_sdc(vns, clocks, false_paths, build_name, additional_timing_constraints):
+def _build_timing_sdc(vns, clocks, false_paths, build_dir, build_name, additional_timing_constraints):
     sdc = []
 
     for clk, period in sorted(clocks.items(), key=lambda x: x[0].duid):
@@ -175,10 +175,10 @@ def _build_timing_sdc(vns, clocks, false_paths, build_name, additional_timing_co
 
     # generate sdc
     sdc += additional_timing_constraints
-    tools.write_to_file(build_name + ".sdc", "\n".join(sdc))
+    tools.write_to_file(os.path.join(build_dir, build_name + ".sdc"), "\n".join(sdc))
 
 
-def _build_script(build_name, device, toolchain_path, ver=None):
+def _build_script(build_dir, build_name, device, toolchain_path, ver=None):
     if sys.platform in ("win32", "cygwin"):
         script_ext = ".bat"
         build_script_contents = "@echo off\nrem Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n\n"
@@ -191,18 +191,18 @@ def _build_script(build_name, device, toolchain_path, ver=None):
         fail_stmt = " || exit 1"
 
     build_script_file = "build_" + build_name + script_ext
-    tools.write_to_file(build_script_file, build_script_contents,
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents,
                         force_unix=False)
     return build_script_file
 
 
-def _run_script(script):
+def _run_script(script, build_dir):
     if sys.platform in ("win32", "cygwin"):
         shell = ["cmd", "/c"]
     else:
         shell = ["bash"]
 
-    if subprocess.call(shell + [script]) != 0:
+    if subprocess.call(shell + [script], cwd=build_dir) != 0:
         raise OSError("Subprocess failed")
 
 
@@ -230,11 +230,10 @@ class MicrosemiLiberoSoCPolarfireToolchain:
         self.additional_timing_constraints = []
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
-              toolchain_path=None, run=False, **kwargs):
+              toolchain_path=None, run=False, build_cache_dir=None, **kwargs):
+        # build_cache_dir: Libero runs are not cached
         # create build directory
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
 
         # finalize design
         if not isinstance(fragment, _Fragment):
@@ -242,36 +241,35 @@ class MicrosemiLiberoSoCPolarfireToolchain:
         platform.finalize(fragment)
 
         # generate top module
-        top_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(top_output.ns)
         top_file = build_name + ".v"
-        top_output.write(top_file)
-        platform.add_source(top_file)
+        top_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, top_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(top_output.ns)
+        platform.add_source(os.path.join(build_dir, top_file))
 
         # generate design script file (.tcl)
         _build_tcl(platform, platform.sources, build_dir, build_name)
 
         # generate design io constraints file (.pdc)
-        _build_io_pdc(named_sc, named_pc, build_name, self.additional_io_constraints)
+        _build_io_pdc(named_sc, named_pc, build_dir, build_name, self.additional_io_constraints)
 
         # generate design fp constraints file (.pdc)
-        _build_fp_pdc(build_name, self.additional_fp_constraints)
+        _build_fp_pdc(build_dir, build_name, self.additional_fp_constraints)
 
         # generate design timing constraints file (sdc)
-        _build_timing_sdc(top_output.ns, self.clocks, self.false_paths, build_name,
+        _build_timing_sdc(top_output.ns, self.clocks, self.false_paths, build_dir, build_name,
             self.additional_timing_constraints)
 
         # generate build script
-        script = _build_script(build_name, platform.device, toolchain_path)
+        script = _build_script(build_dir, build_name, platform.device, toolchain_path)
 
         # run
         if run:
             # delete previous impl
-            if os.path.exists("impl"):
-                shutil.rmtree("impl")
-            _run_script(script)
-
-        os.chdir(cwd)
+            impl_dir = os.path.join(build_dir, "impl")
+            if os.path.exists(impl_dir):
+                shutil.rmtree(impl_dir)
+            _run_script(script, build_dir)
 
         return top_output.ns
 
@@ -0,0 +1,283 @@
+import os
+import re
+import sys
+import ast
+import time
+import inspect
+import pkgutil
+import importlib
+import signal
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+from litex.build.reports import gateware_results
+
+__all__ = ["BuildJob", "BuildResult", "Orchestrator", "format_summary",
+           "all_targets", "parse_job"]
+
+
+# Builds of many SoCs at once: every job runs in a process of its own, with
+# its own output directory and log, so that builds of different targets and
+# variants neither share state nor interleave their output.
+
+
+class BuildJob:
+    def __init__(self, target, soc="BaseSoC", soc_kwargs={}, build_kwargs={}, name=None):
+        # target is a module of litex.boards.targets or a full module name
+        self.target = target
+        self.soc = soc
+        self.soc_kwargs = dict(soc_kwargs)
+        self.build_kwargs = dict(build_kwargs)
+        if name is None:
+            name = target.split(".")[-1] + "_" + soc.lower()
+            for k, v in sorted(self.soc_kwargs.items()):
+                name += "_{}_{}".format(k, v)
+        self.name = name
+
+    def soc_class(self):
+        if "." in self.target:
+            module = importlib.import_module(self.target)
+        else:
+            module = importlib.import_module("litex.boards.targets." + self.target)
+        return getattr(module, self.soc)
+
+    def run(self, output_dir, builder_kwargs):
+        # in the process of the job, raises on failure
+        from litex.soc.integration.builder import Builder
+        builder_kwargs = dict(builder_kwargs)
+        if builder_kwargs.get("csr_csv") is not None:
+            # relative to the output directory of the job
+            builder_kwargs["csr_csv"] = os.path.join(output_dir, builder_kwargs["csr_csv"])
+        soc = self.soc_class()(**self.soc_kwargs)
+        builder = Builder(soc, output_dir=output_dir, **builder_kwargs)
+        builder.build(**self.build_kwargs)
+
+
+class BuildResult:
+    def __init__(self, job, output_dir, log):
+        self.job = job
+        self.output_dir = output_dir
+        self.log = log
+        self.status = "pending"
+        self.start = None
+        self.duration = None
+        self.timing = None
+        self.utilization = None
+
+    @property
+    def ok(self):
+        return self.status == "ok"
+
+
+def _run_job(job, output_dir, builder_kwargs, log):
+    # the job and the tools it runs are a process group of their own
+    if hasattr(os, "setsid"):
+        os.setsid()
+    # the output of the job and of the tools it runs goes to its log
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    try:
+        job.run(output_dir, builder_kwargs)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+# seconds between SIGTERM and SIGKILL when stopping a job
+_kill_grace = 5.0
+
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _stop(process):
+    # stops the job and every process it started
+    if not hasattr(os, "killpg"):
+        process.terminate()
+        process.join()
+        return
+    pgid = process.pid
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except OSError:
+        # not a group leader yet
+        process.terminate()
+    deadline = time.time() + _kill_grace
+    process.join(_kill_grace)
+    while _group_alive(pgid) and time.time() < deadline:
+        time.sleep(0.05)
+    if _group_alive(pgid):
+        os.killpg(pgid, signal.SIGKILL)
+    process.join()
+
+
+class Orchestrator:
+    # jobs: number of builds running at once (None: number of CPUs).
+    # fail_fast: on the first failure, "skip" the jobs not started yet, or
+    # also "kill" the running ones. timeout: seconds after which a job is
+    # killed.
+    def __init__(self, output_dir="build", jobs=None, fail_fast=None, timeout=None,
+                 builder_kwargs={}, verbose=True):
+        assert fail_fast in [None, "skip", "kill"]
+        self.output_dir = os.path.abspath(output_dir)
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.fail_fast = fail_fast
+        self.timeout = timeout
+        self.builder_kwargs = dict(builder_kwargs)
+        self.verbose = verbose
+        self.build_jobs = []
+
+    def add_job(self, job):
+        names = set(j.name for j in self.build_jobs)
+        if job.name in names:
+            raise ValueError("Duplicate job name '{}'".format(job.name))
+        self.build_jobs.append(job)
+        return job
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+            sys.stdout.flush()
+
+    def _finish(self, result, status):
+        result.status = status
+        result.duration = time.time() - result.start
+        gateware_dir = os.path.join(result.output_dir, "gateware")
+        result.timing, result.utilization = gateware_results(gateware_dir,
+            result.job.build_kwargs.get("build_name", "top"), result.log)
+        self._log("[{}] {} ({:.0f}s), log: {}".format(result.job.name, status,
+            result.duration, result.log))
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        results = []
+        for job in self.build_jobs:
+            output_dir = os.path.join(self.output_dir, job.name)
+            results.append(BuildResult(job, output_dir, output_dir + ".log"))
+
+        pending = list(results)
+        running = dict()
+        stop = False
+        while pending or running:
+            while pending and not stop and len(running) < self.jobs:
+                result = pending.pop(0)
+                os.makedirs(result.output_dir, exist_ok=True)
+                process = multiprocessing.Process(target=_run_job,
+                    args=(result.job, result.output_dir, self.builder_kwargs, result.log))
+                result.start = time.time()
+                result.status = "running"
+                process.start()
+                running[process.sentinel] = (process, result)
+                self._log("[{}] started".format(result.job.name))
+            if not running:
+                break
+
+            ready = wait(list(running.keys()), timeout=None if self.timeout is None else 1.0)
+            now = time.time()
+            for sentinel in list(running.keys()):
+                process, result = running[sentinel]
+                if sentinel in ready:
+                    process.join()
+                    del running[sentinel]
+                    self._finish(result, "ok" if process.exitcode == 0 else "failed")
+                    if not result.ok and self.fail_fast is not None:
+                        stop = True
+                elif self.timeout is not None and now - result.start > self.timeout:
+                    _stop(process)
+                    del running[sentinel]
+                    self._finish(result, "timeout")
+                    if self.fail_fast is not None:
+                        stop = True
+
+            if stop and self.fail_fast == "kill":
+                for process, result in running.values():
+                    _stop(process)
+                    self._finish(result, "killed")
+                running.clear()
+
+        for result in pending:
+            result.status = "skipped"
+        return results
+
+
+def _format_utilization(utilization):
+    if not utilization:
+        return "-"
+    return ", ".join("{} {:.0f}%".format(name, 100*used/available)
+        for name, (used, available) in utilization.items())
+
+
+def format_summary(results):
+    rows = [("Job", "Status", "Time", "WNS (ns)", "TNS (ns)", "Utilization")]
+    for r in results:
+        duration = "-"
+        if r.duration is not None:
+            duration = "{:d}m{:02d}s".format(int(r.duration)//60, int(r.duration)%60)
+        wns = tns = "-"
+        if r.timing is not None:
+            if r.timing.get("wns") is not None:
+                wns = "{:.3f}".format(r.timing["wns"])
+            if r.timing.get("tns") is not None:
+                tns = "{:.3f}".format(r.timing["tns"])
+        rows.append((r.job.name, r.status, duration, wns, tns, _format_utilization(r.utilization)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    lines = []
+    for row in rows:
+        cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+        lines.append("  ".join(cells + [row[-1]]))
+    return "\n".join(lines)
+
+
+def all_targets():
+    # the targets of litex.boards.targets with a BaseSoC built without arguments
+    import litex.boards.targets
+    r = []
+    for _, name, _ in pkgutil.iter_modules(litex.boards.targets.__path__):
+        try:
+            module = importlib.import_module("litex.boards.targets." + name)
+        except ImportError:
+            continue
+        soc = getattr(module, "BaseSoC", None)
+        if soc is None:
+            continue
+        parameters = list(inspect.signature(soc).parameters.values())
+        if all(p.default is not p.empty or p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+               for p in parameters):
+            r.append(name)
+    return r
+
+
+def parse_job(spec):
+    # "target[:SoCClass][:key=value,...]", values are Python literals or strings
+    parts = spec.split(":")
+    target = parts[0]
+    soc = parts[1] if len(parts) > 1 and parts[1] else "BaseSoC"
+    soc_kwargs = dict()
+    name = None
+    if len(parts) > 2:
+        arguments = ":".join(parts[2:])
+        name = target + "_" + soc.lower() + "_" + re.sub(r"[^\w.-]+", "_", arguments)
+        for item in arguments.split(","):
+            key, _, value = item.partition("=")
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                pass
+            soc_kwargs[key.strip()] = value
+    return BuildJob(target, soc, soc_kwargs, name=name)
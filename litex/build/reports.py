@@ -0,0 +1,157 @@
+import os
+import re
+from collections import OrderedDict
+
+
+# Timing and utilization results of the toolchain reports. Timing is given as
+# {"wns": ns, "tns": ns} (worst and total negative slack, setup), utilization
+# as {resource: (used, available)} for the main resources of the device.
+
+
+_vivado_resources = {
+    "Slice LUTs":      "LUT",
+    "CLB LUTs":        "LUT",
+    "Slice Registers": "FF",
+    "CLB Registers":   "FF",
+    "Block RAM Tile":  "BRAM",
+    "DSPs":            "DSP",
+}
+
+_nextpnr_resources = {
+    "TRELLIS_SLICE": "SLICE",
+    "ICESTORM_LC":   "LC",
+    "DP16KD":        "BRAM",
+    "ICESTORM_RAM":  "BRAM",
+    "MULT18X18D":    "DSP",
+    "ICESTORM_DSP":  "DSP",
+}
+
+_quartus_resources = {
+    "Total logic elements":               "LE",
+    "Logic utilization (in ALMs)":        "ALM",
+    "Total memory bits":                  "RAM bits",
+    "Embedded Multiplier 9-bit elements": "DSP",
+    "Total DSP Blocks":                   "DSP",
+}
+
+
+def _read(filename):
+    try:
+        with open(filename, errors="replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+def vivado_timing(filename):
+    # "Design Timing Summary" table of report_timing_summary
+    report = _read(filename)
+    if report is None:
+        return None
+    lines = report.splitlines()
+    for i, line in enumerate(lines):
+        if line.split()[:1] == ["WNS(ns)"] and i + 2 < len(lines):
+            names = re.split(r"\s{2,}", line.strip())
+            values = dict(zip(names, lines[i + 2].split()))
+            return {"wns": _float(values.get("WNS(ns)", "")),
+                    "tns": _float(values.get("TNS(ns)", ""))}
+    return None
+
+
+def vivado_utilization(filename):
+    # "| Site Type | Used | Fixed | [Prohibited |] Available | Util% |" rows
+    report = _read(filename)
+    if report is None:
+        return None
+    r = OrderedDict()
+    for line in report.splitlines():
+        cells = [c.strip() for c in line.split("|")[1:-1]]
+        if len(cells) >= 4 and cells[0] in _vivado_resources:
+            used, available = _float(cells[1]), _float(cells[-2])
+            if used is not None and available:
+                r.setdefault(_vivado_resources[cells[0]], (used, available))
+    return r
+
+
+def nextpnr_timing(filename):
+    # "Max frequency for clock 'x': 80.00 MHz (PASS at 50.00 MHz)", the last
+    # one of each clock is after routing
+    log = _read(filename)
+    if log is None:
+        return None
+    slacks = OrderedDict()
+    for clock, fmax, target in re.findall(
+            r"Max frequency for clock\s+'([^']+)': ([\d.]+) MHz \((?:PASS|FAIL) at ([\d.]+) MHz\)", log):
+        slacks[clock] = 1e3/float(target) - 1e3/float(fmax)
+    if not slacks:
+        return None
+    return {"wns": min(slacks.values()),
+            "tns": sum(min(s, 0.0) for s in slacks.values())}
+
+
+def nextpnr_utilization(filename):
+    # "Info:     TRELLIS_SLICE:   646/41820     1%", the last report is
+    # after packing
+    log = _read(filename)
+    if log is None:
+        return None
+    r = OrderedDict()
+    for name, used, available in re.findall(r"^Info:\s+(\w+):\s+(\d+)/\s*(\d+)\s+\d+%", log, re.MULTILINE):
+        if name in _nextpnr_resources:
+            r[_nextpnr_resources[name]] = (float(used), float(available))
+    return r
+
+
+def quartus_timing(filename):
+    # setup "Slack :" and "TNS :" of the slowest model in .sta.summary
+    report = _read(filename)
+    if report is None:
+        return None
+    wns = tns = None
+    for section in report.split("Type  :")[1:]:
+        if "Setup" not in section.splitlines()[0]:
+            continue
+        slack = re.search(r"^Slack\s*:\s*(-?[\d.]+)", section, re.MULTILINE)
+        total = re.search(r"^TNS\s*:\s*(-?[\d.]+)", section, re.MULTILINE)
+        if slack is not None and (wns is None or float(slack.group(1)) < wns):
+            wns = float(slack.group(1))
+            tns = float(total.group(1)) if total is not None else None
+    if wns is None:
+        return None
+    return {"wns": wns, "tns": tns}
+
+
+def quartus_utilization(filename):
+    # "Total logic elements : 1,234 / 22,320 ( 6 % )" lines of .fit.summary
+    report = _read(filename)
+    if report is None:
+        return None
+    r = OrderedDict()
+    for name, used, available in re.findall(r"^(\w[^:\n]*?)\s*:\s*([\d,]+)\s*/\s*([\d,]+)", report, re.MULTILINE):
+        if name in _quartus_resources:
+            r[_quartus_resources[name]] = (float(used.replace(",", "")), float(available.replace(",", "")))
+    return r
+
+
+def gateware_results(build_dir, build_name="top", log=None):
+    # timing and utilization of a build, from the reports of its toolchain
+    # (the output of nextpnr is only in the log of the build)
+    def path(suffix):
+        return os.path.join(build_dir, build_name + suffix)
+    candidates = [
+        (vivado_timing(path("_timing.rpt")), vivado_utilization(path("_utilization_place.rpt"))),
+        (quartus_timing(path(".sta.summary")), quartus_utilization(path(".fit.summary"))),
+    ]
+    if log is not None:
+        candidates.append((nextpnr_timing(log), nextpnr_utilization(log)))
+    for timing, utilization in candidates:
+        if timing or utilization:
+            return timing, utilization
+    return None, None
@@ -28,7 +28,7 @@ def _generate_sim_h_struct(name, index, siglist):
     return content
 
 
-def _generate_sim_h(platform):
+def _generate_sim_h(build_dir, platform):
     content = """\
 #ifndef __SIM_CORE_H_
 #define __SIM_CORE_H_
@@ -45,7 +45,7 @@ void litex_sim_init(void **out);
 
 #endif /* __SIM_CORE_H_ */
 """
-    tools.write_to_file("dut_header.h", content)
+    tools.write_to_file(os.path.join(build_dir, "dut_header.h"), content)
 
 
 def _generate_sim_cpp_struct(name, index, siglist):
@@ -60,7 +60,7 @@ def _generate_sim_cpp_struct(name, index, siglist):
     return content
 
 
-def _generate_sim_cpp(platform, trace=False):
+def _generate_sim_cpp(build_dir, platform, trace=False):
     content = """\
 #include <stdio.h>
 #include <stdlib.h>
@@ -98,10 +98,10 @@ extern "C" void litex_sim_init(void **out)
     *out=dut;
 }
 """
-    tools.write_to_file("dut_init.cpp", content)
+    tools.write_to_file(os.path.join(build_dir, "dut_init.cpp"), content)
 
 
-def _generate_sim_variables(include_paths):
+def _generate_sim_variables(build_dir, include_paths):
     include = ""
     for path in include_paths:
         include += "-I"+path+" "
@@ -109,15 +109,15 @@ def _generate_sim_variables(include_paths):
 SRC_DIR = {}
 INC_DIR = {}
 """.format(core_directory, include)
-    tools.write_to_file("variables.mak", content)
+    tools.write_to_file(os.path.join(build_dir, "variables.mak"), content)
 
 
-def _generate_sim_config(config):
+def _generate_sim_config(build_dir, config):
     content = config.get_json()
-    tools.write_to_file("sim_config.js", content)
+    tools.write_to_file(os.path.join(build_dir, "sim_config.js"), content)
 
 
-def _build_sim(build_name, sources, threads, coverage):
+def _build_sim(build_dir, build_name, sources, threads, coverage):
     makefile = os.path.join(core_directory, 'Makefile')
     cc_srcs = []
     for filename, language, library in sources:
@@ -132,11 +132,12 @@ mkdir -p modules && cp obj_dir/*.so modules
     "COVERAGE=1" if coverage else "",
     )
     build_script_file = "build_" + build_name + ".sh"
-    tools.write_to_file(build_script_file, build_script_contents, force_unix=True)
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents, force_unix=True)
 
-def _compile_sim(build_name, verbose):
+def _compile_sim(build_dir, build_name, verbose):
     build_script_file = "build_" + build_name + ".sh"
-    p = subprocess.Popen(["bash", build_script_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    p = subprocess.Popen(["bash", build_script_file], cwd=build_dir,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     output, _ = p.communicate()
     output = output.decode('utf-8')
     if p.returncode != 0:
@@ -148,16 +149,16 @@ def _compile_sim(build_name, verbose):
     if verbose:
         print(output)
 
-def _run_sim(build_name, as_root=False):
+def _run_sim(build_dir, build_name, as_root=False):
     run_script_contents = "sudo " if as_root else ""
     run_script_contents += "obj_dir/Vdut"
     run_script_file = "run_" + build_name + ".sh"
-    tools.write_to_file(run_script_file, run_script_contents, force_unix=True)
+    tools.write_to_file(os.path.join(build_dir, run_script_file), run_script_contents, force_unix=True)
     if sys.platform != "win32":
         import termios
         termios_settings = termios.tcgetattr(sys.stdin.fileno())
     try:
-        r = subprocess.call(["bash", run_script_file])
+        r = subprocess.call(["bash", run_script_file], cwd=build_dir)
         if r != 0:
             raise OSError("Subprocess failed")
     except:
@@ -166,14 +167,111 @@ def _run_sim(build_name, as_root=False):
         termios.tcsetattr(sys.stdin.fileno(), termios.TCSAFLUSH, termios_settings)
 
 
+def _generate_cosim_cpp(filename, inputs, outputs):
+    # pins are (name, nbits), exchanged as arrays of 32-bit words
+    content = """\
+#include <stdint.h>
+#include "Vdut.h"
+#include <verilated.h>
+
+double sc_time_stamp()
+{
+    return 0;
+}
+
+extern "C" void *litex_cosim_new(void)
+{
+    return new Vdut;
+}
+
+extern "C" void litex_cosim_delete(void *vdut)
+{
+    Vdut *dut = (Vdut*)vdut;
+    dut->final();
+    delete dut;
+}
+
+extern "C" void litex_cosim_step(void *vdut, const uint32_t *in, uint32_t *out)
+{
+    Vdut *dut = (Vdut*)vdut;
+
+"""
+    offset = 0
+    for name, nbits in inputs:
+        if nbits <= 32:
+            content += "    dut->{} = in[{}];\n".format(name, offset)
+        elif nbits <= 64:
+            content += "    dut->{} = (QData)in[{}] | ((QData)in[{}] << 32);\n".format(
+                name, offset, offset + 1)
+        else:
+            content += "    for(int i = 0; i < {}; i++) dut->{}[i] = in[{} + i];\n".format(
+                (nbits + 31)//32, name, offset)
+        offset += (nbits + 31)//32
+    content += "\n    dut->eval();\n\n"
+    offset = 0
+    for name, nbits in outputs:
+        if nbits <= 32:
+            content += "    out[{}] = dut->{};\n".format(offset, name)
+        elif nbits <= 64:
+            content += "    out[{}] = (uint32_t)dut->{};\n".format(offset, name)
+            content += "    out[{}] = (uint32_t)(dut->{} >> 32);\n".format(offset + 1, name)
+        else:
+            content += "    for(int i = 0; i < {}; i++) out[{} + i] = dut->{}[i];\n".format(
+                (nbits + 31)//32, offset, name)
+        offset += (nbits + 31)//32
+    content += "}\n"
+    tools.write_to_file(filename, content)
+
+
+# Builds the Verilator model of module dut of verilog_file as a shared library
+# stepped with litex_cosim_step, returns the library filename.
+def build_cosim_library(build_dir, verilog_file, inputs, outputs, sources=[],
+                        include_paths=[], threads=1, verbose=False):
+    build_dir = os.path.abspath(build_dir)
+    os.makedirs(build_dir, exist_ok=True)
+    _generate_cosim_cpp(os.path.join(build_dir, "cosim.cpp"), inputs, outputs)
+    cc_srcs = ""
+    for filename in [verilog_file] + list(sources):
+        cc_srcs += "--cc " + os.path.abspath(filename) + " "
+    include = ""
+    for path in include_paths:
+        include += "-I" + os.path.abspath(path) + " "
+    build_script_contents = """\
+rm -rf obj_dir/
+verilator -Wno-fatal -O3 {} --top-module dut --exe cosim.cpp \\
+    -CFLAGS "-fPIC -O3" -LDFLAGS "-shared" -o libcosim.so \\
+    {} --unroll-count 256 {} -Wno-BLKANDNBLK -Wno-WIDTH
+make -j -C obj_dir -f Vdut.mk
+""".format(cc_srcs,
+    "--threads {}".format(threads) if int(threads) > 1 else "",
+    include)
+    build_script_file = os.path.join(build_dir, "build_cosim.sh")
+    tools.write_to_file(build_script_file, build_script_contents, force_unix=True)
+
+    p = subprocess.Popen(["bash", build_script_file], cwd=build_dir,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = p.communicate()
+    output = output.decode('utf-8')
+    if p.returncode != 0:
+        error_messages = []
+        for l in output.splitlines():
+            if verbose or "error" in l.lower():
+                error_messages.append(l)
+        raise OSError("Subprocess failed with {}\n{}".format(p.returncode, "\n".join(error_messages)))
+    if verbose:
+        print(output)
+    return os.path.join(build_dir, "obj_dir", "libcosim.so")
+
+
 class SimVerilatorToolchain:
     def build(self, platform, fragment, build_dir="build", build_name="dut",
             toolchain_path=None, serial="console", build=True, run=True, threads=1,
-            verbose=True, sim_config=None, trace=False, coverage=False):
+            verbose=True, sim_config=None, trace=False, coverage=False,
+            build_cache_dir=None):
+        # build_cache_dir: simulations are not cached
 
         # create build directory
         os.makedirs(build_dir, exist_ok=True)
-        os.chdir(build_dir)
 
         if build:
             # finalize design
@@ -182,31 +280,29 @@ class SimVerilatorToolchain:
             platform.finalize(fragment)
 
             # generate top module
+            top_file = build_name + ".v"
             top_output = platform.get_verilog(fragment,
-                name=build_name, dummy_signal=False, regular_comb=False, blocking_assign=True)
+                name=build_name, dummy_signal=False, regular_comb=False, blocking_assign=True,
+                output=os.path.join(build_dir, top_file))
             named_sc, named_pc = platform.resolve_signals(top_output.ns)
-            top_file = build_name + ".v"
-            top_output.write(top_file)
-            platform.add_source(top_file)
+            platform.add_source(os.path.join(build_dir, top_file))
 
             # generate cpp header/main/variables
-            _generate_sim_h(platform)
-            _generate_sim_cpp(platform, trace)
-            _generate_sim_variables(platform.verilog_include_paths)
+            _generate_sim_h(build_dir, platform)
+            _generate_sim_cpp(build_dir, platform, trace)
+            _generate_sim_variables(build_dir, platform.verilog_include_paths)
 
             # generate sim config
             if sim_config:
-                _generate_sim_config(sim_config)
+                _generate_sim_config(build_dir, sim_config)
 
             # build
-            _build_sim(build_name, platform.sources, threads, coverage)
+            _build_sim(build_dir, build_name, platform.sources, threads, coverage)
 
         # run
         if run:
-            _compile_sim(build_name, verbose)
-            _run_sim(build_name, as_root=sim_config.has_module("ethernet"))
-
-        os.chdir("../../")
+            _compile_sim(build_dir, build_name, verbose)
+            _run_sim(build_dir, build_name, as_root=sim_config.has_module("ethernet"))
 
         if build:
             return top_output.ns
\ No newline at end of file
@@ -93,24 +93,20 @@ else:
 
 def get_migen_git_revision():
     import migen
-    d = os.getcwd()
-    os.chdir(os.path.dirname(migen.__file__))
     try:
-        r = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"])[:-1].decode("utf-8")
+        r = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(migen.__file__))[:-1].decode("utf-8")
     except:
         r = "--------"
-    os.chdir(d)
     return r
 
 def get_litex_git_revision():
     import litex
-    d = os.getcwd()
-    os.chdir(os.path.dirname(litex.__file__))
     try:
-        r = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"])[:-1].decode("utf-8")
+        r = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(litex.__file__))[:-1].decode("utf-8")
     except:
         r = "--------"
-    os.chdir(d)
     return r
 
 def generated_banner(line_comment="//"):
@@ -227,7 +227,7 @@ xilinx_ku_special_overrides = {
 }
 
 
-def _run_yosys(device, sources, vincpaths, build_name):
+def _run_yosys(device, sources, vincpaths, build_dir, build_name):
     ys_contents = ""
     incflags = ""
     for path in vincpaths:
@@ -269,7 +269,7 @@ write_edif -pvector bra -attrprop {build_name}.edif
 """.format(build_name=build_name)
 
     ys_name = build_name + ".ys"
-    tools.write_to_file(ys_name, ys_contents)
-    r = subprocess.call(["yosys", ys_name])
+    tools.write_to_file(os.path.join(build_dir, ys_name), ys_contents)
+    r = subprocess.call(["yosys", ys_name], cwd=build_dir)
     if r != 0:
         raise OSError("Subprocess failed")
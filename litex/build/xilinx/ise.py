@@ -45,11 +45,11 @@ def _build_ucf(named_sc, named_pc):
     return r
 
 
-def _build_xst_files(device, sources, vincpaths, build_name, xst_opt):
+def _build_xst_files(device, sources, vincpaths, build_dir, build_name, xst_opt):
     prj_contents = ""
     for filename, language, library in sources:
         prj_contents += language + " " + library + " " + tools.cygpath(filename) + "\n"
-    tools.write_to_file(build_name + ".prj", prj_contents)
+    tools.write_to_file(os.path.join(build_dir, build_name + ".prj"), prj_contents)
 
     xst_contents = """run
 -ifn {build_name}.prj
@@ -63,10 +63,10 @@ def _build_xst_files(device, sources, vincpaths, build_name, xst_opt):
         for path in vincpaths:
             xst_contents += tools.cygpath(path) + " "
         xst_contents += "}"
-    tools.write_to_file(build_name + ".xst", xst_contents)
+    tools.write_to_file(os.path.join(build_dir, build_name + ".xst"), xst_contents)
 
 
-def _run_yosys(device, sources, vincpaths, build_name):
+def _run_yosys(device, sources, vincpaths, build_dir, build_name):
     ys_contents = ""
     incflags = ""
     for path in vincpaths:
@@ -79,13 +79,13 @@ proc; memory; opt; fsm; opt
 synth_xilinx -top top -edif {build_name}.edif""".format(build_name=build_name)
 
     ys_name = build_name + ".ys"
-    tools.write_to_file(ys_name, ys_contents)
-    r = subprocess.call(["yosys", ys_name])
+    tools.write_to_file(os.path.join(build_dir, ys_name), ys_contents)
+    r = subprocess.call(["yosys", ys_name], cwd=build_dir)
     if r != 0:
         raise OSError("Subprocess failed")
 
 
-def _run_ise(build_name, ise_path, source, mode, ngdbuild_opt,
+def _run_ise(build_dir, build_name, ise_path, source, mode, ngdbuild_opt,
         toolchain, platform, ver=None):
     if sys.platform == "win32" or sys.platform == "cygwin":
         source_cmd = "call "
@@ -136,9 +136,9 @@ bitgen {bitgen_opt} {build_name}.ncd {build_name}.bit{fail_stmt}
             device=platform.device, fail_stmt=fail_stmt)
     build_script_contents += toolchain.ise_commands.format(build_name=build_name)
     build_script_file = "build_" + build_name + script_ext
-    tools.write_to_file(build_script_file, build_script_contents, force_unix=False)
+    tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents, force_unix=False)
     command = shell + [build_script_file]
-    r = tools.subprocess_call_filtered(command, common.colors)
+    r = tools.subprocess_call_filtered(command, common.colors, cwd=build_dir)
     if r != 0:
         raise OSError("Subprocess failed")
 
@@ -166,7 +166,9 @@ class XilinxISEToolchain:
         self.ise_commands = ""
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
-            toolchain_path=None, source=True, run=True, mode="xst", **kwargs):
+            toolchain_path=None, source=True, run=True, mode="xst",
+            build_cache_dir=None, **kwargs):
+        # build_cache_dir: ISE runs are not cached
         if not isinstance(fragment, _Fragment):
             fragment = fragment.get_fragment()
         if toolchain_path is None:
@@ -182,42 +184,41 @@ class XilinxISEToolchain:
         vns = None
 
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
-        try:
-            if mode in ("xst", "yosys", "cpld"):
-                v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-                vns = v_output.ns
-                named_sc, named_pc = platform.resolve_signals(vns)
-                v_file = build_name + ".v"
-                v_output.write(v_file)
-                sources = platform.sources | {(v_file, "verilog", "work")}
-                if mode in ("xst", "cpld"):
-                    _build_xst_files(platform.device, sources, platform.verilog_include_paths, build_name, self.xst_opt)
-                    isemode = mode
-                else:
-                    _run_yosys(platform.device, sources, platform.verilog_include_paths, build_name)
-                    isemode = "edif"
-                    ngdbuild_opt += "-p " + platform.device
-
-            if mode == "mist":
-                from mist import synthesize
-                synthesize(fragment, platform.constraint_manager.get_io_signals())
-
-            if mode == "edif" or mode == "mist":
-                e_output = platform.get_edif(fragment)
-                vns = e_output.ns
-                named_sc, named_pc = platform.resolve_signals(vns)
-                e_file = build_name + ".edif"
-                e_output.write(e_file)
+        if mode in ("xst", "yosys", "cpld"):
+            v_file = build_name + ".v"
+            v_output = platform.get_verilog(fragment, name=build_name,
+                                            output=os.path.join(build_dir, v_file),
+                                            **kwargs)
+            vns = v_output.ns
+            named_sc, named_pc = platform.resolve_signals(vns)
+            sources = platform.sources | {(v_file, "verilog", "work")}
+            if mode in ("xst", "cpld"):
+                _build_xst_files(platform.device, sources, platform.verilog_include_paths, build_dir, build_name, self.xst_opt)
+                isemode = mode
+            else:
+                _run_yosys(platform.device, sources, platform.verilog_include_paths, build_dir, build_name)
                 isemode = "edif"
-
-            tools.write_to_file(build_name + ".ucf", _build_ucf(named_sc, named_pc))
-            if run:
-                _run_ise(build_name, toolchain_path, source, isemode,
-                         ngdbuild_opt, self, platform)
-        finally:
-            os.chdir(cwd)
+                ngdbuild_opt += "-p " + platform.device
+
+        if mode == "mist":
+            from mist import synthesize
+            synthesize(fragment, platform.constraint_manager.get_io_signals())
+
+        if mode == "edif" or mode == "mist":
+            e_output = platform.get_edif(fragment)
+            vns = e_output.ns
+            named_sc, named_pc = platform.resolve_signals(vns)
+            e_file = build_name + ".edif"
+            # ConvOutput.write puts the data files in the current directory
+            tools.write_to_file(os.path.join(build_dir, e_file), e_output.main_source)
+            for filename, content in e_output.data_files.items():
+                tools.write_to_file(os.path.join(build_dir, filename), content)
+            isemode = "edif"
+
+        tools.write_to_file(os.path.join(build_dir, build_name + ".ucf"), _build_ucf(named_sc, named_pc))
+        if run:
+            _run_ise(build_dir, build_name, toolchain_path, source, isemode,
+                     ngdbuild_opt, self, platform)
 
         return vns
 
@@ -2,16 +2,23 @@
 # License: BSD
 
 import os
+import re
+import shutil
 import subprocess
 import sys
 import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from distutils.spawn import find_executable
 
 from migen.fhdl.structure import _Fragment
 
 from litex.build.generic_platform import *
 from litex.build import tools
+from litex.build.cache import cached_run, tool_version
+from litex.build.reports import vivado_timing
 from litex.build.xilinx import common
+from litex.gen.fhdl.verilog import split_modules
 
 
 def _format_constraint(c):
@@ -56,13 +63,18 @@ def _build_xdc(named_sc, named_pc):
     return r
 
 
-def _run_vivado(build_name, vivado_path, source, ver=None):
+def _build_vivado_script(build_dir, build_name, vivado_path, tcl_scripts, ver=None):
+    # writes the script running Vivado on tcl_scripts, returns its command
     if sys.platform == "win32" or sys.platform == "cygwin":
         build_script_contents = "REM Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\n"
-        build_script_contents += "vivado -mode batch -source " + build_name + ".tcl\n"
-        build_script_file = "build_" + build_name + ".bat"
+        for tcl_script in tcl_scripts:
+            # vivado is a batch file: call returns from it, errorlevel stops
+            # at the first failing run
+            build_script_contents += "call vivado -mode batch -source " + tcl_script + "\n"
+            build_script_contents += "if errorlevel 1 exit /b 1\n"
+        build_script_file = os.path.join(os.path.abspath(build_dir), "build_" + build_name + ".bat")
         tools.write_to_file(build_script_file, build_script_contents)
-        command = build_script_file
+        return build_script_file
     else:
         build_script_contents = "# Autogenerated by LiteX / git: " + tools.get_litex_git_revision() + "\nset -e\n"
         # Only source Vivado settings if not already in our $PATH
@@ -81,15 +93,189 @@ def _run_vivado(build_name, vivado_path, source, ver=None):
                 raise OSError("Unable to locate Vivado directory or settings.")
             build_script_contents += "source " + settings + "\n"
 
-        build_script_contents += "vivado -mode batch -source " + build_name + ".tcl\n"
+        for tcl_script in tcl_scripts:
+            build_script_contents += "vivado -mode batch -source " + tcl_script + "\n"
         build_script_file = "build_" + build_name + ".sh"
-        tools.write_to_file(build_script_file, build_script_contents)
-        command = ["bash", build_script_file]
-    r = tools.subprocess_call_filtered(command, common.colors)
+        tools.write_to_file(os.path.join(build_dir, build_script_file), build_script_contents)
+        return ["bash", build_script_file]
+
+
+def _run_vivado(build_dir, build_name, vivado_path, source, ver=None, ooc_scripts=[]):
+    command = _build_vivado_script(build_dir, build_name, vivado_path,
+                                   ooc_scripts + [build_name + ".tcl"], ver)
+    r = tools.subprocess_call_filtered(command, common.colors, cwd=build_dir)
     if r != 0:
         raise OSError("Subprocess failed")
 
 
+def _split_ooc_modules(build_dir, build_name, v_file, ooc_modules):
+    # Moves the modules synthesized out of context, with the modules they
+    # instantiate, to sources of their own. The top level source keeps black
+    # box stubs of them, and the modules only they instantiate are dropped
+    # from it. Returns the modules whose checkpoint is out of date.
+    with open(os.path.join(build_dir, v_file)) as f:
+        source = f.read()
+    banner = source.split("\nmodule ")[0] + "\n"
+    definitions = OrderedDict(split_modules(source))
+    for name in ooc_modules:
+        if name not in definitions:
+            raise ValueError("No module '{}' to synthesize out of context".format(name))
+
+    def children(name):
+        return [child for child in re.findall(r"^(\w+) \w+\($", definitions[name], re.MULTILINE)
+                if child in definitions]
+
+    def instantiated(name, r, stop=()):
+        for child in children(name):
+            if child not in r:
+                r.add(child)
+                if child not in stop:
+                    instantiated(child, r, stop)
+        return r
+
+    # modules used by the top level without going through the out of
+    # context ones
+    roots = set(definitions) - {child for name in definitions for child in children(name)}
+    used = set(roots)
+    for name in roots:
+        instantiated(name, used, ooc_modules)
+
+    top = []
+    for name, text in definitions.items():
+        if name in ooc_modules:
+            header = text[:text.index("\n);\n") + len("\n);\n")]
+            top.append("(* black_box *)\n" + header + "endmodule\n")
+        elif name in used:
+            top.append(text)
+    tools.write_to_file(os.path.join(build_dir, v_file), banner + "\n".join(top))
+
+    stale = []
+    for name in ooc_modules:
+        used = instantiated(name, {name})
+        text = "\n".join(t for n, t in definitions.items() if n in used)
+        ooc_file = os.path.join(build_dir, build_name + "_" + name)
+        tools.write_to_file(ooc_file + ".v", text)
+        # the source of the last checkpoint is kept next to it
+        try:
+            with open(ooc_file + "_ooc.v") as f:
+                up_to_date = f.read() == text and \
+                    os.path.exists(ooc_file + "_ooc.dcp")
+        except OSError:
+            up_to_date = False
+        if not up_to_date:
+            stale.append(name)
+    return stale
+
+
+def _vivado_version(vivado_path):
+    if find_executable("vivado"):
+        return tool_version("vivado", "-version")
+    # the settings script is in the directory of the version
+    for p in [vivado_path, os.path.join(vivado_path, "Vivado")]:
+        try:
+            return common.settings(p)
+        except OSError:
+            continue
+    return ""
+
+
+# Implementation strategies of the design space exploration: directives of
+# opt_design, place_design, phys_opt_design (after placement) and
+# route_design, and "commands" run after opening the synthesized checkpoint.
+default_strategies = OrderedDict([
+    ("default",           {}),
+    ("explore",           {"opt": "Explore", "place": "Explore",
+                           "phys_opt": "Explore", "route": "Explore"}),
+    ("extra_timing",      {"place": "ExtraTimingOpt", "phys_opt": "AggressiveExplore",
+                           "route": "AggressiveExplore"}),
+    ("net_delay_high",    {"place": "ExtraNetDelay_high", "phys_opt": "AggressiveFanoutOpt",
+                           "route": "MoreGlobalIterations"}),
+    ("spread_logic_high", {"place": "AltSpreadLogic_high", "phys_opt": "AlternateReplication",
+                           "route": "HigherDelayCost"}),
+    ("early_block",       {"place": "EarlyBlockPlacement", "phys_opt": "AlternateFlowWithRetiming",
+                           "route": "AlternateCLBRouting"}),
+    ("post_placement",    {"opt": "ExploreWithRemap", "place": "ExtraPostPlacementOpt",
+                           "phys_opt": "AddRetime", "route": "NoTimingRelaxation"}),
+    ("net_delay_low",     {"place": "ExtraNetDelay_low", "phys_opt": "ExploreWithHoldFix",
+                           "route": "AdvancedSkewModeling"}),
+])
+
+
+def _strategies(strategies):
+    # a number of default strategies, names of default strategies (a list or
+    # a comma separated string) or a dict of name: directives
+    if isinstance(strategies, int):
+        if not 0 < strategies <= len(default_strategies):
+            raise ValueError("Between 1 and {} default strategies".format(len(default_strategies)))
+        return OrderedDict(list(default_strategies.items())[:strategies])
+    if isinstance(strategies, dict):
+        return OrderedDict(strategies)
+    if isinstance(strategies, str):
+        strategies = [name.strip() for name in strategies.split(",")]
+    unknown = [name for name in strategies if name not in default_strategies]
+    if unknown:
+        raise ValueError("Unknown strategies {}, valid ones are {}".format(
+            ", ".join(unknown), ", ".join(default_strategies)))
+    return OrderedDict((name, default_strategies[name]) for name in strategies)
+
+
+def _run_strategies(build_dir, build_name, vivado_path, strategies, jobs=None):
+    # implements the synthesized checkpoint with the strategies in parallel
+    # and keeps the outputs of the one with the best timing
+    def run(name):
+        directory = os.path.join(build_dir, "strategies", name)
+        command = _build_vivado_script(directory, build_name, vivado_path, [build_name + ".tcl"])
+        with open(os.path.join(directory, "vivado.out"), "w") as log:
+            return subprocess.call(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as executor:
+        returncodes = list(executor.map(run, strategies))
+
+    # runs without timing (e.g. unconstrained designs, WNS "NA") are ranked
+    # after the ones with timing
+    timed = []
+    untimed = []
+    failed = []
+    for name, returncode in zip(strategies, returncodes):
+        if returncode != 0:
+            failed.append(name)
+            continue
+        timing = vivado_timing(os.path.join(build_dir, "strategies", name, build_name + "_timing.rpt"))
+        if timing is None or timing["wns"] is None:
+            untimed.append(name)
+        else:
+            timed.append((name, timing["wns"], timing["tns"] or 0.0))
+    timed.sort(key=lambda r: (r[1], r[2]), reverse=True)
+    ranked = [r[0] for r in timed] + untimed
+
+    lines = ["{:20} {:>10} {:>10}".format("Strategy", "WNS (ns)", "TNS (ns)")]
+    for name, wns, tns in timed:
+        lines.append("{:20} {:10.3f} {:10.3f}".format(name, wns, tns))
+    for name in untimed:
+        lines.append("{:20} {:>10} {:>10}".format(name, "NA", "NA"))
+    for name in failed:
+        lines.append("{:20} {:>10} {:>10}".format(name, "failed", "-"))
+    if ranked:
+        lines.append("")
+        lines.append("Best: " + ranked[0])
+    summary = "\n".join(lines) + "\n"
+    tools.write_to_file(os.path.join(build_dir, build_name + "_strategies.rpt"), summary)
+    print(summary, end="")
+    if not ranked:
+        raise OSError("No implementation strategy succeeded, see {}".format(
+            os.path.join(build_dir, "strategies", "*", "vivado.out")))
+
+    # bitstreams, checkpoint and reports of the best run
+    directory = os.path.join(build_dir, "strategies", ranked[0])
+    for filename in os.listdir(directory):
+        if filename == build_name + ".tcl" or filename.startswith("build_"):
+            continue
+        if os.path.splitext(filename)[1] in (".log", ".jou", ".out"):
+            continue
+        if os.path.isfile(os.path.join(directory, filename)):
+            shutil.copyfile(os.path.join(directory, filename), os.path.join(build_dir, filename))
+
+
 class XilinxVivadoToolchain:
     attr_translate = {
         "keep": ("dont_touch", "true"),
@@ -109,7 +295,29 @@ class XilinxVivadoToolchain:
         self.clocks = dict()
         self.false_paths = set()
 
-    def _build_batch(self, platform, sources, edifs, ips, build_name, synth_mode, enable_xpm):
+    def _build_ooc_batch(self, platform, sources, build_dir, build_name, name, enable_xpm):
+        tcl = []
+        tcl.append("create_project -force -name {}_{}_ooc -part {}".format(build_name, name, platform.device))
+        if enable_xpm:
+            tcl.append("set_property XPM_LIBRARIES {XPM_CDC XPM_MEMORY} [current_project]")
+        for filename, language, library in sources:
+            filename_tcl = "{" + filename + "}"
+            tcl.append("add_files " + filename_tcl)
+            if language == "vhdl":
+                tcl.append("set_property library {} [get_files {}]"
+                           .format(library, filename_tcl))
+        if platform.verilog_include_paths:
+            tcl.append("synth_design -top {} -part {} -mode out_of_context -include_dirs {{{}}}".format(name, platform.device, " ".join(platform.verilog_include_paths)))
+        else:
+            tcl.append("synth_design -top {} -part {} -mode out_of_context".format(name, platform.device))
+        tcl.append("write_checkpoint -force {}_{}_ooc.dcp".format(build_name, name))
+        tcl.append("file copy -force {0}_{1}.v {0}_{1}_ooc.v".format(build_name, name))
+        tcl.append("quit")
+        tools.write_to_file(os.path.join(build_dir, build_name + "_" + name + "_ooc.tcl"), "\n".join(tcl))
+        return build_name + "_" + name + "_ooc.tcl"
+
+    def _build_batch(self, platform, sources, edifs, ips, build_dir, build_name, synth_mode, enable_xpm,
+                     incremental=False, ooc_modules=[], explore=False):
         assert synth_mode in ["vivado", "yosys"]
         tcl = []
         tcl.append("create_project -force -name {} -part {}".format(build_name, platform.device))
@@ -149,20 +357,52 @@ class XilinxVivadoToolchain:
             tcl.append("link_design -top {} -part {}".format(build_name, platform.device))
         else:
             raise OSError("Unknown synthesis mode! {}".format(synth_mode))
+        for name in ooc_modules:
+            # black boxes are filled with the out of context checkpoints
+            tcl.append("foreach cell [get_cells -quiet -hierarchical -filter {{REF_NAME == {} && IS_BLACKBOX}}] {{".format(name))
+            tcl.append("    read_checkpoint -cell $cell {}_{}_ooc.dcp".format(build_name, name))
+            tcl.append("}")
+        if incremental or explore:
+            tcl.append("write_checkpoint -force {}_synth.dcp".format(build_name))
 
         tcl.append("report_timing_summary -file {}_timing_synth.rpt".format(build_name))
         tcl.append("report_utilization -hierarchical -file {}_utilization_hierarchical_synth.rpt".format(build_name))
         tcl.append("report_utilization -file {}_utilization_synth.rpt".format(build_name))
-        tcl.append("opt_design")
-        tcl.append("place_design")
-        if self.with_phys_opt:
+        if explore:
+            # implemented by _run_strategies
+            tcl.append("quit")
+        else:
+            tcl += self._implementation_tcl(build_name, incremental=incremental)
+        tools.write_to_file(os.path.join(build_dir, build_name + ".tcl"), "\n".join(tcl))
+
+    def _implementation_tcl(self, build_name, directives=None, incremental=False):
+        if directives is None:
+            directives = {}
+        def directive(command, step):
+            if step in directives:
+                return command + " -directive " + directives[step]
+            return command
+
+        tcl = []
+        tcl.append(directive("opt_design", "opt"))
+        if incremental:
+            # placement and routing reuse the routed checkpoint of the last run
+            tcl.append("if {{[file exists {}_incremental.dcp]}} {{".format(build_name))
+            tcl.append("    read_checkpoint -incremental {}_incremental.dcp".format(build_name))
+            tcl.append("}")
+        tcl.append(directive("place_design", "place"))
+        if "phys_opt" in directives:
+            tcl.append(directive("phys_opt_design", "phys_opt"))
+        elif self.with_phys_opt:
             tcl.append("phys_opt_design -directive AddRetime")
+        if incremental:
+            tcl.append("write_checkpoint -force {}_place.dcp".format(build_name))
         tcl.append("report_utilization -hierarchical -file {}_utilization_hierarchical_place.rpt".format(build_name))
         tcl.append("report_utilization -file {}_utilization_place.rpt".format(build_name))
         tcl.append("report_io -file {}_io.rpt".format(build_name))
         tcl.append("report_control_sets -verbose -file {}_control_sets.rpt".format(build_name))
         tcl.append("report_clock_utilization -file {}_clock_utilization.rpt".format(build_name))
-        tcl.append("route_design")
+        tcl.append(directive("route_design", "route"))
         tcl.append("phys_opt_design")
         tcl.append("report_timing_summary -no_header -no_detailed_paths")
         tcl.append("write_checkpoint -force {}_route.dcp".format(build_name))
@@ -176,7 +416,18 @@ class XilinxVivadoToolchain:
         for additional_command in self.additional_commands:
             tcl.append(additional_command.format(build_name=build_name))
         tcl.append("quit")
-        tools.write_to_file(build_name + ".tcl", "\n".join(tcl))
+        return tcl
+
+    def _build_strategy_batch(self, build_dir, build_name, name, directives):
+        # implementation of the synthesized checkpoint in a directory of its own
+        directory = os.path.join(build_dir, "strategies", name)
+        os.makedirs(directory, exist_ok=True)
+        tcl = []
+        tcl.append("open_checkpoint ../../{}_synth.dcp".format(build_name))
+        tcl.extend(c.format(build_name=build_name) for c in directives.get("commands", []))
+        tcl += self._implementation_tcl(build_name, directives)
+        tools.write_to_file(os.path.join(directory, build_name + ".tcl"), "\n".join(tcl))
+        return os.path.join("strategies", name, build_name + ".tcl")
 
     def _convert_clocks(self, platform):
         for clk, period in sorted(self.clocks.items(), key=lambda x: x[0].duid):
@@ -221,33 +472,73 @@ class XilinxVivadoToolchain:
 
     def build(self, platform, fragment, build_dir="build", build_name="top",
             toolchain_path="/opt/Xilinx/Vivado", source=True, run=True,
-            synth_mode="vivado", enable_xpm=False, **kwargs):
+            synth_mode="vivado", enable_xpm=False, build_cache_dir=None,
+            incremental=False, ooc_modules=[], strategies=None, strategy_jobs=None,
+            **kwargs):
         if toolchain_path is None:
             toolchain_path = "/opt/Xilinx/Vivado"
+        if ooc_modules and synth_mode != "vivado":
+            raise ValueError("Out of context synthesis needs synth_mode=\"vivado\"")
+        if strategies is not None:
+            # design space exploration: implementation runs of the
+            # synthesized checkpoint, see default_strategies
+            if incremental:
+                raise ValueError("Implementation strategies are not incremental")
+            strategies = _strategies(strategies)
         os.makedirs(build_dir, exist_ok=True)
-        cwd = os.getcwd()
-        os.chdir(build_dir)
 
         if not isinstance(fragment, _Fragment):
+            if ooc_modules:
+                # one Verilog module per submodule
+                kwargs["hierarchy"] = fragment
             fragment = fragment.get_fragment()
+        elif ooc_modules:
+            raise ValueError("Out of context synthesis needs the top Module")
         platform.finalize(fragment)
         self._convert_clocks(platform)
         self._constrain(platform)
-        v_output = platform.get_verilog(fragment, name=build_name, **kwargs)
-        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         v_file = build_name + ".v"
-        v_output.write(v_file)
+        v_output = platform.get_verilog(fragment, name=build_name,
+            output=os.path.join(build_dir, v_file), **kwargs)
+        named_sc, named_pc = platform.resolve_signals(v_output.ns)
         sources = platform.sources | {(v_file, "verilog", "work")}
         edifs = platform.edifs
         ips = platform.ips
-        self._build_batch(platform, sources, edifs, ips, build_name, synth_mode, enable_xpm)
-        tools.write_to_file(build_name + ".xdc", _build_xdc(named_sc, named_pc))
+        ooc_scripts = []
+        ooc_files = []
+        if ooc_modules:
+            stale = _split_ooc_modules(build_dir, build_name, v_file, ooc_modules)
+            for name in ooc_modules:
+                ooc_file = build_name + "_" + name + ".v"
+                script = self._build_ooc_batch(platform,
+                    platform.sources | {(ooc_file, "verilog", "work")},
+                    build_dir, build_name, name, enable_xpm)
+                ooc_files += [ooc_file, script]
+                if name in stale:
+                    ooc_scripts.append(script)
+        route_dcp = os.path.join(build_dir, build_name + "_route.dcp")
+        if incremental and os.path.exists(route_dcp):
+            shutil.copyfile(route_dcp, os.path.join(build_dir, build_name + "_incremental.dcp"))
+        self._build_batch(platform, sources, edifs, ips, build_dir, build_name, synth_mode, enable_xpm,
+                          incremental, ooc_modules, explore=strategies is not None)
+        strategy_files = []
+        for name, directives in (strategies or {}).items():
+            strategy_files.append(self._build_strategy_batch(build_dir, build_name, name, directives))
+        tools.write_to_file(os.path.join(build_dir, build_name + ".xdc"), _build_xdc(named_sc, named_pc))
         if run:
-            if synth_mode == "yosys":
-                common._run_yosys(platform.device, sources, platform.verilog_include_paths, build_name)
-            _run_vivado(build_name, toolchain_path, source)
-
-        os.chdir(cwd)
+            def run_toolchain():
+                if synth_mode == "yosys":
+                    common._run_yosys(platform.device, sources, platform.verilog_include_paths, build_dir, build_name)
+                _run_vivado(build_dir, build_name, toolchain_path, source, ooc_scripts=ooc_scripts)
+                if strategies is not None:
+                    _run_strategies(build_dir, build_name, toolchain_path, strategies, strategy_jobs)
+            cached_run(build_cache_dir, run_toolchain, build_dir,
+                generated=[v_file, build_name + ".tcl", build_name + ".xdc"]
+                    + list(v_output.data_files) + ooc_files + strategy_files,
+                outputs=[build_name + ".bit", build_name + ".bin", build_name + "_*.rpt"],
+                sources=[filename for filename, language, library in platform.sources] + list(edifs) + list(ips),
+                include_paths=platform.verilog_include_paths,
+                toolchain=[_vivado_version(toolchain_path), synth_mode, source])
 
         return v_output.ns
 
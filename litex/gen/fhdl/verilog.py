@@ -1,10 +1,15 @@
 from functools import partial
 from operator import itemgetter
-import collections
+import collections.abc
+import hashlib
+import multiprocessing
+import os
+import shutil
 
 from migen.fhdl.structure import *
 from migen.fhdl.structure import _Operator, _Slice, _Assign, _Fragment
 from migen.fhdl.tools import *
+from migen.fhdl.specials import Instance, Memory, Tristate, _MemoryPort
 from migen.fhdl.namer import build_namespace
 from migen.fhdl.conv_output import ConvOutput
 
@@ -117,9 +122,67 @@ def _printexpr(ns, node):
 (_AT_BLOCKING, _AT_NONBLOCKING, _AT_SIGNAL) = range(3)
 
 
-def _printnode(ns, at, level, node, target_filter=None):
-    if target_filter is not None and target_filter not in list_targets(node):
-        return ""
+class _TargetSets:
+    # targets of statements, computed once for each node
+    def __init__(self):
+        self.sets = dict()
+
+    def __call__(self, node):
+        try:
+            return self.sets[id(node)][1]
+        except KeyError:
+            pass
+        if isinstance(node, _Assign):
+            r = list_targets(node)
+        elif isinstance(node, If):
+            r = self(node.t) | self(node.f)
+        elif isinstance(node, Case):
+            r = set()
+            for statements in node.cases.values():
+                r |= self(statements)
+        elif isinstance(node, collections.abc.Iterable):
+            r = set()
+            for statement in node:
+                r |= self(statement)
+        else:
+            r = set()
+        # the reference keeps the id unique
+        self.sets[id(node)] = (node, r)
+        return r
+
+
+def _group_by_targets(statements, targets):
+    # same groups and order as migen.fhdl.tools.group_by_targets, in linear
+    # time: groups are ordered by their last statement
+    statements = list(flat_iteration(statements))
+    parent = list(range(len(statements)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    owners = dict()
+    for i, statement in enumerate(statements):
+        for target in targets(statement):
+            owner = owners.setdefault(target, i)
+            a, b = find(i), find(owner)
+            if a != b:
+                parent[b] = a
+    groups = collections.OrderedDict()
+    for i in range(len(statements)):
+        groups.setdefault(find(i), []).append(i)
+    r = []
+    for members in sorted(groups.values(), key=lambda x: x[-1]):
+        group_targets = set()
+        for i in members:
+            group_targets |= targets(statements[i])
+        r.append((group_targets, [statements[i] for i in members]))
+    return r
+
+
+def _printnode_chunks(out, ns, at, level, node, target_filter, targets):
+    if target_filter is not None and target_filter not in targets(node):
+        return
     elif isinstance(node, _Assign):
         if at == _AT_BLOCKING:
             assignment = " = "
@@ -129,34 +192,31 @@ def _printnode(ns, at, level, node, target_filter=None):
             assignment = " = "
         else:
             assignment = " <= "
-        return "\t"*level + _printexpr(ns, node.l)[0] + assignment + _printexpr(ns, node.r)[0] + ";\n"
-    elif isinstance(node, collections.Iterable):
-        return "".join(_printnode(ns, at, level, n, target_filter) for n in node)
+        out.append("\t"*level + _printexpr(ns, node.l)[0] + assignment + _printexpr(ns, node.r)[0] + ";\n")
+    elif isinstance(node, collections.abc.Iterable):
+        for n in node:
+            _printnode_chunks(out, ns, at, level, n, target_filter, targets)
     elif isinstance(node, If):
-        r = "\t"*level + "if (" + _printexpr(ns, node.cond)[0] + ") begin\n"
-        r += _printnode(ns, at, level + 1, node.t, target_filter)
+        out.append("\t"*level + "if (" + _printexpr(ns, node.cond)[0] + ") begin\n")
+        _printnode_chunks(out, ns, at, level + 1, node.t, target_filter, targets)
         if node.f:
-            r += "\t"*level + "end else begin\n"
-            r += _printnode(ns, at, level + 1, node.f, target_filter)
-        r += "\t"*level + "end\n"
-        return r
+            out.append("\t"*level + "end else begin\n")
+            _printnode_chunks(out, ns, at, level + 1, node.f, target_filter, targets)
+        out.append("\t"*level + "end\n")
     elif isinstance(node, Case):
         if node.cases:
-            r = "\t"*level + "case (" + _printexpr(ns, node.test)[0] + ")\n"
+            out.append("\t"*level + "case (" + _printexpr(ns, node.test)[0] + ")\n")
             css = [(k, v) for k, v in node.cases.items() if isinstance(k, Constant)]
             css = sorted(css, key=lambda x: x[0].value)
             for choice, statements in css:
-                r += "\t"*(level + 1) + _printexpr(ns, choice)[0] + ": begin\n"
-                r += _printnode(ns, at, level + 2, statements, target_filter)
-                r += "\t"*(level + 1) + "end\n"
+                out.append("\t"*(level + 1) + _printexpr(ns, choice)[0] + ": begin\n")
+                _printnode_chunks(out, ns, at, level + 2, statements, target_filter, targets)
+                out.append("\t"*(level + 1) + "end\n")
             if "default" in node.cases:
-                r += "\t"*(level + 1) + "default: begin\n"
-                r += _printnode(ns, at, level + 2, node.cases["default"], target_filter)
-                r += "\t"*(level + 1) + "end\n"
-            r += "\t"*level + "endcase\n"
-            return r
-        else:
-            return ""
+                out.append("\t"*(level + 1) + "default: begin\n")
+                _printnode_chunks(out, ns, at, level + 2, node.cases["default"], target_filter, targets)
+                out.append("\t"*(level + 1) + "end\n")
+            out.append("\t"*level + "endcase\n")
     elif isinstance(node, Display):
         s = "\"" + node.s + "\""
         for arg in node.args:
@@ -165,24 +225,77 @@ def _printnode(ns, at, level, node, target_filter=None):
                 s += ns.get_name(arg)
             else:
                 s += str(arg)
-        return "\t"*level + "$display(" + s + ");\n"
+        out.append("\t"*level + "$display(" + s + ");\n")
     elif isinstance(node, Finish):
-        return "\t"*level + "$finish;\n"
+        out.append("\t"*level + "$finish;\n")
     else:
         raise TypeError("Node of unrecognized type: "+str(type(node)))
 
 
-def _list_comb_wires(f):
+def _printnode(ns, at, level, node, target_filter=None, targets=None):
+    # output is collected in a list of chunks, joined once
+    if targets is None:
+        targets = _TargetSets()
+    out = []
+    _printnode_chunks(out, ns, at, level, node, target_filter, targets)
+    return "".join(out)
+
+
+# Blocks printed by the workers of _print_blocks, inherited when forking:
+# printing only looks up names already allocated by the namespace, the blocks
+# do not need to be pickled.
+_parallel_blocks = None
+_parallel_min_blocks = 256
+
+
+def _print_block_range(bounds):
+    return [_parallel_blocks[i]() for i in range(*bounds)]
+
+
+def _print_blocks(blocks, jobs):
+    global _parallel_blocks
+    if jobs <= 1 or len(blocks) < _parallel_min_blocks \
+      or "fork" not in multiprocessing.get_all_start_methods():
+        return [print_block() for print_block in blocks]
+    # a few chunks per worker to even out their sizes
+    chunk = (len(blocks) + 4*jobs - 1)//(4*jobs)
+    _parallel_blocks = blocks
+    try:
+        with multiprocessing.get_context("fork").Pool(jobs) as pool:
+            texts = pool.map(_print_block_range,
+                             [(i, min(i + chunk, len(blocks)))
+                              for i in range(0, len(blocks), chunk)])
+    finally:
+        _parallel_blocks = None
+    return [text for chunk_texts in texts for text in chunk_texts]
+
+
+def _join_blocks(pieces, jobs):
+    # pieces are strings and functions printing a block, blocks are printed
+    # in parallel when jobs > 1 and concatenated in order.
+    r = []
+    blocks = []
+    for piece in pieces:
+        if isinstance(piece, str):
+            r.append(piece)
+        else:
+            blocks.append((len(r), piece))
+            r.append(None)
+    texts = _print_blocks([print_block for i, print_block in blocks], jobs)
+    for (i, print_block), text in zip(blocks, texts):
+        r[i] = text
+    return "".join(r)
+
+
+def _list_comb_wires(groups):
     r = set()
-    groups = group_by_targets(f.comb)
     for g in groups:
         if len(g[1]) == 1 and isinstance(g[1][0], _Assign):
             r |= g[0]
     return r
 
 def _printattr(attr, attr_translate):
-    r = ""
-    firsta = True
+    r = []
     for attr in sorted(attr,
                        key=lambda x: ("", x) if isinstance(x, str) else x):
         if isinstance(attr, tuple):
@@ -194,66 +307,72 @@ def _printattr(attr, attr_translate):
             if at is None:
                 continue
             attr_name, attr_value = at
-        if not firsta:
-            r += ", "
-        firsta = False
-        r += attr_name + " = \"" + attr_value + "\""
+        r.append(attr_name + " = \"" + attr_value + "\"")
     if r:
-        r = "(* " + r + " *)"
-    return r
+        return "(* " + ", ".join(r) + " *)"
+    return ""
 
 
 def _printheader(f, ios, name, ns, attr_translate,
-                 reg_initialization):
+                 reg_initialization, comb_groups, submodule_ios=None):
     sigs = list_signals(f) | list_special_ios(f, True, True, True)
     special_outs = list_special_ios(f, False, True, True)
     inouts = list_special_ios(f, False, False, True)
+    if submodule_ios is not None:
+        # signals connected to instances of submodules, driven by them
+        # like the outputs of specials
+        connected, outs, instance_inouts = submodule_ios
+        sigs |= connected
+        special_outs |= outs | instance_inouts
+        inouts |= instance_inouts
     targets = list_targets(f) | special_outs
-    wires = _list_comb_wires(f) | special_outs
-    r = "module " + name + "(\n"
-    firstp = True
+    wires = _list_comb_wires(comb_groups) | special_outs
+    r = ["module " + name + "(\n"]
+    ports = []
     for sig in sorted(ios, key=lambda x: x.duid):
-        if not firstp:
-            r += ",\n"
-        firstp = False
+        port = ""
         attr = _printattr(sig.attr, attr_translate)
         if attr:
-            r += "\t" + attr
+            port += "\t" + attr
         sig.type = "wire"
         if sig in inouts:
             sig.direction = "inout"
-            r += "\tinout " + _printsig(ns, sig)
+            port += "\tinout " + _printsig(ns, sig)
         elif sig in targets:
             sig.direction = "output"
             if sig in wires:
-                r += "\toutput " + _printsig(ns, sig)
+                port += "\toutput " + _printsig(ns, sig)
             else:
                 sig.type = "reg"
-                r += "\toutput reg " + _printsig(ns, sig)
+                port += "\toutput reg " + _printsig(ns, sig)
         else:
             sig.direction = "input"
-            r += "\tinput " + _printsig(ns, sig)
-    r += "\n);\n\n"
+            port += "\tinput " + _printsig(ns, sig)
+        ports.append(port)
+    r.append(",\n".join(ports))
+    r.append("\n);\n\n")
     for sig in sorted(sigs - ios, key=lambda x: x.duid):
         attr = _printattr(sig.attr, attr_translate)
         if attr:
-            r += attr + " "
+            r.append(attr + " ")
         if sig in wires:
-            r += "wire " + _printsig(ns, sig) + ";\n"
+            r.append("wire " + _printsig(ns, sig) + ";\n")
         else:
             if reg_initialization:
-                r += "reg " + _printsig(ns, sig) + " = " + _printexpr(ns, sig.reset)[0] + ";\n"
+                r.append("reg " + _printsig(ns, sig) + " = " + _printexpr(ns, sig.reset)[0] + ";\n")
             else:
-                r += "reg " + _printsig(ns, sig) + ";\n"
-    r += "\n"
-    return r
+                r.append("reg " + _printsig(ns, sig) + ";\n")
+    r.append("\n")
+    return "".join(r)
 
 
 def _printcomb_simulation(f, ns,
             display_run,
             dummy_signal,
-            blocking_assign):
-    r = ""
+            blocking_assign,
+            targets,
+            jobs=1):
+    r = []
     if f.comb:
         if dummy_signal:
             # Generate a dummy event to get the simulator
@@ -261,10 +380,10 @@ def _printcomb_simulation(f, ns,
             syn_off = "// synthesis translate_off\n"
             syn_on = "// synthesis translate_on\n"
             dummy_s = Signal(name_override="dummy_s")
-            r += syn_off
-            r += "reg " + _printsig(ns, dummy_s) + ";\n"
-            r += "initial " + ns.get_name(dummy_s) + " <= 1'd0;\n"
-            r += syn_on
+            r.append(syn_off)
+            r.append("reg " + _printsig(ns, dummy_s) + ";\n")
+            r.append("initial " + ns.get_name(dummy_s) + " <= 1'd0;\n")
+            r.append(syn_on)
 
 
         from collections import defaultdict
@@ -272,87 +391,475 @@ def _printcomb_simulation(f, ns,
         target_stmt_map = defaultdict(list)
 
         for statement in flat_iteration(f.comb):
-            targets = list_targets(statement)
-            for t in targets:
+            for t in targets(statement):
                 target_stmt_map[t].append(statement)
 
-        groups = group_by_targets(f.comb)
-
         for n, (t, stmts) in enumerate(target_stmt_map.items()):
             assert isinstance(t, Signal)
             if len(stmts) == 1 and isinstance(stmts[0], _Assign):
-                r += "assign " + _printnode(ns, _AT_BLOCKING, 0, stmts[0])
+                r.append("assign ")
+                r.append(partial(_printnode, ns, _AT_BLOCKING, 0, stmts[0],
+                                 targets=targets))
             else:
                 if dummy_signal:
                     dummy_d = Signal(name_override="dummy_d")
-                    r += "\n" + syn_off
-                    r += "reg " + _printsig(ns, dummy_d) + ";\n"
-                    r += syn_on
+                    r.append("\n" + syn_off)
+                    r.append("reg " + _printsig(ns, dummy_d) + ";\n")
+                    r.append(syn_on)
 
-                r += "always @(*) begin\n"
+                r.append("always @(*) begin\n")
                 if display_run:
-                    r += "\t$display(\"Running comb block #" + str(n) + "\");\n"
+                    r.append("\t$display(\"Running comb block #" + str(n) + "\");\n")
                 if blocking_assign:
-                    r += "\t" + ns.get_name(t) + " = " + _printexpr(ns, t.reset)[0] + ";\n"
-                    r += _printnode(ns, _AT_BLOCKING, 1, stmts, t)
+                    r.append("\t" + ns.get_name(t) + " = " + _printexpr(ns, t.reset)[0] + ";\n")
+                    at = _AT_BLOCKING
                 else:
-                    r += "\t" + ns.get_name(t) + " <= " + _printexpr(ns, t.reset)[0] + ";\n"
-                    r += _printnode(ns, _AT_NONBLOCKING, 1, stmts, t)
+                    r.append("\t" + ns.get_name(t) + " <= " + _printexpr(ns, t.reset)[0] + ";\n")
+                    at = _AT_NONBLOCKING
+                r.append(partial(_printnode, ns, at, 1, stmts, t, targets))
                 if dummy_signal:
-                    r += syn_off
-                    r += "\t" + ns.get_name(dummy_d) + " = " + ns.get_name(dummy_s) + ";\n"
-                    r += syn_on
-                r += "end\n"
-    r += "\n"
-    return r
-
+                    r.append(syn_off)
+                    r.append("\t" + ns.get_name(dummy_d) + " = " + ns.get_name(dummy_s) + ";\n")
+                    r.append(syn_on)
+                r.append("end\n")
+    r.append("\n")
+    return _join_blocks(r, jobs)
 
-def _printcomb_regular(f, ns, blocking_assign):
-    r = ""
-    if f.comb:
-        groups = group_by_targets(f.comb)
 
-        for n, g in enumerate(groups):
-            if len(g[1]) == 1 and isinstance(g[1][0], _Assign):
-                r += "assign " + _printnode(ns, _AT_BLOCKING, 0, g[1][0])
+def _printcomb_regular(f, ns, blocking_assign, comb_groups, jobs=1):
+    r = []
+    for n, g in enumerate(comb_groups):
+        if len(g[1]) == 1 and isinstance(g[1][0], _Assign):
+            r.append("assign ")
+            r.append(partial(_printnode, ns, _AT_BLOCKING, 0, g[1][0]))
+        else:
+            r.append("always @(*) begin\n")
+            if blocking_assign:
+                for t in g[0]:
+                    r.append("\t" + ns.get_name(t) + " = " + _printexpr(ns, t.reset)[0] + ";\n")
+                at = _AT_BLOCKING
             else:
-                r += "always @(*) begin\n"
-                if blocking_assign:
-                    for t in g[0]:
-                        r += "\t" + ns.get_name(t) + " = " + _printexpr(ns, t.reset)[0] + ";\n"
-                    r += _printnode(ns, _AT_BLOCKING, 1, g[1])
-                else:
-                    for t in g[0]:
-                        r += "\t" + ns.get_name(t) + " <= " + _printexpr(ns, t.reset)[0] + ";\n"
-                    r += _printnode(ns, _AT_NONBLOCKING, 1, g[1])
-                r += "end\n"
-    r += "\n"
-    return r
+                for t in g[0]:
+                    r.append("\t" + ns.get_name(t) + " <= " + _printexpr(ns, t.reset)[0] + ";\n")
+                at = _AT_NONBLOCKING
+            r.append(partial(_printnode, ns, at, 1, g[1]))
+            r.append("end\n")
+    r.append("\n")
+    return _join_blocks(r, jobs)
 
 
-def _printsync(f, ns):
-    r = ""
+def _printsync(f, ns, jobs=1):
+    r = []
     for k, v in sorted(f.sync.items(), key=itemgetter(0)):
-        r += "always @(posedge " + ns.get_name(f.clock_domains[k].clk) + ") begin\n"
-        r += _printnode(ns, _AT_SIGNAL, 1, v)
-        r += "end\n\n"
-    return r
+        r.append("always @(posedge " + ns.get_name(f.clock_domains[k].clk) + ") begin\n")
+        for statement in v:
+            r.append(partial(_printnode, ns, _AT_SIGNAL, 1, statement))
+        r.append("end\n\n")
+    return _join_blocks(r, jobs)
 
 
 def _printspecials(overrides, specials, ns, add_data_file, attr_translate):
-    r = ""
+    r = []
     for special in sorted(specials, key=lambda x: x.duid):
         if hasattr(special, "attr"):
             attr = _printattr(special.attr, attr_translate)
             if attr:
-                r += attr + " "
+                r.append(attr + " ")
         pr = call_special_classmethod(overrides, special, "emit_verilog", ns, add_data_file)
         if pr is None:
             raise NotImplementedError("Special " + str(special) + " failed to implement emit_verilog")
-        r += pr
+        r.append(pr)
+    return "".join(r)
+
+
+def _printinstances(instances, ns):
+    r = []
+    for definition, name, connections in instances:
+        r.append(definition + " " + name + "(\n")
+        r.append(",\n".join("\t." + port + "(" + ns.get_name(sig) + ")"
+                            for port, sig in connections))
+        r.append("\n);\n\n")
+    return "".join(r)
+
+
+class _Fingerprint:
+    # Structure of a lowered module, with signals numbered in order of
+    # appearance: modules with the same fingerprint print the same way,
+    # up to the names of their signals.
+    def __init__(self):
+        self.signals = dict()
+
+    def signal(self, s):
+        try:
+            return self.signals[s][0]
+        except KeyError:
+            n = len(self.signals)
+            self.signals[s] = (n, (s.nbits, s.signed, s.variable, self(s.reset),
+                                   tuple(sorted(repr(a) for a in s.attr))))
+            return n
+
+    def __call__(self, node):
+        if node is None:
+            return None
+        elif isinstance(node, Constant):
+            return ("c", node.nbits, node.signed, node.value)
+        elif isinstance(node, Signal):
+            return ("s", self.signal(node))
+        elif isinstance(node, _Operator):
+            return ("o", node.op) + tuple(self(o) for o in node.operands)
+        elif isinstance(node, _Slice):
+            return ("sl", node.start, node.stop, self(node.value))
+        elif isinstance(node, Cat):
+            return ("cat",) + tuple(self(v) for v in node.l)
+        elif isinstance(node, Replicate):
+            return ("rep", node.n, self(node.v))
+        elif isinstance(node, _Assign):
+            return ("=", self(node.l), self(node.r))
+        elif isinstance(node, collections.abc.Iterable):
+            return tuple(self(n) for n in node)
+        elif isinstance(node, If):
+            return ("if", self(node.cond), self(node.t), self(node.f))
+        elif isinstance(node, Case):
+            cases = sorted((k.value, self(v)) for k, v in node.cases.items()
+                           if isinstance(k, Constant))
+            return ("case", self(node.test), tuple(cases),
+                    self(node.cases.get("default", [])))
+        elif isinstance(node, Display):
+            return ("display", node.s) + tuple(self(a) if isinstance(a, Signal)
+                                               else str(a) for a in node.args)
+        elif isinstance(node, Finish):
+            return ("finish",)
+        else:
+            raise TypeError("Node of unrecognized type: "+str(type(node)))
+
+    def special(self, special):
+        expressions = tuple((attr, direction, self(getattr(obj, attr)))
+                            for obj, attr, direction in special.iter_expressions())
+        if isinstance(special, Instance):
+            items = []
+            for item in special.items:
+                if isinstance(item, Instance.Parameter):
+                    items.append(("p", item.name, self(item.value)
+                                  if isinstance(item.value, Constant) else repr(item.value)))
+                elif isinstance(item, Instance.PreformattedParam):
+                    items.append(("pp", str(item)))
+                else:
+                    items.append((type(item).__name__, item.name))
+            return ("instance", special.of, special.name_override, tuple(items),
+                    special.synthesis_directive,
+                    tuple(sorted(repr(a) for a in special.attr)), expressions)
+        elif isinstance(special, Memory):
+            ports = tuple((port.async_read, port.mode, port.we_granularity)
+                          for port in special.ports)
+            return ("memory", special.width, special.depth, tuple(special.init or ()),
+                    special.name_override, ports, expressions)
+        elif isinstance(special, (_MemoryPort, Tristate)):
+            return (type(special).__name__, expressions)
+        else:
+            # not known to print the same way
+            return ("special", id(special))
+
+    def module(self, f, specials, ports, children):
+        r = (tuple(self.signal(sig) for sig in ports),
+             self(f.comb),
+             tuple((k, self.signal(f.clock_domains[k].clk), self(v))
+                   for k, v in sorted(f.sync.items(), key=itemgetter(0))),
+             tuple(self.special(special) for special in
+                   sorted(specials, key=lambda x: x.duid)),
+             tuple((child.fingerprint, child.name, type(child.module).__name__,
+                    tuple(self.signal(sig) for sig in
+                          sorted(child.ports, key=lambda x: x.duid)))
+                   for child in children))
+        signals = tuple(sorted(self.signals.values()))
+        return hashlib.sha1(repr(r + (signals,)).encode()).hexdigest()
+
+
+class _HierarchyNode:
+    # a module of the hierarchy and the part of the final fragment that it
+    # does not share with its submodules
+    def __init__(self, module, name, children, fragment):
+        self.module = module
+        self.name = name
+        self.children = children
+        self.fragment = fragment
+
+
+def _build_hierarchy(f, top):
+    # Statements of a module are those of its fragment that are not in the
+    # fragments of its submodules. Submodules whose statements were rewritten
+    # by a module transformer of a parent (ResetInserter, CEInserter...) do not
+    # appear verbatim in f and stay flattened into that parent, as do
+    # submodules with signals also driven from outside of them.
+    domains = dict()
+    for k, v in f.sync.items():
+        for statement in v:
+            domains[id(statement)] = k
+    comb = {id(statement) for statement in f.comb}
+
+    # statements and specials driving each signal
+    drivers = collections.defaultdict(set)
+    for statement in f.comb + [s for v in f.sync.values() for s in v]:
+        for sig in list_targets(statement):
+            drivers[sig].add(id(statement))
+    for special in f.specials:
+        for sig in special.list_ios(False, True, True):
+            drivers[sig].add(id(special))
+
+    def separable(fragment):
+        statements = fragment.comb + [s for v in fragment.sync.values() for s in v]
+        if not (all(id(statement) in comb for statement in fragment.comb)
+                and all(id(statement) in domains
+                        for v in fragment.sync.values() for statement in v)
+                and fragment.specials <= f.specials):
+            return False
+        own = {id(statement) for statement in statements} \
+            | {id(special) for special in fragment.specials}
+        targets = list_targets(fragment) | list_special_ios(fragment, False, True, True)
+        return all(drivers[sig] <= own for sig in targets)
+
+    visited = set()
+    def walk(module, name, fragment):
+        visited.add(id(module))
+        children = []
+        for sub_name, submodule in module._submodules:
+            if id(submodule) not in visited and submodule.get_fragment_called \
+              and separable(submodule._fragment):
+                children.append(walk(submodule, sub_name, submodule._fragment))
+        shared = set()
+        specials = set()
+        for child in children:
+            child_fragment = child.module._fragment
+            shared |= {id(statement) for statement in child_fragment.comb}
+            shared |= {id(statement)
+                       for v in child_fragment.sync.values() for statement in v}
+            specials |= child_fragment.specials
+        own = _Fragment(clock_domains=f.clock_domains)
+        own.comb = [statement for statement in fragment.comb if id(statement) not in shared]
+        for k, v in sorted(fragment.sync.items(), key=itemgetter(0)):
+            for statement in v:
+                if id(statement) not in shared:
+                    own.sync.setdefault(domains.get(id(statement), k), []).append(statement)
+        own.specials = fragment.specials - specials
+        return _HierarchyNode(module, name, children, own)
+
+    return walk(top, None, f)
+
+
+def _convert_hierarchical(r, src, f, top, ios, name, special_overrides, attr_translate,
+                          display_run, reg_initialization, dummy_signal,
+                          blocking_assign, regular_comb, jobs):
+    nodes = []
+    def lower(node):
+        children = [lower(child) for child in node.children]
+        node.children = [child for child in children if child is not None]
+        g = node.fragment
+        if node is not root and not (g.comb or g.sync or g.specials or node.children):
+            return None
+        g = lower_complex_slices(g)
+        insert_resets(g)
+        g = lower_basics(g)
+        g, node.lowered_specials = lower_specials(special_overrides, g)
+        g = lower_basics(g)
+        node.fragment = g
+        node.signals = list_signals(g) | list_special_ios(g, True, True, True) \
+            | {g.clock_domains[k].clk for k in g.sync}
+        nodes.append(node)
+        return node
+    root = _build_hierarchy(f, top)
+    lower(root)
+
+    # ports of a module are the signals used both inside and outside of it
+    users = collections.Counter()
+    for node in nodes:
+        users.update(node.signals)
+    users.update(ios)
+    for node in nodes:
+        counts = collections.Counter(node.signals)
+        node.driven = list_targets(node.fragment) \
+            | list_special_ios(node.fragment, False, True, False)
+        node.inouts = list_special_ios(node.fragment, False, False, True)
+        for child in node.children:
+            counts.update(child.counts)
+            node.driven |= child.driven
+            node.inouts |= child.inouts
+        node.counts = counts
+        if node is root:
+            node.ports = ios
+        else:
+            node.ports = {sig for sig, n in counts.items() if n < users[sig]}
+
+    for io in sorted(ios, key=lambda x: x.duid):
+        if io.name_override is None:
+            io_name = io.backtrace[-1][0]
+            if io_name:
+                io.name_override = io_name
+
+    # modules are printed from the leaves. Structurally identical modules
+    # reuse the definition of the first one, without naming or printing them.
+    fingerprints = dict()
+    definitions = dict()
+    definition_names = {name}
+    src.append(generated_banner("//"))
+    for node in nodes:
+        g = node.fragment
+        ports = sorted(node.ports, key=lambda x: x.duid)
+        connected = set()
+        outs = set()
+        inouts = set()
+        for child in node.children:
+            connected |= child.ports
+            outs |= child.ports & child.driven
+            inouts |= child.ports & child.inouts
+
+        if node is not root:
+            node.fingerprint = _Fingerprint().module(g, g.specials - node.lowered_specials,
+                                                     ports, node.children)
+            try:
+                representative = fingerprints[node.fingerprint]
+            except KeyError:
+                fingerprints[node.fingerprint] = node
+                node.instances = 1
+            else:
+                representative.instances += 1
+                node.definition = representative.definition
+                node.port_names = representative.port_names
+                continue
+
+        ns = build_namespace(node.signals | connected | node.ports, _reserved_keywords)
+        ns.clock_domains = g.clock_domains
+        node.port_names = [ns.get_name(sig) for sig in ports]
+
+        instances = []
+        instance_names = {ns.get_name(sig) for sig in node.signals | connected | node.ports}
+        for n, child in enumerate(node.children):
+            instance_name = child.name
+            if instance_name is None:
+                instance_name = type(child.module).__name__.lower() + str(n)
+            while instance_name in instance_names or instance_name in _reserved_keywords:
+                instance_name += "_i"
+            instance_names.add(instance_name)
+            connections = list(zip(child.port_names,
+                                   sorted(child.ports, key=lambda x: x.duid)))
+            instances.append((child.definition, instance_name, connections))
+
+        targets = _TargetSets()
+        comb_groups = _group_by_targets(g.comb, targets)
+        if node is root:
+            module_name = name
+        else:
+            module_name = "{module_name}"
+        body = [_printheader(g, node.ports, module_name, ns, attr_translate,
+                             reg_initialization=reg_initialization,
+                             comb_groups=comb_groups,
+                             submodule_ios=(connected, outs, inouts))]
+        if regular_comb:
+            body.append(_printcomb_regular(g, ns,
+                            blocking_assign=blocking_assign,
+                            comb_groups=comb_groups,
+                            jobs=jobs))
+        else:
+            body.append(_printcomb_simulation(g, ns,
+                            display_run=display_run,
+                            dummy_signal=dummy_signal,
+                            blocking_assign=blocking_assign,
+                            targets=targets,
+                            jobs=jobs))
+        body.append(_printsync(g, ns, jobs))
+        body.append(_printspecials(special_overrides, g.specials - node.lowered_specials,
+            ns, r.add_data_file, attr_translate))
+        body.append(_printinstances(instances, ns))
+        body.append("endmodule\n")
+        body = "".join(body)
+
+        if node is root:
+            src.append(body)
+            r.ns = ns
+        else:
+            try:
+                representative = definitions[body]
+            except KeyError:
+                definition = type(node.module).__name__
+                n = 0
+                while definition in definition_names or definition in _reserved_keywords:
+                    n += 1
+                    definition = type(node.module).__name__ + "_" + str(n)
+                definition_names.add(definition)
+                node.definition = definition
+                node.size = len(body)
+                definitions[body] = node
+                src.append(body.replace("module {module_name}(", "module " + definition + "(", 1))
+                src.append("\n")
+            else:
+                # different structures printed the same way
+                representative.instances += 1
+                node.definition = representative.definition
+                fingerprints[node.fingerprint] = representative
+    r.modules = len(nodes)
+    r.definitions = len(definitions) + 1
+    # (definition, instances, size of the definition) of the modules
+    # instantiated more than once
+    r.duplicates = sorted(((node.definition, node.instances, node.size)
+                           for node in definitions.values() if node.instances > 1),
+                          key=lambda x: (-(x[1] - 1)*x[2], x[0]))
+
+
+def split_modules(source):
+    # (name, text) of the module definitions of a converted source
+    r = []
+    for text in source.split("\nmodule ")[1:]:
+        text = "module " + text[:text.index("\nendmodule\n") + len("\nendmodule\n")]
+        r.append((text[len("module "):text.index("(")], text))
     return r
 
 
+class StreamingConvOutput(ConvOutput):
+    # Conversion output written while it is generated: sections of the main
+    # source are appended to main_file (a file name or a file object) and
+    # data files are written next to it when added, without keeping them.
+    def __init__(self, main_file):
+        self.owned = isinstance(main_file, str)
+        if self.owned:
+            self.main_filename = main_file
+            self.file = open(main_file, "w")
+        else:
+            self.main_filename = getattr(main_file, "name", None)
+            self.file = main_file
+        self.directory = os.path.dirname(self.main_filename or "")
+        self.data_files = dict()
+
+    @property
+    def main_source(self):
+        self.file.flush()
+        with open(self.main_filename) as f:
+            return f.read()
+
+    def append(self, text):
+        self.file.write(text)
+
+    def add_data_file(self, filename_base, content):
+        # the file names are kept, not their content
+        filename = ConvOutput.add_data_file(self, filename_base, None)
+        path = os.path.join(self.directory, filename)
+        with open(path, "w") as f:
+            f.write(content)
+        self.data_files[filename] = path
+        return filename
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def write(self, main_filename):
+        # already written, copied when asked for elsewhere
+        if os.path.abspath(main_filename) != os.path.abspath(self.main_filename):
+            shutil.copyfile(self.main_filename, main_filename)
+        for filename, path in self.data_files.items():
+            if os.path.abspath(filename) != os.path.abspath(path):
+                shutil.copyfile(path, filename)
+
+
 class DummyAttrTranslate:
     def __getitem__(self, k):
         return (k, "true")
@@ -366,10 +873,25 @@ def convert(f, ios=None, name="top",
   reg_initialization=True,
   dummy_signal=True,
   blocking_assign=False,
-  regular_comb=True):
-    r = ConvOutput()
+  regular_comb=True,
+  hierarchy=None,
+  jobs=1,
+  output=None):
+    if output is None:
+        r = ConvOutput()
+        src = []
+    else:
+        # sections are written to output as they are printed
+        r = StreamingConvOutput(output)
+        src = r
+    if jobs is None:
+        jobs = os.cpu_count() or 1
     if not isinstance(f, _Fragment):
+        if hierarchy is True:
+            hierarchy = f
         f = f.get_fragment()
+    elif hierarchy is True:
+        raise TypeError("Hierarchical conversion needs the top Module, not its fragment")
     if ios is None:
         ios = set()
 
@@ -387,6 +909,17 @@ def convert(f, ios=None, name="top",
                     print(f.name)
                 raise KeyError("Unresolved clock domain: '"+cd_name+"'")
 
+    if hierarchy is not None:
+        # one Verilog module per submodule, instantiated from its parent
+        _convert_hierarchical(r, src, f, hierarchy, ios, name, special_overrides,
+                              attr_translate, display_run, reg_initialization,
+                              dummy_signal, blocking_assign, regular_comb, jobs)
+        if output is None:
+            r.set_main_source("".join(src))
+        else:
+            r.close()
+        return r
+
     f = lower_complex_slices(f)
     insert_resets(f)
     f = lower_basics(f)
@@ -404,21 +937,32 @@ def convert(f, ios=None, name="top",
     ns.clock_domains = f.clock_domains
     r.ns = ns
 
-    src = generated_banner("//")
-    src += _printheader(f, ios, name, ns, attr_translate,
-                        reg_initialization=reg_initialization)
+    targets = _TargetSets()
+    comb_groups = _group_by_targets(f.comb, targets)
+
+    src.append(generated_banner("//"))
+    src.append(_printheader(f, ios, name, ns, attr_translate,
+                            reg_initialization=reg_initialization,
+                            comb_groups=comb_groups))
     if regular_comb:
-        src += _printcomb_regular(f, ns,
-                      blocking_assign=blocking_assign)
+        src.append(_printcomb_regular(f, ns,
+                       blocking_assign=blocking_assign,
+                       comb_groups=comb_groups,
+                       jobs=jobs))
+    else:
+        src.append(_printcomb_simulation(f, ns,
+                       display_run=display_run,
+                       dummy_signal=dummy_signal,
+                       blocking_assign=blocking_assign,
+                       targets=targets,
+                       jobs=jobs))
+    src.append(_printsync(f, ns, jobs))
+    src.append(_printspecials(special_overrides, f.specials - lowered_specials,
+        ns, r.add_data_file, attr_translate))
+    src.append("endmodule\n")
+    if output is None:
+        r.set_main_source("".join(src))
     else:
-        src += _printcomb_simulation(f, ns,
-                      display_run=display_run,
-                      dummy_signal=dummy_signal,
-                      blocking_assign=blocking_assign)
-    src += _printsync(f, ns)
-    src += _printspecials(special_overrides, f.specials - lowered_specials,
-        ns, r.add_data_file, attr_translate)
-    src += "endmodule\n"
-    r.set_main_source(src)
+        r.close()
 
     return r
@@ -1 +1,2 @@
-from litex.gen.sim.core import Simulator, run_simulation, passive
+from litex.gen.sim.core import (Simulator, run_simulation, run_simulations_parallel,
+                                passive, Delay, Wait, WaitUntil)
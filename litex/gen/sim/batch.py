@@ -0,0 +1,551 @@
+import collections.abc
+from functools import partial
+
+import numpy as np
+
+from migen.fhdl.structure import *
+from migen.fhdl.structure import _Operator, _Slice, _ArrayProxy, _Assign
+from migen.fhdl.bitcontainer import value_bits_sign
+
+from litex.gen.sim.core import (Evaluator, Simulator, _SlotValues, _truncate,
+                                _generators_by_domain)
+from litex.gen.sim.compiler import (_Function, _binops, _truncate as _truncate_expr,
+                                    _max_expr_depth, _max_stmt_depth)
+
+
+# Values that may not fit are computed and stored in object arrays of Python
+# integers, the rest in int64 arrays.
+_max_int_bits = 62
+
+_comparisons = {"<", "<=", "==", "!=", ">", ">="}
+
+
+def _fits_int(node):
+    return value_bits_sign(node)[0] <= _max_int_bits
+
+
+class _LaneValues(collections.abc.Mapping):
+    def __init__(self, evaluator, lane):
+        self.evaluator = evaluator
+        self.lane = lane
+
+    def __getitem__(self, signal):
+        return int(self.evaluator.values[self.evaluator.slots[signal]][self.lane])
+
+    def __iter__(self):
+        return iter(self.evaluator.slots)
+
+    def __len__(self):
+        return len(self.evaluator.slots)
+
+
+# Scalar view of one lane, used by generators and for statements the batch
+# compiler does not handle.
+class _LaneEvaluator(Evaluator):
+    def __init__(self, evaluator, lane):
+        Evaluator.__init__(self, evaluator.clock_domains, evaluator.replaced_memories)
+        self.evaluator = evaluator
+        self.lane = lane
+        self.signal_values = _LaneValues(evaluator, lane)
+
+    def commit(self):
+        raise TypeError("Lanes are committed by their batch evaluator")
+
+    def eval(self, node, postcommit=False):
+        if isinstance(node, Signal):
+            slot = self.evaluator.slot(node)
+            if postcommit:
+                return int(self.evaluator.next_values[slot][self.lane])
+            else:
+                return int(self.evaluator.values[slot][self.lane])
+        return Evaluator.eval(self, node, postcommit)
+
+    def assign(self, node, value, postcommit=False):
+        if isinstance(node, Signal):
+            assert not node.variable
+            self.evaluator.assign_lane(self.evaluator.slot(node), self.lane,
+                                       _truncate(value, node.nbits, node.signed))
+        else:
+            Evaluator.assign(self, node, value, postcommit)
+
+
+class _BatchFunctions:
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.shape = (evaluator.lanes,)
+
+    def store(self, value, dtype):
+        if isinstance(value, np.ndarray) and value.shape == self.shape:
+            return value.astype(dtype, copy=False)
+        return np.full(self.shape, value, dtype)
+
+    def where(self, mask, value, default, dtype):
+        return np.where(mask, value, default).astype(dtype, copy=False)
+
+    def nonzero(self, value):
+        return np.broadcast_to(np.asarray(value) != 0, self.shape)
+
+    def mux(self, sel, a, b):
+        return np.where(np.asarray(sel) != 0, a, b)
+
+    def lanes(self, mask):
+        if mask is None:
+            return range(self.evaluator.lanes)
+        return np.flatnonzero(mask)
+
+    def keys(self, key, n):
+        key = np.broadcast_to(np.minimum(key, n - 1), self.shape)
+        return key, np.unique(key)
+
+    def gather(self, values, slots, key):
+        key, present = self.keys(key, len(slots))
+        if len(present) == 1:
+            return values[slots[present[0]]]
+        arrays = [values[slots[k]] for k in present]
+        r = np.empty(self.shape, dtype=np.result_type(*arrays))
+        for k, array in zip(present, arrays):
+            m = key == k
+            r[m] = array[m]
+        return r
+
+    def take(self, choices, key):
+        return choices[np.minimum(key, len(choices) - 1)]
+
+    def select(self, functions, key):
+        key, present = self.keys(key, len(functions))
+        if len(present) == 1:
+            return functions[present[0]]()
+        arrays = [np.broadcast_to(functions[k](), self.shape) for k in present]
+        r = np.empty(self.shape, dtype=np.result_type(*arrays))
+        for k, array in zip(present, arrays):
+            m = key == k
+            r[m] = array[m]
+        return r
+
+    def scatter(self, functions, key, value, mask):
+        key, present = self.keys(key, len(functions))
+        for k in present:
+            m = key == k
+            if mask is not None:
+                m &= mask
+            if m.any():
+                functions[k](value, m)
+
+    def case(self, test, table, default, mask):
+        test = np.broadcast_to(test, self.shape)
+        handled = np.zeros(self.shape, dtype=bool)
+        for value in np.unique(test):
+            try:
+                function = table[int(value)]
+            except KeyError:
+                continue
+            m = test == value
+            if mask is not None:
+                m &= mask
+            if m.any():
+                function(m)
+            handled |= m
+        if default is not None:
+            m = ~handled
+            if mask is not None:
+                m &= mask
+            if m.any():
+                default(m)
+
+    def lane_eval(self, node, postcommit):
+        return np.array([evaluator.eval(node, postcommit)
+            for evaluator in self.evaluator.lane_evaluators], dtype=object)
+
+    def lane_assign(self, node, postcommit, value, mask):
+        value = np.broadcast_to(value, self.shape)
+        for lane in self.lanes(mask):
+            self.evaluator.lane_evaluators[lane].assign(node, int(value[lane]), postcommit)
+
+    def lane_execute(self, statements, postcommit, mask):
+        for lane in self.lanes(mask):
+            self.evaluator.lane_evaluators[lane].execute(statements, postcommit)
+
+
+# Lowers statements to Python functions evaluating all lanes at once with
+# NumPy operations. Conditional statements become masks: a branch is
+# executed for the lanes taking it, and skipped when no lane does.
+class BatchStatementCompiler:
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.functions = _BatchFunctions(evaluator)
+        f = self.functions
+        self.namespace = {
+            "V":   evaluator.values,
+            "N":   evaluator.next_values,
+            "_d":  evaluator.dirty.add,
+            "_I":  lambda x: np.asarray(x).astype(np.int64),
+            "_O":  lambda x: np.asarray(x, dtype=object),
+            "_sum": sum,
+        }
+        for name in ("store", "where", "nonzero", "mux", "gather", "take",
+                     "select", "scatter", "case",
+                     "lane_eval", "lane_assign", "lane_execute"):
+            self.namespace["_" + name] = getattr(f, name)
+        self.counter = 0
+        self.postcommit = False
+
+    def _name(self, prefix):
+        self.counter += 1
+        return prefix + str(self.counter)
+
+    def _new_function(self, args=""):
+        fn = _Function(self._name("_f"), args)
+        self.functions_source.append(fn)
+        return fn
+
+    def _constant(self, value):
+        name = self._name("_c")
+        self.namespace[name] = value
+        return name
+
+    def _table(self, source):
+        name = self._name("_c")
+        self.tables.append(name + " = " + source)
+        return name
+
+    # expressions, returned with a flag telling if they are object arrays
+
+    def expr(self, node, postcommit=None, depth=0):
+        code, wide = self._expr(node, postcommit, depth)
+        if wide and _fits_int(node):
+            return "_I(" + code + ")", False
+        return code, wide
+
+    def _operands(self, operands, wide):
+        if wide:
+            return [code if w else "_O(" + code + ")" for code, w in operands]
+        return [code for code, w in operands]
+
+    def _expr(self, node, postcommit, depth):
+        if postcommit is None:
+            postcommit = self.postcommit
+        if depth > _max_expr_depth:
+            fn = self._new_function()
+            code, wide = self.expr(node, postcommit)
+            fn.emit(1, "return " + code)
+            return fn.name + "()", wide
+        depth += 1
+
+        if isinstance(node, Constant):
+            return "(" + str(node.value) + ")", not _fits_int(node)
+        elif isinstance(node, Signal):
+            slot = self.evaluator.slot(node)
+            return ("N[{}]" if postcommit else "V[{}]").format(slot), self.evaluator.is_object(slot)
+        elif isinstance(node, _Operator):
+            operands = [self.expr(o, postcommit, depth) for o in node.operands]
+            wide = any(w for c, w in operands) or not _fits_int(node)
+            codes = self._operands(operands, wide)
+            if node.op == "m":
+                return "_mux({}, {}, {})".format(*codes), wide
+            elif len(codes) == 1 and node.op in ("-", "~"):
+                return "(" + node.op + codes[0] + ")", wide
+            elif len(codes) == 2 and node.op in _comparisons:
+                return "_I({} {} {})".format(codes[0], _binops[node.op], codes[1]), False
+            elif len(codes) == 2 and node.op in _binops:
+                return "({} {} {})".format(codes[0], _binops[node.op], codes[1]), wide
+        elif isinstance(node, _Slice):
+            v, wide = self.expr(node.value, postcommit, depth)
+            mask = 2**(node.stop - node.start) - 1
+            return "(({} >> {}) & {})".format(v, node.start, mask), wide
+        elif isinstance(node, Cat):
+            wide = not _fits_int(node)
+            parts = []
+            shift = 0
+            for element in node.l:
+                nbits = len(element)
+                code, w = self.expr(element, postcommit, depth)
+                if wide and not w:
+                    code = "_O(" + code + ")"
+                parts.append("(({} & {}) << {})".format(code, 2**nbits - 1, shift))
+                shift += nbits
+            if not parts:
+                return "0", False
+            return "_sum((" + ", ".join(parts) + "))", wide
+        elif isinstance(node, Replicate):
+            wide = not _fits_int(node)
+            nbits = len(node.v)
+            factor = sum(1 << i*nbits for i in range(node.n))
+            code, w = self.expr(node.v, postcommit, depth)
+            if wide and not w:
+                code = "_O(" + code + ")"
+            return "(({} & {}) * {})".format(code, 2**nbits - 1, factor), wide
+        elif isinstance(node, _ArrayProxy):
+            key, w = self.expr(node.key, postcommit, depth)
+            if w:
+                key = "_I(" + key + ")"
+            if all(isinstance(c, Signal) for c in node.choices):
+                slots = tuple(self.evaluator.slot(c) for c in node.choices)
+                return "_gather({}, {}, {})".format("N" if postcommit else "V",
+                    self._constant(slots), key), any(self.evaluator.is_object(s) for s in slots)
+            elif all(isinstance(c, Constant) for c in node.choices):
+                wide = not all(_fits_int(c) for c in node.choices)
+                choices = np.array([c.value for c in node.choices],
+                                   dtype=object if wide else np.int64)
+                return "_take({}, {})".format(self._constant(choices), key), wide
+            else:
+                wide = False
+                choices = []
+                for choice in node.choices:
+                    fn = self._new_function()
+                    code, w = self.expr(choice, postcommit)
+                    fn.emit(1, "return " + code)
+                    choices.append(fn.name)
+                    wide = wide or w
+                table = self._table("(" + ", ".join(choices) + ",)")
+                return "_select({}, {})".format(table, key), wide
+        elif isinstance(node, ClockSignal):
+            if node.cd in self.evaluator.clock_domains:
+                cd = self.evaluator.clock_domains[node.cd]
+                return self.expr(cd.clk, postcommit, depth)
+        elif isinstance(node, ResetSignal):
+            if node.cd in self.evaluator.clock_domains:
+                rst = self.evaluator.clock_domains[node.cd].rst
+                if rst is not None:
+                    return self.expr(rst, postcommit, depth)
+                elif node.allow_reset_less:
+                    return "0", False
+
+        # evaluate lane by lane with the interpreter
+        return "_lane_eval({}, {})".format(self._constant(node), postcommit), True
+
+    # statements
+
+    def assign(self, fn, level, node, value, mask):
+        code, wide = value
+        if isinstance(node, Signal):
+            assert not node.variable
+            slot = self.evaluator.slot(node)
+            target_wide = self.evaluator.is_object(slot)
+            if target_wide and not wide:
+                code = "_O(" + code + ")"
+            code = _truncate_expr(code, node.nbits, node.signed)
+            if wide and not target_wide:
+                code = "_I(" + code + ")"
+            dtype = self._constant(self.evaluator.dtypes[slot])
+            if mask is None:
+                fn.emit(level, "N[{}] = _store({}, {})".format(slot, code, dtype))
+            else:
+                fn.emit(level, "N[{}] = _where({}, {}, N[{}], {})".format(slot, mask, code, slot, dtype))
+            fn.emit(level, "_d({})".format(slot))
+        elif isinstance(node, Cat):
+            t = fn.temp()
+            fn.emit(level, t + " = " + code)
+            for i, element in enumerate(node.l):
+                nbits = len(element)
+                self.assign(fn, level, element, ("({} & {})".format(t, 2**nbits - 1), wide), mask)
+                if i != len(node.l) - 1:
+                    fn.emit(level, "{} = {} >> {}".format(t, t, nbits))
+        elif isinstance(node, _Slice):
+            t = fn.temp()
+            full_value, full_wide = self.expr(node.value, True)
+            wide = wide or full_wide or not _fits_int(node.value)
+            if wide:
+                full_value, code = self._operands([(full_value, full_wide), value], True)
+            clear = ~((2**node.stop - 1) - (2**node.start - 1))
+            mask_bits = 2**(node.stop - node.start) - 1
+            fn.emit(level, "{} = ({} & ({})) | (({} & {}) << {})".format(
+                t, full_value, clear, code, mask_bits, node.start))
+            self.assign(fn, level, node.value, (t, wide), mask)
+        elif isinstance(node, _ArrayProxy):
+            choices = []
+            for choice in node.choices:
+                afn = self._new_function("value, m, ")
+                self.assign(afn, 1, choice, ("value", wide), "m")
+                choices.append(afn.name)
+            table = self._table("(" + ", ".join(choices) + ",)")
+            key, w = self.expr(node.key)
+            if w:
+                key = "_I(" + key + ")"
+            fn.emit(level, "_scatter({}, {}, {}, {})".format(table, key, code, mask))
+        else:
+            fn.emit(level, "_lane_assign({}, {}, {}, {})".format(
+                self._constant(node), self.postcommit, code, mask))
+
+    def block(self, fn, level, statements, mask):
+        n = len(fn.lines)
+        self.statements(fn, level, statements, mask)
+        if len(fn.lines) == n:
+            fn.emit(level, "pass")
+
+    def _branch(self, fn, level, statements, mask):
+        fn.emit(level, "if {}.any():".format(mask))
+        self.block(fn, level + 1, statements, mask)
+
+    def statements(self, fn, level, statements, mask):
+        if level > _max_stmt_depth:
+            sfn = self._new_function("m, ")
+            self.statements(sfn, 1, statements, "m")
+            fn.emit(level, "{}({})".format(sfn.name, mask))
+            return
+        for s in statements:
+            if isinstance(s, _Assign):
+                self.assign(fn, level, s.l, self.expr(s.r), mask)
+            elif isinstance(s, If):
+                cond = fn.temp()
+                code, wide = self.expr(s.cond)
+                fn.emit(level, "{} = _nonzero({} & {})".format(cond, code, 2**len(s.cond) - 1))
+                mask_t = fn.temp()
+                if mask is None:
+                    fn.emit(level, "{} = {}".format(mask_t, cond))
+                else:
+                    fn.emit(level, "{} = {} & {}".format(mask_t, cond, mask))
+                self._branch(fn, level, s.t, mask_t)
+                if s.f:
+                    mask_f = fn.temp()
+                    if mask is None:
+                        fn.emit(level, "{} = ~{}".format(mask_f, cond))
+                    else:
+                        fn.emit(level, "{} = ~{} & {}".format(mask_f, cond, mask))
+                    self._branch(fn, level, s.f, mask_f)
+            elif isinstance(s, Case):
+                nbits, signed = value_bits_sign(s.test)
+                code, wide = self.expr(s.test)
+                test = _truncate_expr(code, nbits, signed)
+                entries = []
+                for k, v in s.cases.items():
+                    if isinstance(k, Constant) and not any(e[0] == k.value for e in entries):
+                        cfn = self._new_function("m, ")
+                        self.statements(cfn, 1, v, "m")
+                        entries.append((k.value, cfn.name))
+                table = self._table("{" + ", ".join("{}: {}".format(*e) for e in entries) + "}")
+                if "default" in s.cases:
+                    dfn = self._new_function("m, ")
+                    self.statements(dfn, 1, s.cases["default"], "m")
+                    default = dfn.name
+                else:
+                    default = "None"
+                fn.emit(level, "_case({}, {}, {}, {})".format(test, table, default, mask))
+            elif isinstance(s, collections.abc.Iterable):
+                self.statements(fn, level, s, mask)
+            else:
+                fn.emit(level, "_lane_execute({}, {}, {})".format(
+                    self._constant([s]), self.postcommit, mask))
+
+    def compile(self, statements, postcommit=False):
+        self.postcommit = postcommit
+        self.functions_source = []
+        self.tables = []
+        fn = self._new_function()
+        self.statements(fn, 1, statements, None)
+        source = "".join(f.get_source() for f in self.functions_source)
+        source += "\n".join(self.tables) + "\n"
+        try:
+            exec(compile(source, "<litex.gen.sim.batch>", "exec"), self.namespace)
+        except (SyntaxError, RecursionError, MemoryError):
+            return partial(self.functions.lane_execute, statements, postcommit, None)
+        return self.namespace[fn.name]
+
+
+class BatchEvaluator:
+    def __init__(self, clock_domains, replaced_memories, lanes):
+        self.clock_domains = clock_domains
+        self.replaced_memories = replaced_memories
+        self.lanes = lanes
+        self.slots = dict()
+        self.slot_signals = []
+        self.dtypes = []
+        self.values = []
+        self.next_values = []
+        self.dirty = set()
+        self.signal_values = _SlotValues(self)
+        self.lane_evaluators = [_LaneEvaluator(self, lane) for lane in range(lanes)]
+        self.compiler = BatchStatementCompiler(self)
+
+    def slot(self, signal):
+        try:
+            return self.slots[signal]
+        except KeyError:
+            slot = len(self.slot_signals)
+            self.slots[signal] = slot
+            self.slot_signals.append(signal)
+            dtype = np.int64 if _fits_int(signal) else object
+            self.dtypes.append(dtype)
+            values = np.full(self.lanes, signal.reset.value, dtype)
+            self.values.append(values)
+            self.next_values.append(values)
+            return slot
+
+    def is_object(self, slot):
+        return self.dtypes[slot] is object
+
+    def commit(self):
+        r = set()
+        values = self.values
+        next_values = self.next_values
+        for slot in self.dirty:
+            new = next_values[slot]
+            old = values[slot]
+            if new is old:
+                continue
+            if np.array_equal(new, old):
+                next_values[slot] = old
+            else:
+                values[slot] = new
+                r.add(self.slot_signals[slot])
+        self.dirty.clear()
+        return r
+
+    def assign_lane(self, slot, lane, value):
+        values = self.next_values[slot]
+        # committed arrays are shared with next_values, never modify them
+        if values is self.values[slot]:
+            values = values.copy()
+            self.next_values[slot] = values
+        values[lane] = value
+        self.dirty.add(slot)
+
+    def assign(self, node, value, postcommit=False):
+        if isinstance(node, Signal):
+            assert not node.variable
+            slot = self.slot(node)
+            self.next_values[slot] = np.full(self.lanes,
+                _truncate(value, node.nbits, node.signed), self.dtypes[slot])
+            self.dirty.add(slot)
+        else:
+            for evaluator in self.lane_evaluators:
+                evaluator.assign(node, value, postcommit)
+
+    def execute(self, statements, postcommit=False):
+        for evaluator in self.lane_evaluators:
+            evaluator.execute(statements, postcommit)
+
+    def compile(self, statements, postcommit=False):
+        return self.compiler.compile(statements, postcommit)
+
+
+# Simulates independent sets of generators (lanes, each in any form accepted
+# by Simulator) in lockstep on a design elaborated and compiled once. Each
+# signal holds one value per lane, generators see their lane as a regular
+# simulation.
+class BatchSimulator(Simulator):
+    def __init__(self, fragment_or_module, lanes, clocks={"sys": 10},
+                 special_overrides={}, propagation="event"):
+        self.lanes = [_generators_by_domain(generators) for generators in lanes]
+        # memories are arrays of signals, which hold one value per lane
+        Simulator.__init__(self, fragment_or_module, {}, clocks,
+                           special_overrides=special_overrides,
+                           propagation=propagation, native_memories=False)
+
+    def _create_evaluator(self, compiled, replaced_memories):
+        return BatchEvaluator(self.fragment.clock_domains, replaced_memories,
+                              len(self.lanes))
+
+    def _process_generators(self, cd):
+        for lane, generators in enumerate(self.lanes):
+            if cd in generators:
+                self._run_generators(self.evaluator.lane_evaluators[lane],
+                                     generators[cd])
+
+    def _generator_lists(self):
+        return [(cd, cd_generators) for generators in self.lanes
+                for cd, cd_generators in generators.items()]
+
+
+def run_batch_simulation(*args, **kwargs):
+    with BatchSimulator(*args, **kwargs) as s:
+        s.run()
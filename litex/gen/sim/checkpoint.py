@@ -0,0 +1,42 @@
+import zlib
+
+from litex.gen.sim.lxw import _write_varint, _read_varint, _read_varints
+
+
+# Simulator checkpoint files
+#
+#   magic    b"LXCKPT1\n"
+#   zlib compressed unsigned LEB128 integers:
+#     nsections, (length, integer*length)*nsections
+#
+# The meaning of the sections is defined by Simulator.save_checkpoint.
+
+_magic = b"LXCKPT1\n"
+
+
+def write_checkpoint(filename, sections):
+    data = bytearray()
+    _write_varint(data, len(sections))
+    for section in sections:
+        _write_varint(data, len(section))
+        for n in section:
+            _write_varint(data, n)
+    with open(filename, "wb") as f:
+        f.write(_magic)
+        f.write(zlib.compress(bytes(data)))
+
+
+def read_checkpoint(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(_magic)) != _magic:
+            raise ValueError("{} is not a simulator checkpoint".format(filename))
+        data = zlib.decompress(f.read())
+    nsections, i = _read_varint(data, 0)
+    integers = _read_varints(data[i:])
+    sections = []
+    i = 0
+    for n in range(nsections):
+        length = integers[i]
+        sections.append(integers[i + 1:i + 1 + length])
+        i += 1 + length
+    return sections
@@ -0,0 +1,366 @@
+import collections.abc
+from functools import partial
+
+from migen.fhdl.structure import *
+from migen.fhdl.structure import _Operator, _Slice, _ArrayProxy, _Assign
+from migen.fhdl.specials import _MemoryLocation
+from migen.fhdl.bitcontainer import value_bits_sign
+
+from litex.gen.sim.memory import _MemoryWrite
+
+
+_binops = {
+    "+": "+",
+    "-": "-",
+    "*": "*",
+
+    ">>>": ">>",
+    "<<<": "<<",
+
+    "&": "&",
+    "^": "^",
+    "|": "|",
+
+    "<": "<",
+    "<=": "<=",
+    "==": "==",
+    "!=": "!=",
+    ">": ">",
+    ">=": ">=",
+}
+
+# CPython rejects deeply nested sources: deeper expressions and statement
+# blocks are moved to helper functions.
+_max_expr_depth = 48
+_max_stmt_depth = 32
+# Case statements with more choices are dispatched through a dict.
+_case_dispatch_threshold = 8
+# Cat with more elements are summed from a tuple instead of or-ed.
+_cat_sum_threshold = 8
+
+
+def _truncate(value, nbits, signed):
+    if nbits == 0:
+        return "0"
+    mask = 2**nbits - 1
+    if signed:
+        sign = 2**(nbits - 1)
+        return "((({} & {}) ^ {}) - {})".format(value, mask, sign, sign)
+    else:
+        return "({} & {})".format(value, mask)
+
+
+class _Function:
+    def __init__(self, name, args=""):
+        self.name = name
+        self.args = args
+        self.lines = []
+        self.ntemps = 0
+
+    def temp(self):
+        self.ntemps += 1
+        return "_t" + str(self.ntemps)
+
+    def emit(self, level, line):
+        self.lines.append("    "*level + line)
+
+    def get_source(self):
+        r = "def " + self.name + "(" + self.args + "V=V, N=N, _d=_d):\n"
+        if self.lines:
+            r += "\n".join(self.lines) + "\n"
+        else:
+            r += "    pass\n"
+        return r
+
+
+# Lowers statements to Python functions working on the slots of a
+# CompiledEvaluator: generated code reads committed values from V, writes
+# pending values to N and marks the written slots with _d. Nodes that cannot
+# be compiled are delegated to the interpreter.
+class StatementCompiler:
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.namespace = {
+            "V":    evaluator.values,
+            "N":    evaluator.next_values,
+            "_d":   evaluator.dirty.add,
+            "_min": min,
+            "_sum": sum,
+            "_nop": lambda: None,
+        }
+        self.counter = 0
+        self.functions = []
+        self.tables = []
+        self.postcommit = False
+
+    def _name(self, prefix):
+        self.counter += 1
+        return prefix + str(self.counter)
+
+    def _new_function(self, args=""):
+        fn = _Function(self._name("_f"), args)
+        self.functions.append(fn)
+        return fn
+
+    def _constant(self, value):
+        name = self._name("_c")
+        self.namespace[name] = value
+        return name
+
+    def _table(self, source):
+        # tables of generated functions are built once all functions are defined
+        name = self._name("_c")
+        self.tables.append(name + " = " + source)
+        return name
+
+    # expressions
+
+    def expr(self, node, postcommit=None, depth=0):
+        if postcommit is None:
+            postcommit = self.postcommit
+        if depth > _max_expr_depth:
+            fn = self._new_function()
+            fn.emit(1, "return " + self.expr(node, postcommit))
+            return fn.name + "()"
+        depth += 1
+
+        if isinstance(node, Constant):
+            return "(" + str(node.value) + ")"
+        elif isinstance(node, Signal):
+            if postcommit:
+                return "N[" + str(self.evaluator.slot(node)) + "]"
+            else:
+                return "V[" + str(self.evaluator.slot(node)) + "]"
+        elif isinstance(node, _Operator):
+            operands = [self.expr(o, postcommit, depth) for o in node.operands]
+            if node.op == "m":
+                return "({} if {} else {})".format(operands[1], operands[0], operands[2])
+            elif len(operands) == 1 and node.op in ("-", "~"):
+                return "(" + node.op + operands[0] + ")"
+            elif len(operands) == 2 and node.op in _binops:
+                return "({} {} {})".format(operands[0], _binops[node.op], operands[1])
+        elif isinstance(node, _Slice):
+            v = self.expr(node.value, postcommit, depth)
+            mask = 2**(node.stop - node.start) - 1
+            if node.start:
+                return "(({} >> {}) & {})".format(v, node.start, mask)
+            else:
+                return "({} & {})".format(v, mask)
+        elif isinstance(node, Cat):
+            parts = []
+            shift = 0
+            for element in node.l:
+                nbits = len(element)
+                # make value always positive
+                part = "({} & {})".format(self.expr(element, postcommit, depth), 2**nbits - 1)
+                if shift:
+                    part = "(" + part + " << " + str(shift) + ")"
+                parts.append(part)
+                shift += nbits
+            if not parts:
+                return "0"
+            elif len(parts) > _cat_sum_threshold:
+                # fields do not overlap: a flat sum avoids deep expressions
+                return "_sum((" + ", ".join(parts) + "))"
+            else:
+                return "(" + " | ".join(parts) + ")"
+        elif isinstance(node, Replicate):
+            nbits = len(node.v)
+            factor = sum(1 << i*nbits for i in range(node.n))
+            if not factor:
+                return "0"
+            v = self.expr(node.v, postcommit, depth)
+            return "(({} & {}) * {})".format(v, 2**nbits - 1, factor)
+        elif isinstance(node, _ArrayProxy):
+            key = "_min({}, {})".format(len(node.choices) - 1,
+                                        self.expr(node.key, postcommit, depth))
+            if all(isinstance(c, Signal) for c in node.choices):
+                slots = self._constant(tuple(self.evaluator.slot(c) for c in node.choices))
+                return "{}[{}[{}]]".format("N" if postcommit else "V", slots, key)
+            elif all(isinstance(c, Constant) for c in node.choices):
+                values = self._constant(tuple(c.value for c in node.choices))
+                return "{}[{}]".format(values, key)
+            else:
+                choices = []
+                for choice in node.choices:
+                    fn = self._new_function()
+                    fn.emit(1, "return " + self.expr(choice, postcommit))
+                    choices.append(fn.name)
+                table = self._table("(" + ", ".join(choices) + ",)")
+                return "{}[{}]()".format(table, key)
+        elif isinstance(node, _MemoryLocation):
+            if node.memory not in self.evaluator.replaced_memories:
+                state = self.evaluator.memory(node.memory)
+                read = self._constant(state.read_pending if postcommit else state.read)
+                return "{}(_min({}, {}))".format(read, state.depth - 1,
+                    self.expr(node.index, postcommit, depth))
+        elif isinstance(node, ClockSignal):
+            if node.cd in self.evaluator.clock_domains:
+                cd = self.evaluator.clock_domains[node.cd]
+                return self.expr(cd.clk, postcommit, depth)
+        elif isinstance(node, ResetSignal):
+            if node.cd in self.evaluator.clock_domains:
+                rst = self.evaluator.clock_domains[node.cd].rst
+                if rst is not None:
+                    return self.expr(rst, postcommit, depth)
+                elif node.allow_reset_less:
+                    return "0"
+
+        # let the interpreter handle (or report) everything else
+        return self._constant(partial(self.evaluator.eval, node, postcommit)) + "()"
+
+    # statements
+
+    def assign(self, fn, level, node, value):
+        if isinstance(node, Signal):
+            assert not node.variable
+            slot = str(self.evaluator.slot(node))
+            fn.emit(level, "N[" + slot + "] = " + _truncate(value, node.nbits, node.signed))
+            fn.emit(level, "_d(" + slot + ")")
+        elif isinstance(node, Cat):
+            t = fn.temp()
+            fn.emit(level, t + " = " + value)
+            for i, element in enumerate(node.l):
+                nbits = len(element)
+                self.assign(fn, level, element, "({} & {})".format(t, 2**nbits - 1))
+                if i != len(node.l) - 1:
+                    fn.emit(level, "{} >>= {}".format(t, nbits))
+        elif isinstance(node, _Slice):
+            t = fn.temp()
+            full_value = self.expr(node.value, True)
+            # clear bits assigned to by the slice and set them to the new value
+            clear = ~((2**node.stop - 1) - (2**node.start - 1))
+            mask = 2**(node.stop - node.start) - 1
+            fn.emit(level, "{} = ({} & ({})) | (({} & {}) << {})".format(
+                t, full_value, clear, value, mask, node.start))
+            self.assign(fn, level, node.value, t)
+        elif isinstance(node, _ArrayProxy):
+            choices = []
+            for choice in node.choices:
+                afn = self._new_function("value, ")
+                self.assign(afn, 1, choice, "value")
+                choices.append(afn.name)
+            table = self._table("(" + ", ".join(choices) + ",)")
+            t = fn.temp()
+            fn.emit(level, t + " = " + value)
+            fn.emit(level, "{}[_min({}, {})]({})".format(
+                table, len(node.choices) - 1, self.expr(node.key), t))
+        elif (isinstance(node, _MemoryLocation)
+                and node.memory not in self.evaluator.replaced_memories):
+            state = self.evaluator.memory(node.memory)
+            fn.emit(level, "{}(_min({}, {}), {})".format(self._constant(state.write),
+                state.depth - 1, self.expr(node.index), value))
+        else:
+            assign = self._constant(partial(self.evaluator.assign, node,
+                                            postcommit=self.postcommit))
+            fn.emit(level, assign + "(" + value + ")")
+
+    def block(self, fn, level, statements):
+        n = len(fn.lines)
+        self.statements(fn, level, statements)
+        if len(fn.lines) == n:
+            fn.emit(level, "pass")
+
+    def case(self, fn, level, s):
+        nbits, signed = value_bits_sign(s.test)
+        test = fn.temp()
+        fn.emit(level, test + " = " + _truncate(self.expr(s.test), nbits, signed))
+        # the first matching choice wins
+        choices = collections.OrderedDict()
+        for k, v in s.cases.items():
+            if isinstance(k, Constant) and k.value not in choices:
+                choices[k.value] = v
+        default = s.cases["default"] if "default" in s.cases else None
+
+        if len(choices) <= _case_dispatch_threshold:
+            keyword = "if"
+            for value, statements in choices.items():
+                fn.emit(level, "{} {} == {}:".format(keyword, test, value))
+                self.block(fn, level + 1, statements)
+                keyword = "elif"
+            if default is not None:
+                if choices:
+                    fn.emit(level, "else:")
+                    self.block(fn, level + 1, default)
+                else:
+                    self.statements(fn, level, default)
+        else:
+            entries = []
+            for value, statements in choices.items():
+                cfn = self._new_function()
+                self.statements(cfn, 1, statements)
+                entries.append("{}: {}".format(value, cfn.name))
+            table = self._table("{" + ", ".join(entries) + "}")
+            if default is not None:
+                dfn = self._new_function()
+                self.statements(dfn, 1, default)
+                default_name = dfn.name
+            else:
+                default_name = "_nop"
+            fn.emit(level, "{}.get({}, {})()".format(table, test, default_name))
+
+    def memory_write(self, fn, level, s):
+        state = self.evaluator.memory(s.memory)
+        we = fn.temp()
+        fn.emit(level, we + " = " + self.expr(s.we))
+        fn.emit(level, "if " + we + ":")
+        address = "_min({}, {})".format(state.depth - 1, self.expr(s.adr))
+        if s.we_granularity:
+            fn.emit(level + 1, "{}({}, {}, {}, {})".format(self._constant(state.write),
+                address, self.expr(s.dat_w), we, s.we_granularity))
+        else:
+            fn.emit(level + 1, "{}({}, {})".format(self._constant(state.write),
+                address, self.expr(s.dat_w)))
+
+    def statements(self, fn, level, statements):
+        if level > _max_stmt_depth:
+            sfn = self._new_function()
+            self.statements(sfn, 1, statements)
+            fn.emit(level, sfn.name + "()")
+            return
+        for s in statements:
+            if isinstance(s, _Assign):
+                self.assign(fn, level, s.l, self.expr(s.r))
+            elif isinstance(s, If):
+                fn.emit(level, "if {} & {}:".format(self.expr(s.cond), 2**len(s.cond) - 1))
+                self.block(fn, level + 1, s.t)
+                if s.f:
+                    fn.emit(level, "else:")
+                    self.block(fn, level + 1, s.f)
+            elif isinstance(s, Case):
+                self.case(fn, level, s)
+            elif isinstance(s, _MemoryWrite):
+                self.memory_write(fn, level, s)
+            elif isinstance(s, collections.abc.Iterable):
+                self.statements(fn, level, s)
+            else:
+                execute = self._constant(partial(self.evaluator.execute, [s],
+                                                 self.postcommit))
+                fn.emit(level, execute + "()")
+
+    def _compile(self, statements):
+        self.functions = []
+        self.tables = []
+        fn = self._new_function()
+        self.statements(fn, 1, statements)
+        source = "".join(f.get_source() for f in self.functions)
+        source += "\n".join(self.tables) + "\n"
+        exec(compile(source, "<litex.gen.sim.compiler>", "exec"), self.namespace)
+        return self.namespace[fn.name]
+
+    def compile(self, statements, postcommit=False):
+        # with postcommit, reads see the values assigned by the previous
+        # statements instead of the committed ones
+        self.postcommit = postcommit
+        try:
+            return self._compile(statements)
+        except (SyntaxError, RecursionError, MemoryError):
+            statements = list(statements)
+            if len(statements) > 1:
+                functions = [self.compile([s], postcommit) for s in statements]
+                def execute():
+                    for function in functions:
+                        function()
+                return execute
+            else:
+                return partial(self.evaluator.execute, statements, postcommit)
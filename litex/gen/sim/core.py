@@ -1,41 +1,83 @@
 import operator
 import collections
+import itertools
+import math
+import collections.abc
 import inspect
-from functools import wraps
+import heapq
+import traceback
+import zlib
+import concurrent.futures
+from fnmatch import fnmatchcase
+from fractions import Fraction
+from functools import wraps, partial
 
 from migen.fhdl.structure import *
 from migen.fhdl.structure import (_Value, _Statement,
                                   _Operator, _Slice, _ArrayProxy,
                                   _Assign, _Fragment)
 from migen.fhdl.bitcontainer import value_bits_sign
-from migen.fhdl.tools import (list_targets, list_signals,
+from migen.fhdl.tools import (list_targets, group_by_targets,
                               insert_resets, lower_specials)
+from migen.fhdl.visit import NodeVisitor
+from migen.fhdl.namer import build_namespace
 from migen.fhdl.simplify import MemoryToArray
-from migen.fhdl.specials import _MemoryLocation
+from migen.fhdl.specials import Memory, Instance, _MemoryLocation
 from migen.fhdl.module import Module
+from migen.genlib.record import Record
 from migen.genlib.resetsync import AsyncResetSynchronizer
 
 from litex.gen.sim.vcd import VCDWriter, DummyVCDWriter
+from litex.gen.sim.lxw import LXWWriter
+from litex.gen.sim.compiler import StatementCompiler
+from litex.gen.sim.memory import (MemoryState, _MemoryWrite, lower_memories,
+                                  _page_size)
+from litex.gen.sim.checkpoint import write_checkpoint, read_checkpoint
+from litex.gen.sim.profiler import SimulationProfiler
 
 
 class ClockState:
-    def __init__(self, high, half_period, time_before_trans):
+    def __init__(self, high, half_period, next_transition):
         self.high = high
         self.half_period = half_period
-        self.time_before_trans = time_before_trans
+        self.next_transition = next_transition
+
+
+def _exact(t):
+    # floats are taken as written, e.g. 6.4 is 32/5
+    if isinstance(t, float):
+        return Fraction(repr(t))
+    return Fraction(t)
+
+
+def _lcm(a, b):
+    return a*b//math.gcd(a, b)
 
 
 class TimeManager:
+    # Clock edges and timers are scheduled in a heap. Times are integers,
+    # counted in units of 1/scale of the times given in the description,
+    # which makes odd and fractional periods and phases exact. elapsed and
+    # the waveform files give them back in the units of the description.
     def __init__(self, description):
         self.clocks = collections.OrderedDict()
 
+        periods_phases = collections.OrderedDict()
         for k, period_phase in description.items():
             if isinstance(period_phase, tuple):
                 period, phase = period_phase
             else:
                 period = period_phase
                 phase = 0
-            half_period = period//2
+            periods_phases[k] = _exact(period), _exact(phase)
+        self.scale = 1
+        for period, phase in periods_phases.values():
+            for t in (period/2, phase):
+                self.scale = _lcm(self.scale, t.denominator)
+
+        for k, (period, phase) in periods_phases.items():
+            half_period = int(period*self.scale)//2
+            phase = int(phase*self.scale) % (2*half_period)
             if phase >= half_period:
                 phase -= half_period
                 high = True
@@ -43,23 +85,126 @@ class TimeManager:
                 high = False
             self.clocks[k] = ClockState(high, half_period, half_period - phase)
 
+        self.now = 0
+        self.order = itertools.count()
+        self.timeouts = []
+        self._schedule_clocks()
+
+    def _schedule_clocks(self):
+        self.events = [(cs.next_transition, next(self.order), k, None)
+                       for k, cs in self.clocks.items()]
+        heapq.heapify(self.events)
+
+    def remove(self, clock):
+        # the clock is not toggled anymore
+        del self.clocks[clock]
+        timers = [event for event in self.events if event[2] is None]
+        self._schedule_clocks()
+        for event in timers:
+            heapq.heappush(self.events, event)
+
+    @property
+    def elapsed(self):
+        if self.now % self.scale:
+            return Fraction(self.now, self.scale)
+        return self.now//self.scale
+
+    def ticks(self, t):
+        # rounds up to the time resolution
+        return math.ceil(_exact(t)*self.scale)
+
+    def add_timer(self, delay, key):
+        heapq.heappush(self.events,
+                       (self.now + self.ticks(delay), next(self.order), None, key))
+
+    def next_rising(self, clock, n):
+        # time of the n-th rising edge of the clock from now
+        cs = self.clocks[clock]
+        t = cs.next_transition
+        if cs.high:
+            t += cs.half_period
+        return t + (n - 1)*2*cs.half_period
+
+    def next_timer(self):
+        timers = [event[0] for event in self.events if event[2] is None]
+        return min(timers) if timers else None
+
+    def skip(self, t):
+        # jumps over the clock transitions before time t, to the last of them.
+        # Returns the elapsed time, the number of rising edges of each clock
+        # and the clocks which changed level.
+        now = self.now
+        rising = dict()
+        toggled = set()
+        for k, cs in self.clocks.items():
+            n = max(0, -((cs.next_transition - t)//cs.half_period))
+            if cs.high:
+                rising[k] = n//2
+            else:
+                rising[k] = (n + 1)//2
+            if n:
+                now = max(now, cs.next_transition + (n - 1)*cs.half_period)
+                cs.next_transition += n*cs.half_period
+            if n % 2:
+                cs.high = not cs.high
+                toggled.add(k)
+        timers = [event for event in self.events if event[2] is None]
+        self._schedule_clocks()
+        for event in timers:
+            heapq.heappush(self.events, event)
+        dt = now - self.now
+        self.now = now
+        return dt, rising, toggled
+
     def tick(self):
+        # timers that expired at this time are left in timeouts
         rising = set()
         falling = set()
-        dt = min(cs.time_before_trans for cs in self.clocks.values())
-        for k, cs in self.clocks.items():
-            if cs.time_before_trans == dt:
-                cs.high = not cs.high
-                if cs.high:
-                    rising.add(k)
-                else:
-                    falling.add(k)
-            cs.time_before_trans -= dt
-            if not cs.time_before_trans:
-                cs.time_before_trans += cs.half_period
+        self.timeouts = []
+        if not self.events:
+            return 0, rising, falling
+        t = self.events[0][0]
+        dt = t - self.now
+        self.now = t
+        while self.events and self.events[0][0] == t:
+            _, _, clock, key = heapq.heappop(self.events)
+            if clock is None:
+                self.timeouts.append(key)
+                continue
+            cs = self.clocks[clock]
+            cs.high = not cs.high
+            if cs.high:
+                rising.add(clock)
+            else:
+                falling.add(clock)
+            cs.next_transition = t + cs.half_period
+            heapq.heappush(self.events, (cs.next_transition, next(self.order), clock, None))
         return dt, rising, falling
 
 
+# Generator command: resumes the generator after the given time (in the
+# units of the clock periods) instead of at the next clock edge.
+class Delay:
+    def __init__(self, time):
+        self.time = time
+
+
+# Generator command: resumes the generator after the given number of cycles
+# of its clock domain, like as many plain yields.
+class Wait:
+    def __init__(self, cycles):
+        self.cycles = cycles
+
+
+# Generator command: resumes the generator at the first cycle of its clock
+# domain where the signal has the given value, or immediately if it already
+# has it.
+class WaitUntil:
+    def __init__(self, signal, value=1):
+        self.signal = signal
+        self.value = value
+
+
 str2op = {
     "~": operator.invert,
     "+": operator.add,
@@ -89,12 +234,63 @@ def _truncate(value, nbits, signed):
     return value
 
 
+_node_constants_size = 2**16
+
+
 class Evaluator:
     def __init__(self, clock_domains, replaced_memories):
         self.clock_domains = clock_domains
         self.replaced_memories = replaced_memories
         self.signal_values = dict()
         self.modifications = dict()
+        self.memories = dict()
+        self.modified_memories = set()
+        # id(node): (node, constants), the reference keeps the id unique
+        self.node_constants = dict()
+
+    def constants(self, node):
+        # shifts and masks of a node, costly to recompute on wide values
+        try:
+            return self.node_constants[id(node)][1]
+        except KeyError:
+            pass
+        if isinstance(node, _Slice):
+            r = (node.start, 2**(node.stop - node.start) - 1,
+                 ~((2**node.stop - 1) - (2**node.start - 1)))
+        elif isinstance(node, Cat):
+            r = []
+            shift = 0
+            for element in node.l:
+                nbits = len(element)
+                r.append((element, shift, 2**nbits - 1))
+                shift += nbits
+        elif isinstance(node, Replicate):
+            nbits = len(node.v)
+            r = (2**nbits - 1, sum(1 << i*nbits for i in range(node.n)))
+        elif isinstance(node, If):
+            r = 2**len(node.cond) - 1
+        elif isinstance(node, Case):
+            r = value_bits_sign(node.test)
+        else:
+            raise TypeError(node)
+        if len(self.node_constants) < _node_constants_size:
+            self.node_constants[id(node)] = (node, r)
+        return r
+
+    def memory(self, memory):
+        try:
+            return self.memories[memory]
+        except KeyError:
+            state = MemoryState(memory, self.modified_memories)
+            self.memories[memory] = state
+            return state
+
+    def _commit_memories(self, r):
+        # modified memories are reported along with the signals
+        for state in self.modified_memories:
+            if state.commit():
+                r.add(state.memory)
+        self.modified_memories.clear()
 
     def commit(self):
         r = set()
@@ -103,6 +299,8 @@ class Evaluator:
                 self.signal_values[k] = v
                 r.add(k)
         self.modifications.clear()
+        if self.modified_memories:
+            self._commit_memories(r)
         return r
 
     def eval(self, node, postcommit=False):
@@ -130,28 +328,30 @@ class Evaluator:
             else:
                 return str2op[node.op](*operands)
         elif isinstance(node, _Slice):
-            v = self.eval(node.value, postcommit)
-            idx = range(node.start, node.stop)
-            return sum(((v >> i) & 1) << j for j, i in enumerate(idx))
+            start, mask, _ = self.constants(node)
+            return (self.eval(node.value, postcommit) >> start) & mask
         elif isinstance(node, Cat):
-            shift = 0
             r = 0
-            for element in node.l:
-                nbits = len(element)
+            for element, shift, mask in self.constants(node):
                 # make value always positive
-                r |= (self.eval(element, postcommit) & (2**nbits-1)) << shift
-                shift += nbits
+                r |= (self.eval(element, postcommit) & mask) << shift
             return r
         elif isinstance(node, Replicate):
-            nbits = len(node.v)
-            v = self.eval(node.v, postcommit) & (2**nbits - 1)
-            return sum(v << i*nbits for i in range(node.n))
+            mask, factor = self.constants(node)
+            return (self.eval(node.v, postcommit) & mask)*factor
         elif isinstance(node, _ArrayProxy):
             idx = min(len(node.choices) - 1, self.eval(node.key, postcommit))
             return self.eval(node.choices[idx], postcommit)
         elif isinstance(node, _MemoryLocation):
-            array = self.replaced_memories[node.memory]
-            return self.eval(array[self.eval(node.index, postcommit)], postcommit)
+            if node.memory in self.replaced_memories:
+                array = self.replaced_memories[node.memory]
+                return self.eval(array[self.eval(node.index, postcommit)], postcommit)
+            state = self.memory(node.memory)
+            address = min(state.depth - 1, self.eval(node.index, postcommit))
+            if postcommit:
+                return state.read_pending(address)
+            else:
+                return state.read(address)
         elif isinstance(node, ClockSignal):
             return self.eval(self.clock_domains[node.cd].clk, postcommit)
         elif isinstance(node, ResetSignal):
@@ -167,55 +367,62 @@ class Evaluator:
         else:
             raise NotImplementedError(node)
 
-    def assign(self, node, value):
+    def assign(self, node, value, postcommit=False):
         if isinstance(node, Signal):
             assert not node.variable
             self.modifications[node] = _truncate(value,
                                                  node.nbits, node.signed)
         elif isinstance(node, Cat):
-            for element in node.l:
-                nbits = len(element)
-                self.assign(element, value & (2**nbits-1))
-                value >>= nbits
+            for element, shift, mask in self.constants(node):
+                self.assign(element, (value >> shift) & mask, postcommit)
         elif isinstance(node, _Slice):
-            full_value = self.eval(node.value, True)
-            # clear bits assigned to by the slice
-            full_value &= ~((2**node.stop-1) - (2**node.start-1))
-            # set them to the new value
-            value &= 2**(node.stop - node.start)-1
-            full_value |= value << node.start
-            self.assign(node.value, full_value)
+            start, mask, clear = self.constants(node)
+            # clear bits assigned to by the slice and set them to the new value
+            full_value = self.eval(node.value, True) & clear
+            self.assign(node.value, full_value | ((value & mask) << start), postcommit)
         elif isinstance(node, _ArrayProxy):
-            idx = min(len(node.choices) - 1, self.eval(node.key))
-            self.assign(node.choices[idx], value)
+            idx = min(len(node.choices) - 1, self.eval(node.key, postcommit))
+            self.assign(node.choices[idx], value, postcommit)
         elif isinstance(node, _MemoryLocation):
-            array = self.replaced_memories[node.memory]
-            self.assign(array[self.eval(node.index)], value)
+            if node.memory in self.replaced_memories:
+                array = self.replaced_memories[node.memory]
+                self.assign(array[self.eval(node.index, postcommit)], value, postcommit)
+            else:
+                state = self.memory(node.memory)
+                address = min(state.depth - 1, self.eval(node.index, postcommit))
+                state.write(address, value)
         else:
             raise NotImplementedError(node)
 
-    def execute(self, statements):
+    def execute(self, statements, postcommit=False):
         for s in statements:
             if isinstance(s, _Assign):
-                self.assign(s.l, self.eval(s.r))
+                self.assign(s.l, self.eval(s.r, postcommit), postcommit)
             elif isinstance(s, If):
-                if self.eval(s.cond) & (2**len(s.cond) - 1):
-                    self.execute(s.t)
+                if self.eval(s.cond, postcommit) & self.constants(s):
+                    self.execute(s.t, postcommit)
                 else:
-                    self.execute(s.f)
+                    self.execute(s.f, postcommit)
             elif isinstance(s, Case):
-                nbits, signed = value_bits_sign(s.test)
-                test = _truncate(self.eval(s.test), nbits, signed)
+                nbits, signed = self.constants(s)
+                test = _truncate(self.eval(s.test, postcommit), nbits, signed)
                 found = False
                 for k, v in s.cases.items():
                     if isinstance(k, Constant) and k.value == test:
-                        self.execute(v)
+                        self.execute(v, postcommit)
                         found = True
                         break
                 if not found and "default" in s.cases:
-                    self.execute(s.cases["default"])
-            elif isinstance(s, collections.Iterable):
-                self.execute(s)
+                    self.execute(s.cases["default"], postcommit)
+            elif isinstance(s, _MemoryWrite):
+                we = self.eval(s.we, postcommit)
+                if we:
+                    state = self.memory(s.memory)
+                    address = min(state.depth - 1, self.eval(s.adr, postcommit))
+                    state.write(address, self.eval(s.dat_w, postcommit),
+                                we, s.we_granularity)
+            elif isinstance(s, collections.abc.Iterable):
+                self.execute(s, postcommit)
             elif isinstance(s, Display):
                 args = []
                 for arg in s.args:
@@ -228,6 +435,283 @@ class Evaluator:
             else:
                 raise NotImplementedError
 
+    def compile(self, statements, postcommit=False):
+        return partial(self.execute, statements, postcommit)
+
+
+class _SlotValues(collections.abc.MutableMapping):
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+
+    def __getitem__(self, signal):
+        return self.evaluator.values[self.evaluator.slots[signal]]
+
+    def __setitem__(self, signal, value):
+        slot = self.evaluator.slot(signal)
+        self.evaluator.values[slot] = value
+        self.evaluator.next_values[slot] = value
+
+    def __delitem__(self, signal):
+        raise TypeError("Signals cannot be removed from a compiled evaluator")
+
+    def __iter__(self):
+        return iter(self.evaluator.slots)
+
+    def __len__(self):
+        return len(self.evaluator.slots)
+
+
+class CompiledEvaluator(Evaluator):
+    def __init__(self, clock_domains, replaced_memories):
+        Evaluator.__init__(self, clock_domains, replaced_memories)
+        self.slots = dict()
+        self.slot_signals = []
+        self.values = []
+        self.next_values = []
+        self.dirty = set()
+        self.signal_values = _SlotValues(self)
+        self.compiler = StatementCompiler(self)
+
+    def slot(self, signal):
+        try:
+            return self.slots[signal]
+        except KeyError:
+            slot = len(self.slot_signals)
+            self.slots[signal] = slot
+            self.slot_signals.append(signal)
+            self.values.append(signal.reset.value)
+            self.next_values.append(signal.reset.value)
+            return slot
+
+    def commit(self):
+        r = set()
+        values = self.values
+        for slot in self.dirty:
+            value = self.next_values[slot]
+            if values[slot] != value:
+                values[slot] = value
+                r.add(self.slot_signals[slot])
+        self.dirty.clear()
+        if self.modified_memories:
+            self._commit_memories(r)
+        return r
+
+    def eval(self, node, postcommit=False):
+        if isinstance(node, Signal):
+            if postcommit:
+                return self.next_values[self.slot(node)]
+            else:
+                return self.values[self.slot(node)]
+        return Evaluator.eval(self, node, postcommit)
+
+    def assign(self, node, value, postcommit=False):
+        if isinstance(node, Signal):
+            assert not node.variable
+            slot = self.slot(node)
+            self.next_values[slot] = _truncate(value, node.nbits, node.signed)
+            self.dirty.add(slot)
+        else:
+            Evaluator.assign(self, node, value, postcommit)
+
+    def compile(self, statements, postcommit=False):
+        return self.compiler.compile(statements, postcommit)
+
+
+class _SensitivityLister(NodeVisitor):
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.output_list = set()
+
+    def visit_Signal(self, node):
+        self.output_list.add(node)
+
+    def visit_ClockSignal(self, node):
+        if node.cd in self.evaluator.clock_domains:
+            self.output_list.add(self.evaluator.clock_domains[node.cd].clk)
+
+    def visit_ResetSignal(self, node):
+        if node.cd in self.evaluator.clock_domains:
+            rst = self.evaluator.clock_domains[node.cd].rst
+            if rst is not None:
+                self.output_list.add(rst)
+
+    def visit_Assign(self, node):
+        self.visit(node.r)
+        self.visit_target(node.l)
+
+    def visit_target(self, node):
+        # signals used to address the assigned bits
+        if isinstance(node, Cat):
+            for element in node.l:
+                self.visit_target(element)
+        elif isinstance(node, _Slice):
+            self.visit_target(node.value)
+        elif isinstance(node, _ArrayProxy):
+            self.visit(node.key)
+            for choice in node.choices:
+                self.visit_target(choice)
+        elif isinstance(node, _MemoryLocation):
+            self.visit(node.index)
+
+    def visit_unknown(self, node):
+        if isinstance(node, _MemoryLocation):
+            self.visit(node.index)
+            if node.memory in self.evaluator.replaced_memories:
+                self.output_list |= set(self.evaluator.replaced_memories[node.memory])
+            else:
+                self.output_list.add(node.memory)
+        elif isinstance(node, Display):
+            for arg in node.args:
+                self.visit(arg)
+
+
+class _SignalLister(NodeVisitor):
+    # also lists the signals used by memory locations and write ports
+    def __init__(self):
+        self.output_list = set()
+
+    def visit_Signal(self, node):
+        self.output_list.add(node)
+
+    def visit_unknown(self, node):
+        if isinstance(node, _MemoryLocation):
+            self.visit(node.index)
+        elif isinstance(node, _MemoryWrite):
+            self.visit(node.adr)
+            self.visit(node.dat_w)
+            self.visit(node.we)
+        elif isinstance(node, Display):
+            for arg in node.args:
+                self.visit(arg)
+
+
+class _DisplayFinder(NodeVisitor):
+    def __init__(self):
+        self.found = False
+
+    def visit_unknown(self, node):
+        if isinstance(node, Display):
+            self.found = True
+
+
+def _has_display(statements):
+    finder = _DisplayFinder()
+    finder.visit(statements)
+    return finder.found
+
+
+def _list_signals(node):
+    lister = _SignalLister()
+    lister.visit(node)
+    return lister.output_list
+
+
+def _list_sensitivity(evaluator, statements):
+    lister = _SensitivityLister(evaluator)
+    lister.visit(statements)
+    return lister.output_list
+
+
+def _strongly_connected_components(successors):
+    # iterative Tarjan, components are returned in topological order
+    index = dict()
+    lowlink = dict()
+    stack = []
+    on_stack = set()
+    components = []
+    for root in range(len(successors)):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors[root]))]
+        while work:
+            node, it = work[-1]
+            for succ in it:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(successors[succ])))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        component.append(n)
+                        if n == node:
+                            break
+                    components.append(sorted(component))
+    components.reverse()
+    return components
+
+
+def _generators_by_domain(generators):
+    if not isinstance(generators, dict):
+        generators = {"sys": generators}
+    r = dict()
+    for k, v in generators.items():
+        if (isinstance(v, collections.abc.Iterable)
+                and not inspect.isgenerator(v)):
+            r[k] = list(v)
+        else:
+            r[k] = [v]
+    return r
+
+
+def _hierarchical_name(signal):
+    names = []
+    for name, number in signal.backtrace:
+        if not names or names[-1] != name:
+            names.append(name)
+    return ".".join(names)
+
+
+def _select_signals(items, signals, replaced_memories, namespace=None):
+    # items are globs on hierarchical ("top.submodule.signal") or VCD names,
+    # modules, memories, records, signals, or lists of those
+    if not isinstance(items, (list, tuple, set)):
+        items = [items]
+    r = set()
+    for item in items:
+        if isinstance(item, str):
+            if namespace is None:
+                namespace = build_namespace(signals)
+            for signal in signals:
+                if (fnmatchcase(_hierarchical_name(signal), item)
+                        or fnmatchcase(namespace.get_name(signal), item)):
+                    r.add(signal)
+        elif isinstance(item, Signal):
+            r.add(item)
+        elif isinstance(item, Memory):
+            r |= set(replaced_memories.get(item, []))
+        elif isinstance(item, Record):
+            r |= set(item.flatten())
+        elif isinstance(item, Module):
+            if not item.get_fragment_called:
+                raise ValueError("Module is not part of the simulated design")
+            r |= _list_signals(item._fragment)
+            for special in item._fragment.specials:
+                if isinstance(special, Memory):
+                    r |= set(replaced_memories.get(special, []))
+                    for port in special.ports:
+                        r |= {s for s in (port.adr, port.dat_r, port.we, port.dat_w, port.re)
+                              if isinstance(s, Signal)}
+        elif isinstance(item, (list, tuple, set)):
+            r |= _select_signals(item, signals, replaced_memories, namespace)
+        else:
+            raise TypeError("Cannot select signals with {}".format(repr(item)))
+    return r & signals
+
 
 class DummyAsyncResetSynchronizerImpl(Module):
     def __init__(self, cd, async_reset):
@@ -243,34 +727,48 @@ class DummyAsyncResetSynchronizer:
         return DummyAsyncResetSynchronizerImpl(dr.cd, dr.async_reset)
 
 
-# TODO: instances via Iverilog/VPI
 class Simulator:
     def __init__(self, fragment_or_module, generators, clocks={"sys": 10}, vcd_name=None,
-                 special_overrides={}):
+                 special_overrides={}, compiled=True, propagation="event",
+                 trace_include=None, trace_exclude=None, trace_window=None,
+                 trace_domain="sys", native_memories=None, profile=False,
+                 profile_json=None, fast_forward=True, cosim=None):
         if isinstance(fragment_or_module, _Fragment):
             self.fragment = fragment_or_module
         else:
             self.fragment = fragment_or_module.get_fragment()
 
-        mta = MemoryToArray()
-        mta.transform_fragment(None, self.fragment)
+        # memories are either simulated natively or lowered to arrays of
+        # signals, which can be traced. They are lowered by default when a
+        # waveform file is written.
+        if native_memories is None:
+            native_memories = vcd_name is None
+        if native_memories:
+            self.memories = sorted(lower_memories(self.fragment), key=lambda x: x.duid)
+            replaced_memories = dict()
+        else:
+            self.memories = []
+            mta = MemoryToArray()
+            mta.transform_fragment(None, self.fragment)
+            replaced_memories = mta.replacements
 
         overrides = {AsyncResetSynchronizer: DummyAsyncResetSynchronizer}
         overrides.update(special_overrides)
         f, lowered = lower_specials(overrides, self.fragment)
+        # instances are simulated by an external model, e.g. VerilatorCosim
+        self.cosim_models = []
+        instances = {s for s in self.fragment.specials if isinstance(s, Instance)}
+        if instances and cosim is not None:
+            self.fragment.specials -= instances
+            self.cosim_models.append(cosim.build(instances))
         if self.fragment.specials:
             raise ValueError("Could not lower all specials", self.fragment.specials)
 
-        if not isinstance(generators, dict):
-            generators = {"sys": generators}
-        self.generators = dict()
+        self.generators = _generators_by_domain(generators)
         self.passive_generators = set()
-        for k, v in generators.items():
-            if (isinstance(v, collections.Iterable)
-                    and not inspect.isgenerator(v)):
-                self.generators[k] = list(v)
-            else:
-                self.generators[k] = [v]
+        self.sleeping_generators = set()
+        # generator: cycles left or WaitUntil command
+        self.waiting = dict()
 
         clocks = collections.OrderedDict(sorted(clocks.items(),
                                                 key=operator.itemgetter(0)))
@@ -285,24 +783,105 @@ class Simulator:
         # comb signals return to their reset value if nothing assigns them
         self.fragment.comb[0:0] = [s.eq(s.reset)
                                    for s in list_targets(self.fragment.comb)]
-        self.evaluator = Evaluator(self.fragment.clock_domains,
-                                   mta.replacements)
+        self.evaluator = self._create_evaluator(compiled, replaced_memories)
+        if propagation == "fixpoint":
+            self.comb_units = [self.evaluator.compile(self.fragment.comb)]
+            self._comb_propagate = self._comb_propagate_fixpoint
+        elif propagation == "event":
+            self._build_comb_units()
+            self._comb_propagate = self._comb_propagate_event
+        elif propagation == "levelized":
+            self._build_comb_levels()
+            self._comb_propagate = self._comb_propagate_levelized
+        else:
+            raise ValueError("Unknown propagation mode: '{}'".format(propagation))
+        self.sync = {cd: self.evaluator.compile(statements)
+                     for cd, statements in self.fragment.sync.items()}
+        # models are evaluated when one of their inputs changes
+        self.cosim_units = [(_list_sensitivity(self.evaluator, model.inputs),
+                             partial(self._cosim_step, model))
+                            for model in self.cosim_models]
 
+        # signals written to the waveform file, from cycle trace_start to
+        # cycle trace_stop of trace_domain
+        self.traced_signals = set()
+        self.trace_start, self.trace_stop = trace_window or (None, None)
+        self.trace_domain = trace_domain
+        self.trace_cycles = 0
+        self.tracing = False
+        self.trace_dump = False
         if vcd_name is None:
             self.vcd = DummyVCDWriter()
         else:
-            self.vcd = VCDWriter(vcd_name)
+            # the waveform format is selected by the file extension
+            if vcd_name.endswith(".lxw"):
+                self.vcd = LXWWriter(vcd_name, scale=self.time.scale)
+            else:
+                self.vcd = VCDWriter(vcd_name, scale=self.time.scale)
 
-            signals = list_signals(self.fragment)
+            signals = _list_signals(self.fragment)
+            for model in self.cosim_models:
+                signals |= _list_signals(model.inputs + model.outputs)
             for cd in self.fragment.clock_domains:
                 signals.add(cd.clk)
                 if cd.rst is not None:
                     signals.add(cd.rst)
-            for memory_array in mta.replacements.values():
+            for memory_array in replaced_memories.values():
                 signals |= set(memory_array)
+            if trace_include is not None:
+                signals = _select_signals(trace_include, signals, replaced_memories)
+            if trace_exclude is not None:
+                signals -= _select_signals(trace_exclude, signals, replaced_memories)
+            self.traced_signals = signals
             self.vcd.init(signals)
             for signal in sorted(signals, key=lambda x: x.duid):
                 self.vcd.set(signal, signal.reset.value)
+            self.tracing = not self.trace_start
+
+        # domains without sync logic or generators are not clocked, unless
+        # their clock is read or traced
+        comb_inputs = _list_sensitivity(self.evaluator, self.fragment.comb)
+        for sensitivity, step in self.cosim_units:
+            comb_inputs |= sensitivity
+        generator_domains = self._generator_domains()
+        for cd in self.fragment.clock_domains:
+            if (cd.name in self.time.clocks
+                    and not self.fragment.sync.get(cd.name)
+                    and cd.name not in generator_domains
+                    and cd.clk not in comb_inputs
+                    and cd.clk not in self.traced_signals):
+                self.time.remove(cd.name)
+
+        # when the state of the design does not change during a cycle of
+        # every clocked domain, and all generators wait, the cycles until the
+        # first of them resumes are skipped
+        self.clock_signals = {self.fragment.clock_domains[cd].clk
+                              for cd in self.time.clocks}
+        self.sync_domains = set(self.sync) & set(self.time.clocks)
+        self.idle_domains = set()
+        # Display prints at every cycle, even when no signal changes
+        self.display_domains = {cd for cd, statements in self.fragment.sync.items()
+                                if _has_display(statements)}
+        sync_inputs = set()
+        for statements in self.fragment.sync.values():
+            sync_inputs |= _list_sensitivity(self.evaluator, statements)
+        # models have state which is not visible in the signals
+        self.fast_forward = (fast_forward and not self.cosim_models
+                             and not (sync_inputs & self.clock_signals))
+
+        self.profile = profile
+        self.profile_json = profile_json
+        self.profiler = None
+        if profile or profile_json is not None:
+            self.profiler = SimulationProfiler()
+            self._instrument(self.profiler)
+
+    def _create_evaluator(self, compiled, replaced_memories):
+        if compiled:
+            return CompiledEvaluator(self.fragment.clock_domains,
+                                     replaced_memories)
+        else:
+            return Evaluator(self.fragment.clock_domains, replaced_memories)
 
     def __enter__(self):
         return self
@@ -312,39 +891,294 @@ class Simulator:
 
     def close(self):
         self.vcd.close()
+        for model in self.cosim_models:
+            model.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+            if self.profile:
+                print(self.profiler.report())
+            if self.profile_json is not None:
+                self.profiler.write_json(self.profile_json)
 
-    def _commit_and_comb_propagate(self):
-        # TODO: optimize
-        all_modified = set()
-        modified = self.evaluator.commit()
-        all_modified |= modified
+    def _checkpoint_signals(self):
+        signals = _list_signals(self.fragment)
+        for cd in self.fragment.clock_domains:
+            signals.add(cd.clk)
+            if cd.rst is not None:
+                signals.add(cd.rst)
+        return sorted(signals, key=lambda x: x.duid)
+
+    def _checkpoint_fingerprint(self, signals):
+        # designs are matched by the names and widths of their signals and
+        # memories, and their clocks
+        description = [(_hierarchical_name(s), len(s)) for s in signals]
+        description += [(m.width, m.depth) for m in self.memories]
+        description += [(k, cs.half_period) for k, cs in self.time.clocks.items()]
+        return zlib.crc32(repr(description).encode())
+
+    # Checkpoints hold the state of the design between clock edges, and are
+    # meant to be saved and restored outside of run(). Generators are not
+    # part of them: the simulator restoring a checkpoint continues with its
+    # own generators.
+    def save_checkpoint(self, filename):
+        if self.cosim_models:
+            raise ValueError("The state of co-simulated instances cannot be saved")
+        signals = self._checkpoint_signals()
+        header = [self._checkpoint_fingerprint(signals), self.time.scale]
+        values = [self.evaluator.eval(s) & (2**len(s) - 1) for s in signals]
+        memories = []
+        for memory in self.memories:
+            pages = self.evaluator.memory(memory).allocated_pages()
+            memories.append(len(pages))
+            for n, page in pages:
+                memories.append(n)
+                memories += page
+        time = [self.time.now, self.trace_cycles]
+        for k, cs in self.time.clocks.items():
+            time += [int(cs.high), cs.next_transition]
+        write_checkpoint(filename, [header, values, memories, time])
+
+    def restore_checkpoint(self, filename):
+        header, values, memories, time = read_checkpoint(filename)
+        signals = self._checkpoint_signals()
+        if header != [self._checkpoint_fingerprint(signals), self.time.scale]:
+            raise ValueError("Checkpoint {} does not match the simulated design"
+                             .format(filename))
+        for signal, value in zip(signals, values):
+            self.evaluator.signal_values[signal] = _truncate(value, signal.nbits,
+                                                             signal.signed)
+        i = 0
+        for memory in self.memories:
+            npages = memories[i]
+            i += 1
+            pages = []
+            for j in range(npages):
+                pages.append((memories[i], memories[i + 1:i + 1 + _page_size]))
+                i += 1 + _page_size
+            self.evaluator.memory(memory).restore_pages(pages)
+        self.time.now, self.trace_cycles = time[:2]
+        for j, cs in enumerate(self.time.clocks.values()):
+            cs.high = bool(time[2 + 2*j])
+            cs.next_transition = time[3 + 2*j]
+        self.time._schedule_clocks()
+        self.idle_domains.clear()
+        # waveforms continue with the values of all traced signals
+        if self.tracing:
+            self.trace_dump = True
+
+    def _instrument(self, profiler):
+        # comb units are named after the signals they drive
+        targets = collections.defaultdict(list)
+        for target, unit in getattr(self, "comb_drivers", {}).items():
+            targets[unit].append(target)
+        comb_units = []
+        for n, unit in enumerate(self.comb_units):
+            if targets[n]:
+                unit_targets = sorted(targets[n], key=lambda x: x.duid)
+                path = _hierarchical_name(unit_targets[0]).split(".")
+                if len(unit_targets) > 1:
+                    path[-1] += "(+{})".format(len(unit_targets) - 1)
+            else:
+                path = ["all"]
+            comb_units.append(profiler.wrap("comb", path, unit))
+        self.comb_units = comb_units
+        self.sync = {cd: profiler.wrap("sync", [cd], sync)
+                     for cd, sync in self.sync.items()}
+        for cd, generators in self.generators.items():
+            generators[:] = [profiler.wrap_generator([cd, g.__qualname__], g)
+                             for g in generators]
+        self._comb_propagate = profiler.wrap_propagate(self._comb_propagate)
+        self.cosim_units = [(sensitivity, profiler.wrap("cosim", [str(n)], step))
+                            for n, (sensitivity, step) in enumerate(self.cosim_units)]
+
+    def _levelize_comb(self):
+        # Comb statements are split into groups driving disjoint targets,
+        # then sorted so that groups come after the ones driving their
+        # inputs. Groups depending on each other through a combinatorial
+        # loop form a single unit.
+        groups = group_by_targets(self.fragment.comb)
+        drivers = dict()
+        for i, (targets, statements) in enumerate(groups):
+            for target in targets:
+                drivers[target] = i
+        successors = [set() for group in groups]
+        for i, (targets, statements) in enumerate(groups):
+            for signal in _list_sensitivity(self.evaluator, statements):
+                if signal in drivers:
+                    successors[drivers[signal]].add(i)
+        units = _strongly_connected_components(successors)
+        return groups, successors, units
+
+    def _build_comb_units(self):
+        # units are re-run until their outputs are stable, and are numbered
+        # in topological order
+        groups, successors, units = self._levelize_comb()
+        self.comb_units = []
+        self.comb_drivers = dict()
+        sensitivity = collections.defaultdict(set)
+        for n, unit in enumerate(units):
+            statements = [groups[i][1] for i in unit]
+            self.comb_units.append(self.evaluator.compile(statements))
+            for i in unit:
+                for target in groups[i][0]:
+                    self.comb_drivers[target] = n
+            for signal in _list_sensitivity(self.evaluator, statements):
+                sensitivity[signal].add(n)
+        self.comb_sensitivity = {signal: tuple(sorted(units))
+                                 for signal, units in sensitivity.items()}
+
+    def _build_comb_levels(self):
+        groups, successors, units = self._levelize_comb()
+        loops = [[groups[i][0] for i in unit] for unit in units
+                 if len(unit) > 1 or unit[0] in successors[unit[0]]]
+        if loops:
+            ns = build_namespace(set().union(*(t for loop in loops for t in loop)))
+            raise ValueError("Combinatorial loops prevent levelization: " +
+                "; ".join(", ".join(sorted(ns.get_name(s) for s in set().union(*loop)))
+                          for loop in loops))
+        # a single pass in topological order where each group sees the values
+        # assigned by the previous ones
+        statements = [groups[unit[0]][1] for unit in units]
+        self.comb_units = [self.evaluator.compile(statements, postcommit=True)]
+
+    def _comb_propagate_fixpoint(self, modified):
+        all_modified = set(modified)
         while modified:
-            self.evaluator.execute(self.fragment.comb)
+            for unit in self.comb_units:
+                unit()
             modified = self.evaluator.commit()
             all_modified |= modified
-        for signal in all_modified:
-            self.vcd.set(signal, self.evaluator.signal_values[signal])
+        return all_modified
+
+    def _comb_propagate_levelized(self, modified):
+        all_modified = set(modified)
+        if modified:
+            self.comb_units[0]()
+            all_modified |= self.evaluator.commit()
+        return all_modified
+
+    def _comb_propagate_event(self, modified):
+        all_modified = set(modified)
+        sensitivity = self.comb_sensitivity
+        pending = []
+        scheduled = set()
+        for signal in modified:
+            # signals driven by comb logic but modified by sync statements
+            # or generators are restored by their driver
+            units = sensitivity.get(signal, ())
+            driver = self.comb_drivers.get(signal)
+            if driver is not None:
+                units += (driver,)
+            for unit in units:
+                if unit not in scheduled:
+                    scheduled.add(unit)
+                    heapq.heappush(pending, unit)
+        while pending:
+            unit = heapq.heappop(pending)
+            scheduled.discard(unit)
+            self.comb_units[unit]()
+            modified = self.evaluator.commit()
+            all_modified |= modified
+            for signal in modified:
+                for unit in sensitivity.get(signal, ()):
+                    if unit not in scheduled:
+                        scheduled.add(unit)
+                        heapq.heappush(pending, unit)
+        return all_modified
+
+    def _cosim_step(self, model):
+        evaluator = self.evaluator
+        values = model.step([evaluator.eval(e) for e in model.inputs])
+        for expression, value in zip(model.outputs, values):
+            evaluator.assign(expression, value)
+
+    def _cosim_propagate(self, modified):
+        # models and comb logic are evaluated in turn until nothing changes
+        all_modified = modified
+        while True:
+            stepped = False
+            for sensitivity, step in self.cosim_units:
+                if modified & sensitivity:
+                    step()
+                    stepped = True
+            if not stepped:
+                return all_modified
+            modified = self._comb_propagate(self.evaluator.commit())
+            all_modified = all_modified | modified
+
+    def _commit_and_comb_propagate(self):
+        all_modified = self._comb_propagate(self.evaluator.commit())
+        if self.cosim_units:
+            all_modified = self._cosim_propagate(all_modified)
+        if self.tracing:
+            traced = all_modified
+            if self.trace_dump:
+                # values at the start of the trace window
+                traced = self.traced_signals
+                self.trace_dump = False
+            signal_values = self.evaluator.signal_values
+            for signal in traced & self.traced_signals:
+                self.vcd.set(signal, signal_values[signal])
+        return all_modified
+
+    def _trace_cycle(self):
+        self.trace_cycles += 1
+        if self.trace_cycles == self.trace_start and self.traced_signals:
+            self.tracing = True
+            self.trace_dump = True
+        if self.trace_cycles == self.trace_stop:
+            self.tracing = False
 
-    def _evalexec_nested_lists(self, x):
+    def _evalexec_nested_lists(self, evaluator, x):
         if isinstance(x, list):
-            return [self._evalexec_nested_lists(e) for e in x]
+            return [self._evalexec_nested_lists(evaluator, e) for e in x]
         elif isinstance(x, _Value):
-            return self.evaluator.eval(x)
+            return evaluator.eval(x)
         elif isinstance(x, _Statement):
-            self.evaluator.execute([x])
+            evaluator.execute([x])
             return None
         else:
             raise ValueError
 
     def _process_generators(self, cd):
+        if cd in self.generators:
+            self._run_generators(self.evaluator, self.generators[cd])
+
+    def _run_generators(self, evaluator, generators):
         exhausted = []
-        for generator in self.generators[cd]:
+        sleeping = []
+        waiting = self.waiting
+        for generator in generators:
+            if generator in waiting:
+                wait = waiting[generator]
+                if isinstance(wait, WaitUntil):
+                    if evaluator.eval(wait.signal) != wait.value:
+                        continue
+                elif wait > 1:
+                    waiting[generator] = wait - 1
+                    continue
+                del waiting[generator]
             reply = None
             while True:
                 try:
                     request = generator.send(reply)
+                    reply = None
                     if request is None:
                         break  # next cycle
+                    elif isinstance(request, Wait):
+                        if request.cycles > 0:
+                            waiting[generator] = request.cycles
+                            break
+                    elif isinstance(request, WaitUntil):
+                        if evaluator.eval(request.signal) != request.value:
+                            waiting[generator] = request
+                            break
+                    elif isinstance(request, Delay):
+                        sleeping.append(generator)
+                        self.sleeping_generators.add(generator)
+                        self.time.add_timer(request.time,
+                                            (evaluator, generators, generator))
+                        break
                     elif isinstance(request, str):
                         if request == "passive":
                             self.passive_generators.add(generator)
@@ -354,38 +1188,111 @@ class Simulator:
                             raise ValueError("Unknown simulator command: '{}'"
                                              .format(request))
                     else:
-                        reply = self._evalexec_nested_lists(request)
+                        reply = self._evalexec_nested_lists(evaluator, request)
                 except StopIteration:
                     exhausted.append(generator)
                     break
-        for generator in exhausted:
-            self.generators[cd].remove(generator)
+        for generator in exhausted + sleeping:
+            generators.remove(generator)
+
+    def _wake_generators(self, timeouts):
+        for evaluator, generators, generator in timeouts:
+            self.sleeping_generators.discard(generator)
+            woken = [generator]
+            self._run_generators(evaluator, woken)
+            # back to its clock domain, unless exhausted or sleeping again
+            generators += woken
+
+    def _generator_lists(self):
+        # (clock domain, generators) pairs
+        return self.generators.items()
+
+    def _generator_domains(self):
+        return {cd for cd, generators in self._generator_lists()}
 
     def _continue_simulation(self):
-        for cd_generators in self.generators.values():
+        if self.sleeping_generators - self.passive_generators:
+            return True
+        for cd, cd_generators in self._generator_lists():
             if set(cd_generators) - self.passive_generators:
                 return True
         return False
 
+    def _fast_forward(self, rising, modified):
+        if modified - self.clock_signals:
+            self.idle_domains.clear()
+            return
+        self.idle_domains |= rising - self.display_domains
+        if not self.sync_domains <= self.idle_domains:
+            return
+        if self.tracing and self.traced_signals & self.clock_signals:
+            return
+
+        # first time something can happen
+        targets = []
+        for cd, generators in self._generator_lists():
+            for generator in generators:
+                wait = self.waiting.get(generator)
+                if wait is None:
+                    return
+                if not isinstance(wait, WaitUntil) and cd in self.time.clocks:
+                    targets.append(self.time.next_rising(cd, wait))
+        timer = self.time.next_timer()
+        if timer is not None:
+            targets.append(timer)
+        if self.trace_domain in self.time.clocks:
+            for trace_cycle in (self.trace_start, self.trace_stop):
+                if trace_cycle is not None and trace_cycle > self.trace_cycles:
+                    targets.append(self.time.next_rising(
+                        self.trace_domain, trace_cycle - self.trace_cycles))
+        if not targets:
+            return
+
+        dt, skipped, toggled = self.time.skip(min(targets))
+        if not dt:
+            return
+        self.vcd.delay(dt)
+        for cd, generators in self._generator_lists():
+            if skipped.get(cd):
+                for generator in generators:
+                    wait = self.waiting[generator]
+                    if not isinstance(wait, WaitUntil):
+                        self.waiting[generator] = wait - skipped[cd]
+        self.trace_cycles += skipped.get(self.trace_domain, 0)
+        for cd in toggled:
+            self.evaluator.assign(self.fragment.clock_domains[cd].clk,
+                                  int(self.time.clocks[cd].high))
+        self._commit_and_comb_propagate()
+
     def run(self):
-        self.evaluator.execute(self.fragment.comb)
+        if self.profiler is not None:
+            self.profiler.start()
+        for unit in self.comb_units:
+            unit()
+        for sensitivity, step in self.cosim_units:
+            step()
         self._commit_and_comb_propagate()
 
         while True:
             dt, rising, falling = self.time.tick()
             self.vcd.delay(dt)
             for cd in rising:
+                if cd == self.trace_domain:
+                    self._trace_cycle()
                 self.evaluator.assign(self.fragment.clock_domains[cd].clk, 1)
-                if cd in self.fragment.sync:
-                    self.evaluator.execute(self.fragment.sync[cd])
-                if cd in self.generators:
-                    self._process_generators(cd)
+                if cd in self.sync:
+                    self.sync[cd]()
+                self._process_generators(cd)
             for cd in falling:
                 self.evaluator.assign(self.fragment.clock_domains[cd].clk, 0)
-            self._commit_and_comb_propagate()
+            if self.time.timeouts:
+                self._wake_generators(self.time.timeouts)
+            modified = self._commit_and_comb_propagate()
 
             if not self._continue_simulation():
                 break
+            if self.fast_forward:
+                self._fast_forward(rising, modified)
 
 
 def run_simulation(*args, **kwargs):
@@ -393,6 +1300,72 @@ def run_simulation(*args, **kwargs):
         s.run()
 
 
+class SimulationResult:
+    def __init__(self, returns=None, vcd_name=None, traceback=None):
+        self.returns = returns
+        self.vcd_name = vcd_name
+        self.traceback = traceback
+
+    @property
+    def failed(self):
+        return self.traceback is not None
+
+
+def _capture_returns(generators):
+    # wraps generators given in any form accepted by Simulator, and returns
+    # a function giving their return values in the same form
+    if isinstance(generators, dict):
+        wrapped = dict()
+        getters = dict()
+        for k, v in generators.items():
+            wrapped[k], getters[k] = _capture_returns(v)
+        return wrapped, lambda: {k: g() for k, g in getters.items()}
+    elif (isinstance(generators, collections.abc.Iterable)
+            and not inspect.isgenerator(generators)):
+        captured = [_capture_returns(g) for g in generators]
+        return [w for w, g in captured], lambda: [g() for w, g in captured]
+    else:
+        returns = [None]
+        def capture():
+            returns[0] = yield from generators
+        return capture(), lambda: returns[0]
+
+
+def _run_simulation_job(design_factory, generator_factory, vcd_name, kwargs):
+    try:
+        dut = design_factory()
+        generators, get_returns = _capture_returns(generator_factory(dut))
+        run_simulation(dut, generators, vcd_name=vcd_name, **kwargs)
+        return SimulationResult(get_returns(), vcd_name)
+    except Exception:
+        return SimulationResult(vcd_name=vcd_name, traceback=traceback.format_exc())
+
+
+def run_simulations_parallel(design_factory, generator_factories, vcd_name=None,
+                             max_workers=None, **kwargs):
+    # Each simulation runs in a worker process on its own design instance:
+    # design_factory() builds the design and each generator factory is called
+    # with it to build the generators. Factories and return values of the
+    # generators must be picklable. vcd_name is formatted with the index of
+    # the simulation. Results are returned in order, failures carry their
+    # traceback instead of raising.
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        jobs = []
+        for i, generator_factory in enumerate(generator_factories):
+            job_vcd_name = None if vcd_name is None else vcd_name.format(i)
+            future = executor.submit(_run_simulation_job, design_factory,
+                                     generator_factory, job_vcd_name, kwargs)
+            jobs.append((future, job_vcd_name))
+        for future, job_vcd_name in jobs:
+            try:
+                results.append(future.result())
+            except Exception:
+                results.append(SimulationResult(vcd_name=job_vcd_name,
+                                                traceback=traceback.format_exc()))
+    return results
+
+
 def passive(generator):
     @wraps(generator)
     def wrapper(*args, **kwargs):
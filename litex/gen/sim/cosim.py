@@ -0,0 +1,105 @@
+import ctypes
+import os
+
+from migen.fhdl.structure import Signal, Constant, _Fragment
+from migen.fhdl.specials import Instance
+
+from litex.gen.fhdl.verilog import convert
+from litex.build.sim.verilator import build_cosim_library
+
+
+def _fields(expressions):
+    # (shift, mask) of each pin, pins start on 32-bit words
+    fields = []
+    shift = 0
+    for expression in expressions:
+        nbits = len(expression)
+        fields.append((shift, 2**nbits - 1))
+        shift += 32*((nbits + 31)//32)
+    return fields, max(shift//8, 4)
+
+
+# Verilator model of instances, loaded with ctypes. inputs and outputs are the
+# expressions connected to its pins, all exchanged in one call per evaluation.
+class CosimModel:
+    def __init__(self, library, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.library = ctypes.CDLL(library)
+        self.library.litex_cosim_new.restype = ctypes.c_void_p
+        self.library.litex_cosim_delete.argtypes = [ctypes.c_void_p]
+        self.library.litex_cosim_step.argtypes = [ctypes.c_void_p,
+                                                  ctypes.c_char_p, ctypes.c_char_p]
+        self.handle = self.library.litex_cosim_new()
+        self.in_fields, in_size = _fields(inputs)
+        self.out_fields, out_size = _fields(outputs)
+        self.in_buffer = ctypes.create_string_buffer(in_size)
+        self.out_buffer = ctypes.create_string_buffer(out_size)
+
+    def step(self, values):
+        # sets the inputs, evaluates the model and returns the outputs
+        v = 0
+        for value, (shift, mask) in zip(values, self.in_fields):
+            v |= (value & mask) << shift
+        self.in_buffer.raw = v.to_bytes(len(self.in_buffer), "little")
+        self.library.litex_cosim_step(self.handle, self.in_buffer, self.out_buffer)
+        v = int.from_bytes(self.out_buffer.raw, "little")
+        return [(v >> shift) & mask for shift, mask in self.out_fields]
+
+    def close(self):
+        if self.handle is not None:
+            self.library.litex_cosim_delete(self.handle)
+            self.handle = None
+
+
+# Co-simulation of Instance specials with Verilator, given to the Simulator
+# with the Verilog sources of the instantiated modules.
+class VerilatorCosim:
+    def __init__(self, sources=[], include_paths=[], build_dir="cosim_build",
+                 threads=1, verbose=False):
+        self.sources = sources
+        self.include_paths = include_paths
+        self.build_dir = build_dir
+        self.threads = threads
+        self.verbose = verbose
+
+    def build(self, instances):
+        # the instances are wrapped in a dut module, with one pin per port
+        inputs = []
+        outputs = []
+        wrapped = set()
+        for instance in sorted(instances, key=lambda x: x.duid):
+            items = []
+            for item in instance.items:
+                if isinstance(item, Instance.InOut):
+                    raise NotImplementedError("Inout port '{}' of instance '{}' cannot be "
+                                              "co-simulated".format(item.name, instance.name_override))
+                elif isinstance(item, Instance.Input) and isinstance(item.expr, Constant):
+                    items.append(item)
+                elif isinstance(item, (Instance.Input, Instance.Output)):
+                    pin = Signal(len(item.expr),
+                                 name_override=instance.name_override + "_" + item.name)
+                    items.append(type(item)(item.name, pin))
+                    if isinstance(item, Instance.Input):
+                        inputs.append((pin, item.expr))
+                    else:
+                        outputs.append((pin, item.expr))
+                else:
+                    items.append(item)
+            wrapped.add(Instance(instance.of, *items, name=instance.name_override,
+                                 synthesis_directive=instance.synthesis_directive,
+                                 attr=instance.attr))
+
+        ios = {pin for pin, expression in inputs + outputs}
+        output = convert(_Fragment(specials=wrapped), ios, name="dut")
+        os.makedirs(self.build_dir, exist_ok=True)
+        verilog_file = os.path.join(self.build_dir, "dut.v")
+        with open(verilog_file, "w") as f:
+            f.write(output.main_source)
+        library = build_cosim_library(self.build_dir, verilog_file,
+            [(output.ns.get_name(pin), len(pin)) for pin, expression in inputs],
+            [(output.ns.get_name(pin), len(pin)) for pin, expression in outputs],
+            self.sources, self.include_paths, self.threads, self.verbose)
+        return CosimModel(library,
+                          [expression for pin, expression in inputs],
+                          [expression for pin, expression in outputs])
@@ -0,0 +1,300 @@
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+import math
+import json
+import struct
+import zlib
+
+from migen.fhdl.namer import build_namespace
+
+from litex.gen.sim.vcd import vcd_codes, vcd_format, vcd_timescale
+
+
+# LiteX waveform (.lxw) files
+#
+#   magic    b"LXWAVE1\n"
+#   blocks   zlib compressed blocks, one after the other
+#   index    zlib compressed JSON:
+#              {"signals": [[name, nbits, reset], ...],
+#               "blocks":  [[start, offset, size], ...],
+#               "end":     end time,
+#               "scale":   times are in units of 1/scale of the clock periods}
+#   trailer  struct "<QQ8s": index offset, index size, magic
+#
+# Blocks hold the values of all signals known at their start time, so any
+# time can be reached by decompressing a single block, followed by the value
+# changes. They are made of unsigned LEB128 integers, split in two streams
+# that compress better separately:
+#   size                                     size of the structure stream
+#   structure stream:
+#     n                                      signals 0 to n-1 at start time
+#     (dt, n, signal delta*n)*               changes, dt from previous ones
+#   value stream:
+#     value*n, (value*n)*
+# Changes of a time are sorted by signal and each signal is stored as the
+# difference with the previous one plus one. Values are stored as unsigned
+# numbers of the signal width.
+
+_magic = b"LXWAVE1\n"
+_trailer = struct.Struct("<QQ8s")
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, i):
+    n = 0
+    shift = 0
+    while data[i] & 0x80:
+        n |= (data[i] & 0x7f) << shift
+        shift += 7
+        i += 1
+    return n | (data[i] << shift), i + 1
+
+
+def _read_varints(data):
+    r = []
+    n = 0
+    shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            r.append(n)
+            n = 0
+            shift = 0
+    return r
+
+
+class LXWWriter:
+    def __init__(self, filename, block_size=2**20, level=6, scale=1):
+        self.filename = filename
+        self.block_size = block_size
+        self.level = level
+        self.scale = scale
+        self.out_file = None
+        self.signals = []
+        self.indexes = dict()
+        self.masks = []
+        self.signal_values = []
+        self.blocks = []
+        self.structure = None
+        self.values = None
+        self.block_start = 0
+        self.last_time = 0
+        self.changes = []
+        self.t = 0
+
+    def _add_signal(self, signal):
+        self.indexes[signal] = len(self.signals)
+        self.signals.append(signal)
+        mask = 2**len(signal) - 1
+        self.masks.append(mask)
+        self.signal_values.append(signal.reset.value & mask)
+
+    def _start_block(self):
+        self.structure = bytearray()
+        self.values = bytearray()
+        self.block_start = self.t
+        self.last_time = self.t
+        _write_varint(self.structure, len(self.signal_values))
+        for value in self.signal_values:
+            _write_varint(self.values, value)
+
+    def _flush_block(self):
+        block = bytearray()
+        _write_varint(block, len(self.structure))
+        block += self.structure
+        block += self.values
+        data = zlib.compress(bytes(block), self.level)
+        self.blocks.append((self.block_start, self.out_file.tell(), len(data)))
+        self.out_file.write(data)
+
+    def _flush_changes(self):
+        structure = self.structure
+        values = self.values
+        _write_varint(structure, self.t - self.last_time)
+        _write_varint(structure, len(self.changes))
+        previous = -1
+        for index, value in sorted(self.changes):
+            _write_varint(structure, index - previous - 1)
+            _write_varint(values, value)
+            previous = index
+        self.changes = []
+        self.last_time = self.t
+        if len(structure) + len(values) >= self.block_size:
+            self._flush_block()
+            self._start_block()
+
+    def init(self, signals):
+        for signal in sorted(signals, key=lambda x: x.duid):
+            if signal not in self.indexes:
+                self._add_signal(signal)
+        self.out_file = open(self.filename, "wb")
+        self.out_file.write(_magic)
+        self._start_block()
+
+    def set(self, signal, value):
+        try:
+            index = self.indexes[signal]
+        except KeyError:
+            if self.out_file is None:
+                self.init([signal])
+            else:
+                self._add_signal(signal)
+            index = self.indexes[signal]
+        value &= self.masks[index]
+        if self.signal_values[index] != value:
+            self.signal_values[index] = value
+            self.changes.append((index, value))
+
+    def delay(self, delay):
+        if self.changes:
+            self._flush_changes()
+        self.t += delay
+
+    def close(self):
+        if self.changes:
+            self._flush_changes()
+        self._flush_block()
+        ns = build_namespace(self.signals)
+        index = {
+            "signals": [[ns.get_name(s), len(s), s.reset.value & m]
+                        for s, m in zip(self.signals, self.masks)],
+            "blocks": self.blocks,
+            "end": self.t,
+            "scale": self.scale
+        }
+        data = zlib.compress(json.dumps(index).encode(), self.level)
+        offset = self.out_file.tell()
+        self.out_file.write(data)
+        self.out_file.write(_trailer.pack(offset, len(data), _magic))
+        self.out_file.close()
+
+
+class LXWReader:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(_magic)) != _magic:
+                raise ValueError("{} is not a LiteX waveform file".format(filename))
+            f.seek(-_trailer.size, 2)
+            offset, size, magic = _trailer.unpack(f.read(_trailer.size))
+            if magic != _magic:
+                raise ValueError("{} is truncated".format(filename))
+            f.seek(offset)
+            index = json.loads(zlib.decompress(f.read(size)).decode())
+        # (name, nbits, reset)
+        self.signals = [tuple(s) for s in index["signals"]]
+        self.blocks = [tuple(b) for b in index["blocks"]]
+        self.scale = index.get("scale", 1)
+        self.end = self._time(index["end"])
+
+    def _time(self, t):
+        # from units of 1/scale to the units of the clock periods
+        if t % self.scale:
+            return Fraction(t, self.scale)
+        return t//self.scale
+
+    def _ticks(self, t, rounding=math.floor):
+        if isinstance(t, float):
+            t = Fraction(repr(t))
+        return rounding(t*self.scale)
+
+    def _read_block(self, n):
+        start, offset, size = self.blocks[n]
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(size))
+        size, i = _read_varint(data, 0)
+        structure = _read_varints(data[i:i + size])
+        values = _read_varints(data[i + size:])
+        nvalues = structure[0]
+        snapshot = list(enumerate(values[:nvalues]))
+        changes = []
+        t = start
+        i = 1
+        j = nvalues
+        while i < len(structure):
+            t += structure[i]
+            n = structure[i + 1]
+            t_changes = []
+            index = -1
+            for delta, value in zip(structure[i + 2:i + 2 + n], values[j:j + n]):
+                index += delta + 1
+                t_changes.append((index, value))
+            changes.append((t, t_changes))
+            i += 2 + n
+            j += n
+        return snapshot, changes
+
+    def values_at(self, t):
+        # values of all signals after the changes at time t
+        values = [reset for name, nbits, reset in self.signals]
+        t = self._ticks(t)
+        n = bisect_right([b[0] for b in self.blocks], t) - 1
+        if n < 0:
+            return values
+        snapshot, changes = self._read_block(n)
+        for index, value in snapshot:
+            values[index] = value
+        for ct, ct_changes in changes:
+            if ct > t:
+                break
+            for index, value in ct_changes:
+                values[index] = value
+        return values
+
+    def changes(self, start=0, stop=None):
+        # yields (time, [(signal index, value), ...]) for start <= time < stop
+        if stop is not None:
+            stop = self._ticks(stop, math.ceil)
+        for t, t_changes in self._changes(self._ticks(start, math.ceil), stop):
+            yield self._time(t), t_changes
+
+    def _changes(self, start, stop):
+        starts = [b[0] for b in self.blocks]
+        # changes at the start time of a block end the previous one
+        first = max(bisect_left(starts, start) - 1, 0)
+        for n in range(first, len(self.blocks)):
+            if stop is not None and starts[n] >= stop:
+                break
+            snapshot, changes = self._read_block(n)
+            for t, t_changes in changes:
+                if t < start:
+                    continue
+                if stop is not None and t >= stop:
+                    return
+                yield t, t_changes
+
+    def write_vcd(self, filename):
+        codegen = vcd_codes()
+        formats = []
+        timescale, factor = vcd_timescale(self.scale)
+        with open(filename, "w", buffering=2**20, newline="\n") as f:
+            f.write(timescale)
+            for name, nbits, reset in self.signals:
+                code = next(codegen)
+                f.write("$var wire {} {} {} $end\n".format(nbits, code, name))
+                formats.append(vcd_format(code, nbits))
+            f.write("$dumpvars\n")
+            for fmtstr, (name, nbits, reset) in zip(formats, self.signals):
+                f.write(fmtstr.format(reset))
+            f.write("$end\n")
+            f.write("#0\n")
+            last_t = 0
+            for t, t_changes in self._changes(0, None):
+                t = round(t*factor)
+                if t != last_t:
+                    f.write("#{}\n".format(t))
+                    last_t = t
+                for index, value in t_changes:
+                    f.write(formats[index].format(value))
+            end = round(self.end*self.scale*factor)
+            if end != last_t:
+                f.write("#{}\n".format(end))
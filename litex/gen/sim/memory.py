@@ -0,0 +1,157 @@
+from array import array
+
+from migen.fhdl.structure import *
+from migen.fhdl.structure import _Statement
+from migen.fhdl.specials import Memory, WRITE_FIRST, NO_CHANGE
+
+
+_page_bits = 12
+_page_size = 2**_page_bits
+
+
+# Contents of a memory. Storage is allocated by pages on first write,
+# untouched locations read their initial value.
+class MemoryState:
+    def __init__(self, memory, modified):
+        self.memory = memory
+        self.depth = memory.depth
+        self.mask = 2**memory.width - 1
+        self.init = memory.init if memory.init is not None else []
+        self.typecode = "Q" if memory.width <= 64 else None
+        self.pages = [None]*((self.depth + _page_size - 1)//_page_size)
+        self.pending = dict()
+        self.modified = modified
+        self.lane_masks = dict()
+
+    def _new_page(self, values):
+        if self.typecode is not None:
+            return array(self.typecode, values)
+        else:
+            return list(values)
+
+    def _page(self, n):
+        page = self.pages[n]
+        if page is None:
+            start = n*_page_size
+            values = [v & self.mask for v in self.init[start:start + _page_size]]
+            values += [0]*(_page_size - len(values))
+            page = self._new_page(values)
+            self.pages[n] = page
+        return page
+
+    def allocated_pages(self):
+        return [(n, page) for n, page in enumerate(self.pages) if page is not None]
+
+    def restore_pages(self, pages):
+        # pages are (page number, values), the others are back to init
+        self.pending.clear()
+        for n in range(len(self.pages)):
+            self.pages[n] = None
+        for n, values in pages:
+            self.pages[n] = self._new_page(values)
+
+    def read(self, address):
+        page = self.pages[address >> _page_bits]
+        if page is not None:
+            return page[address & (_page_size - 1)]
+        elif address < len(self.init):
+            return self.init[address] & self.mask
+        else:
+            return 0
+
+    def read_pending(self, address):
+        try:
+            return self.pending[address]
+        except KeyError:
+            return self.read(address)
+
+    def _lane_mask(self, we, granularity):
+        key = we, granularity
+        try:
+            return self.lane_masks[key]
+        except KeyError:
+            lane = 2**granularity - 1
+            mask = 0
+            for i in range(self.memory.width//granularity):
+                if we & (1 << i):
+                    mask |= lane << i*granularity
+            if len(self.lane_masks) < 4096:
+                self.lane_masks[key] = mask
+            return mask
+
+    def write(self, address, value, we=1, granularity=0):
+        # writes are visible after commit, like signal assignments
+        if granularity:
+            mask = self._lane_mask(we, granularity)
+            value = (self.read_pending(address) & ~mask) | (value & mask)
+        self.pending[address] = value & self.mask
+        self.modified.add(self)
+
+    def commit(self):
+        changed = False
+        for address, value in self.pending.items():
+            page = self._page(address >> _page_bits)
+            offset = address & (_page_size - 1)
+            if page[offset] != value:
+                page[offset] = value
+                changed = True
+        self.pending.clear()
+        return changed
+
+
+# Write port of a memory, executed directly by the evaluators.
+class _MemoryWrite(_Statement):
+    def __init__(self, memory, adr, dat_w, we, we_granularity):
+        self.memory = memory
+        self.adr = adr
+        self.dat_w = dat_w
+        self.we = we
+        self.we_granularity = we_granularity
+
+
+def lower_memories(f):
+    # Replaces memory ports with statements reading and writing memory
+    # locations (Memory[address]), which the evaluators handle natively.
+    memories = []
+    newspecials = set()
+    processed_ports = set()
+
+    for mem in f.specials:
+        if not isinstance(mem, Memory):
+            newspecials.add(mem)
+            continue
+        memories.append(mem)
+
+        for port in mem.ports:
+            try:
+                sync = f.sync[port.clock.cd]
+            except KeyError:
+                sync = f.sync[port.clock.cd] = []
+
+            # read
+            if port.async_read:
+                f.comb.append(port.dat_r.eq(mem[port.adr]))
+            else:
+                if port.mode == WRITE_FIRST:
+                    adr_reg = Signal.like(port.adr)
+                    rd_stmt = adr_reg.eq(port.adr)
+                    f.comb.append(port.dat_r.eq(mem[adr_reg]))
+                elif port.mode == NO_CHANGE and port.we is not None:
+                    rd_stmt = If(~port.we, port.dat_r.eq(mem[port.adr]))
+                else: # NO_CHANGE without write capability reduces to READ_FIRST
+                    rd_stmt = port.dat_r.eq(mem[port.adr])
+                if port.re is None:
+                    sync.append(rd_stmt)
+                else:
+                    sync.append(If(port.re, rd_stmt))
+
+            # write
+            if port.we is not None:
+                sync.append(_MemoryWrite(mem, port.adr, port.dat_w, port.we,
+                                         port.we_granularity))
+
+            processed_ports.add(port)
+
+    newspecials -= processed_ports
+    f.specials = newspecials
+    return memories
@@ -0,0 +1,120 @@
+import collections
+import json
+import time
+
+
+class _ProfileEntry:
+    def __init__(self, kind, path):
+        self.kind = kind
+        self.path = path
+        self.calls = 0
+        self.time = 0.0
+
+    @property
+    def name(self):
+        return ".".join(self.path)
+
+
+class _ProfiledGenerator:
+    def __init__(self, generator, entry):
+        self.generator = generator
+        self.entry = entry
+
+    def send(self, value):
+        t = time.perf_counter()
+        try:
+            return self.generator.send(value)
+        finally:
+            self.entry.time += time.perf_counter() - t
+            self.entry.calls += 1
+
+
+# Counts evaluations and wall time of comb units, sync domains and
+# generators, and the number of comb unit evaluations needed to propagate
+# each change (delta iterations).
+class SimulationProfiler:
+    def __init__(self):
+        self.entries = []
+        self.evaluations = 0
+        self.deltas = collections.Counter()
+        self.started = None
+        self.elapsed = 0.0
+
+    def _entry(self, kind, path):
+        entry = _ProfileEntry(kind, path)
+        self.entries.append(entry)
+        return entry
+
+    def wrap(self, kind, path, function):
+        entry = self._entry(kind, path)
+        profiler = self
+        def wrapper():
+            t = time.perf_counter()
+            function()
+            entry.time += time.perf_counter() - t
+            entry.calls += 1
+            profiler.evaluations += 1
+        return wrapper
+
+    def wrap_propagate(self, propagate):
+        def wrapper(modified):
+            evaluations = self.evaluations
+            r = propagate(modified)
+            self.deltas[self.evaluations - evaluations] += 1
+            return r
+        return wrapper
+
+    def wrap_generator(self, path, generator):
+        return _ProfiledGenerator(generator, self._entry("generator", path))
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        if self.started is not None:
+            self.elapsed += time.perf_counter() - self.started
+            self.started = None
+
+    def report(self):
+        r = "Simulation profile: {:.3f} s\n".format(self.elapsed)
+        r += "{:>10} {:>10} {:>6}  {:<9} {}\n".format("calls", "time (s)", "%", "kind", "name")
+        for entry in sorted(self.entries, key=lambda e: e.time, reverse=True):
+            if not entry.calls:
+                continue
+            share = 100*entry.time/self.elapsed if self.elapsed else 0.0
+            r += "{:>10} {:>10.3f} {:>6.1f}  {:<9} {}\n".format(
+                entry.calls, entry.time, share, entry.kind, entry.name)
+        modules = collections.Counter()
+        for entry in self.entries:
+            if entry.kind == "comb" and len(entry.path) > 1:
+                modules[".".join(entry.path[:-1])] += entry.time
+        if modules:
+            r += "Comb time by module:\n"
+            for module, module_time in modules.most_common():
+                r += "{:>10.3f}  {}\n".format(module_time, module)
+        propagations = sum(self.deltas.values())
+        if propagations:
+            r += "Comb evaluations per propagation: {:.2f} average, {} maximum\n".format(
+                sum(k*v for k, v in self.deltas.items())/propagations, max(self.deltas))
+        return r
+
+    def to_json(self):
+        # stacks are in the folded format used by flame graph tools
+        entries = []
+        for entry in sorted(self.entries, key=lambda e: e.time, reverse=True):
+            entries.append({
+                "kind": entry.kind,
+                "name": entry.name,
+                "stack": ";".join([entry.kind] + entry.path),
+                "calls": entry.calls,
+                "time": entry.time
+            })
+        return {
+            "elapsed": self.elapsed,
+            "entries": entries,
+            "deltas": {str(k): v for k, v in sorted(self.deltas.items())}
+        }
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_json(), f, indent=1)
@@ -1,7 +1,6 @@
 from itertools import count
-import tempfile
+from fractions import Fraction
 import os
-from collections import OrderedDict
 import shutil
 
 from migen.fhdl.namer import build_namespace
@@ -18,89 +17,128 @@ def vcd_codes():
         yield code
 
 
+_timescale_units = ["1ns", "100ps", "10ps", "1ps", "100fs", "10fs", "1fs"]
+
+
+def vcd_timescale(scale):
+    # Simulation times are counted in units of 1/scale of the clock periods,
+    # which are in ns like VCD files without $timescale. Returns the
+    # $timescale line and the factor converting times to its unit, exact
+    # when scale only has the prime factors 2 and 5 and rounded otherwise.
+    if scale == 1:
+        return "", 1
+    for k, unit in enumerate(_timescale_units):
+        if 10**k % scale == 0:
+            break
+    return "$timescale " + unit + " $end\n", Fraction(10**k, scale)
+
+
+def vcd_format(code, nbits):
+    # codes may contain braces
+    code = code.replace("{", "{{").replace("}", "}}")
+    if nbits > 1:
+        return "b{:0" + str(nbits) + "b} " + code + "\n"
+    else:
+        return "{}" + code + "\n"
+
+
 class VCDWriter:
-    def __init__(self, filename):
+    # Value changes are streamed to the output file right after the header.
+    # Signals only seen after init() are added to the header at close, which
+    # then rewrites the file once.
+    def __init__(self, filename, buffering=2**20, scale=1):
         self.filename = filename
+        self.buffering = buffering
+        self.timescale, self.time_factor = vcd_timescale(scale)
         self.out_file = None
-        self.buffer_file = tempfile.TemporaryFile(
-            dir=os.path.dirname(filename), mode="w+")
-        self.initialized = False
+        self.body_start = None
+        self.late_signals = False
         self.codegen = vcd_codes()
-        self.codes = OrderedDict()
+        self.codes = dict()
+        self.formats = dict()
         self.signal_values = dict()
         self.t = 0
+        self.written_time = 0
+        self.pending_time = False
 
-    def _write_value(self, signal, value):
-        l = len(signal)
-        if value < 0:
-            value += 2**l
-        if l > 1:
-            fmtstr = "b{:0" + str(l) + "b} {}\n"
-        else:
-            fmtstr = "{}{}\n"
-        try:
-            code = self.codes[signal]
-        except KeyError:
-            code = next(self.codegen)
-            self.codes[signal] = code
-            self.init(self.codes.keys())
-
-        return fmtstr.format(value, code)
-
-    def _write(self, s):
-        self.out_file.write(s)
-        self.buffer_file.write(s)
+    def _add_signal(self, signal):
+        code = next(self.codegen)
+        self.codes[signal] = code
+        self.formats[signal] = (vcd_format(code, len(signal)), 2**len(signal))
 
-    def init(self, signals):
-        self.out_file = open(self.filename, "w")
-
-        # generate codes
-        for signal in signals:
-            try:
-                code = self.codes[signal]
-            except KeyError:
-                code = next(self.codegen)
-                self.codes[signal] = code
-
-        # write vcd header
-        header = ""
+    def _format_value(self, signal, value):
+        fmtstr, modulo = self.formats[signal]
+        if value < 0:
+            value += modulo
+        return fmtstr.format(value)
+
+    def _write_time(self):
+        t = round(self.t*self.time_factor)
+        if t != self.written_time:
+            self.out_file.write("#{}\n".format(t))
+            self.written_time = t
+        self.pending_time = False
+
+    def _header(self):
+        r = [self.timescale]
         ns = build_namespace(self.codes.keys())
-        for signal, code in self.codes.items():
+        for signal, code in sorted(self.codes.items(), key=lambda x: x[0].duid):
             name = ns.get_name(signal)
-            header += "$var wire {len} {code} {name} $end\n".format(name=name, code=code, len=len(signal))
-        header += "$dumpvars\n"
-        for signal in self.codes.keys():
-            header += self._write_value(signal, signal.reset.value)
-        header += "$end\n"
-        self.out_file.write(header)
-
-        if self.initialized:
-            self.buffer_file.seek(0)
-            shutil.copyfileobj(self.buffer_file, self.out_file)
-            self.buffer_file.seek(0, 2)
-        else:
-            # init time
-            self._write("#0\n")
-
-        self.initialized = True
+            r.append("$var wire {len} {code} {name} $end\n".format(name=name, code=code, len=len(signal)))
+        r.append("$dumpvars\n")
+        for signal in sorted(self.codes.keys(), key=lambda x: x.duid):
+            r.append(self._format_value(signal, signal.reset.value))
+        r.append("$end\n")
+        return "".join(r)
+
+    def init(self, signals):
+        for signal in sorted(signals, key=lambda x: x.duid):
+            if signal not in self.codes:
+                self._add_signal(signal)
+                self.signal_values[signal] = signal.reset.value
+        self.out_file = open(self.filename, "w", buffering=self.buffering,
+                             newline="\n")
+        self.out_file.write(self._header())
+        self.out_file.flush()
+        self.body_start = self.out_file.tell()
+        self.out_file.write("#0\n")
 
     def set(self, signal, value):
-        if (signal not in self.signal_values
-                or self.signal_values[signal] != value):
-            self._write(self._write_value(signal, value))
-            self.signal_values[signal] = value
+        if signal not in self.codes:
+            if self.out_file is None:
+                self.init([signal])
+            else:
+                self._add_signal(signal)
+                self.late_signals = True
+        if self.signal_values.get(signal) == value:
+            return
+        self.signal_values[signal] = value
+        if self.pending_time:
+            self._write_time()
+        self.out_file.write(self._format_value(signal, value))
 
     def delay(self, delay):
         self.t += delay
-        self._write("#{}\n".format(self.t))
+        self.pending_time = True
 
     def close(self):
+        if self.pending_time:
+            self._write_time()
         self.out_file.close()
-        self.buffer_file.close()
+        if self.late_signals:
+            # the header does not fit in place anymore: rewrite the file
+            tmp_filename = self.filename + ".tmp"
+            with open(self.filename, "rb") as old_file, \
+                 open(tmp_filename, "wb", buffering=self.buffering) as new_file:
+                new_file.write(self._header().encode())
+                old_file.seek(self.body_start)
+                shutil.copyfileobj(old_file, new_file, self.buffering)
+            os.replace(tmp_filename, self.filename)
+            self.late_signals = False
 
 
 class DummyVCDWriter:
-    def init(self):
+    def init(self, signals):
         pass
 
     def set(self, signal, value):
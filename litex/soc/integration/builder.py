@@ -31,6 +31,7 @@ class Builder:
     def __init__(self, soc, output_dir=None,
                  compile_software=True, compile_gateware=True,
                  gateware_toolchain_path=None,
+                 gateware_cache_dir=None,
                  csr_csv=None):
         self.soc = soc
         if output_dir is None:
@@ -43,6 +44,7 @@ class Builder:
         self.compile_software = compile_software
         self.compile_gateware = compile_gateware
         self.gateware_toolchain_path = gateware_toolchain_path
+        self.gateware_cache_dir = gateware_cache_dir
         self.csr_csv = csr_csv
 
         self.software_packages = []
@@ -167,6 +169,8 @@ class Builder:
 
         if "run" not in kwargs:
             kwargs["run"] = self.compile_gateware
+        if self.gateware_cache_dir is not None:
+            kwargs["build_cache_dir"] = self.gateware_cache_dir
         vns = self.soc.build(build_dir=os.path.join(self.output_dir, "gateware"),
                              toolchain_path=toolchain_path, **kwargs)
         return vns
@@ -185,6 +189,10 @@ def builder_args(parser):
     parser.add_argument("--gateware-toolchain-path", default=None,
                         help="set gateware toolchain (ISE, Quartus, etc.) "
                              "installation path")
+    parser.add_argument("--gateware-cache-dir", default=None,
+                        help="reuse the bitstreams and reports of previous "
+                             "gateware builds with the same inputs "
+                             "(Vivado, Quartus, IceStorm, Trellis)")
     parser.add_argument("--csr-csv", default=None,
                         help="store CSR map in CSV format into the "
                              "specified file")
@@ -196,5 +204,6 @@ def builder_argdict(args):
         "compile_software": not args.no_compile_software,
         "compile_gateware": not args.no_compile_gateware,
         "gateware_toolchain_path": args.gateware_toolchain_path,
+        "gateware_cache_dir": args.gateware_cache_dir,
         "csr_csv": args.csr_csv
     }
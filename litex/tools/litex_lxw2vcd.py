@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+import sys
+
+from litex.gen.sim.lxw import LXWReader
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: litex_lxw2vcd lxw_file [vcd_file]")
+        exit(1)
+
+    lxw_file = sys.argv[1]
+    if len(sys.argv) < 3:
+        vcd_file = lxw_file[:-len(".lxw")] if lxw_file.endswith(".lxw") else lxw_file
+        vcd_file += ".vcd"
+    else:
+        vcd_file = sys.argv[2]
+
+    LXWReader(lxw_file).write_vcd(vcd_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+
+from litex.soc.integration.builder import builder_args, builder_argdict
+from litex.build.orchestrator import *
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build LiteX targets in parallel")
+    parser.add_argument("targets", nargs="*",
+                        help="jobs as target[:SoCClass][:key=value,...], "
+                             "e.g. arty:EthernetSoC or versa_ecp5::sys_clk_freq=50e6")
+    parser.add_argument("--all", action="store_true",
+                        help="build the BaseSoC of every target")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of builds running at once "
+                             "(default=number of CPUs)")
+    parser.add_argument("--fail-fast", nargs="?", const="skip", default=None,
+                        choices=["skip", "kill"],
+                        help="on the first failure, skip the builds not started "
+                             "(default) or also kill the running ones")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="kill builds running for longer (seconds)")
+    builder_args(parser)
+    args = parser.parse_args()
+
+    builder_kwargs = builder_argdict(args)
+    output_dir = builder_kwargs.pop("output_dir") or "build"
+
+    orchestrator = Orchestrator(output_dir, jobs=args.jobs, fail_fast=args.fail_fast,
+                                timeout=args.timeout, builder_kwargs=builder_kwargs)
+    specs = list(args.targets)
+    if args.all:
+        specs += all_targets()
+    if not specs:
+        parser.error("no target to build")
+    for spec in specs:
+        orchestrator.add_job(parse_job(spec))
+
+    results = orchestrator.run()
+    print()
+    print(format_summary(results))
+    if not all(r.ok for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,9 @@ setup(
             "litex_server=litex.tools.litex_server:main",
             "litex_sim=litex.tools.litex_sim:main",
             "litex_read_verilog=litex.tools.litex_read_verilog:main",
+            "litex_lxw2vcd=litex.tools.litex_lxw2vcd:main",
             "litex_simple=litex.boards.targets.simple:main",
+            "litex_orchestrator=litex.tools.litex_orchestrator:main",
             # short names
             "lxterm=litex.tools.litex_term:main",
             "lxserver=litex.tools.litex_server:main",
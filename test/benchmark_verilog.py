@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+# Verilog conversion time vs. design size:
+#   python3 -m test.benchmark_verilog [sizes...]
+
+import sys
+import time
+
+from litex.gen.fhdl import verilog
+
+from test.test_verilog import VerilogDUT
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [8, 16, 32, 64, 128]
+    print("{:>6} {:>10} {:>10} {:>10}".format("size", "lines", "regular", "simulation"))
+    for n in sizes:
+        times = []
+        for regular_comb in (True, False):
+            dut = VerilogDUT(n)
+            t = time.perf_counter()
+            output = verilog.convert(dut, dut.ios, regular_comb=regular_comb)
+            times.append(time.perf_counter() - t)
+            if regular_comb:
+                lines = output.main_source.count("\n")
+        print("{:>6} {:>10} {:>9.3f}s {:>9.3f}s".format(n, lines, *times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from litex.build.cache import BuildCache, cached_run
+from litex.build.tools import write_to_file, generated_banner
+
+
+class TestBuildCache(unittest.TestCase):
+    def test_cached_run(self):
+        with tempfile.TemporaryDirectory() as d:
+            build_dir = os.path.join(d, "build")
+            cache_dir = os.path.join(d, "cache")
+            os.makedirs(build_dir)
+            runs = []
+            def run():
+                runs.append(None)
+                write_to_file(os.path.join(build_dir, "top.bit"), str(len(runs)))
+
+            for banner, body in [("A", "a"), ("B", "a"), ("A", "b")]:
+                write_to_file(os.path.join(build_dir, "top.v"),
+                              generated_banner("//").replace("LiteX", banner) + body)
+                cached_run(cache_dir, run, build_dir, ["top.v"], ["top.bit"])
+            # the banner does not change the key
+            self.assertEqual(len(runs), 2)
+            with open(os.path.join(build_dir, "top.bit")) as f:
+                self.assertEqual(f.read(), "2")
+
+            cache = BuildCache(cache_dir)
+            self.assertNotEqual(cache.key(build_dir, ["top.v"], toolchain=["1.0"]),
+                                cache.key(build_dir, ["top.v"], toolchain=["1.1"]))
+
+    def test_moved_sources(self):
+        # absolute paths of the sources in generated scripts do not matter
+        keys = []
+        with tempfile.TemporaryDirectory() as d:
+            for checkout in ("a", "b"):
+                source = os.path.join(d, checkout, "rtl", "core.v")
+                include = os.path.join(d, checkout, "include")
+                build_dir = os.path.join(d, checkout, "build")
+                for path in (os.path.dirname(source), include, build_dir):
+                    os.makedirs(path)
+                write_to_file(source, "module core(); endmodule")
+                write_to_file(os.path.join(include, "defs.vh"), "`define A 1")
+                write_to_file(os.path.join(build_dir, "top.tcl"),
+                              "read_verilog {}\nsynth -include_dirs {}\n".format(source, include))
+                keys.append(BuildCache(os.path.join(d, "cache")).key(build_dir, ["top.tcl"],
+                    sources=[source], include_paths={include}))
+        self.assertEqual(keys[0], keys[1])
+
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import subprocess
+
+from litex.build.reports import vivado_timing, nextpnr_timing
+from litex.build.tools import write_to_file
+from litex.build.orchestrator import *
+
+
+class _Job(BuildJob):
+    def __init__(self, name, fail=False):
+        BuildJob.__init__(self, "none", name=name)
+        self.fail = fail
+
+    def run(self, output_dir, builder_kwargs):
+        print("building " + self.name)
+        if self.fail:
+            raise ValueError("failed " + self.name)
+        write_to_file(os.path.join(output_dir, "done"), self.name)
+
+
+class _HangingJob(BuildJob):
+    def __init__(self, name, pid_file):
+        BuildJob.__init__(self, "none", name=name)
+        self.pid_file = pid_file
+
+    def run(self, output_dir, builder_kwargs):
+        tool = subprocess.Popen(["sleep", "60"])
+        write_to_file(self.pid_file, str(tool.pid))
+        tool.wait()
+
+
+def _alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+class TestOrchestrator(unittest.TestCase):
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as d:
+            orchestrator = Orchestrator(d, jobs=2, verbose=False)
+            for i in range(3):
+                orchestrator.add_job(_Job("job{}".format(i), fail=(i == 1)))
+            results = orchestrator.run()
+            self.assertEqual([r.status for r in results], ["ok", "failed", "ok"])
+            self.assertTrue(os.path.exists(os.path.join(d, "job2", "done")))
+            with open(os.path.join(d, "job1.log")) as f:
+                log = f.read()
+            self.assertIn("building job1", log)
+            self.assertIn("ValueError: failed job1", log)
+            self.assertIn("job1  failed", format_summary(results))
+
+    def test_fail_fast(self):
+        with tempfile.TemporaryDirectory() as d:
+            orchestrator = Orchestrator(d, jobs=1, fail_fast="skip", verbose=False)
+            for i in range(3):
+                orchestrator.add_job(_Job("job{}".format(i), fail=(i == 1)))
+            results = orchestrator.run()
+            self.assertEqual([r.status for r in results], ["ok", "failed", "skipped"])
+
+    def test_reports(self):
+        with tempfile.TemporaryDirectory() as d:
+            report = os.path.join(d, "top_timing.rpt")
+            write_to_file(report, """\
+| Design Timing Summary
+| ---------------------
+
+    WNS(ns)      TNS(ns)  TNS Failing Endpoints  TNS Total Endpoints      WHS(ns)
+    -------      -------  ---------------------  -------------------      -------
+     -0.250       -1.500                     12                 4096        0.052
+""")
+            self.assertEqual(vivado_timing(report), {"wns": -0.25, "tns": -1.5})
+            log = os.path.join(d, "top.log")
+            write_to_file(log, "Info: Max frequency for clock 'sys_clk': 125.00 MHz (PASS at 100.00 MHz)\n")
+            self.assertAlmostEqual(nextpnr_timing(log)["wns"], 2.0)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs /proc")
+    def test_timeout(self):
+        with tempfile.TemporaryDirectory() as d:
+            pid_file = os.path.join(d, "pid")
+            orchestrator = Orchestrator(d, timeout=1.0, verbose=False)
+            orchestrator.add_job(_HangingJob("hanging", pid_file))
+            results = orchestrator.run()
+            self.assertEqual(results[0].status, "timeout")
+            with open(pid_file) as f:
+                pid = int(f.read())
+            # the tools started by the job are stopped with it
+            for i in range(50):
+                if not _alive(pid):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(_alive(pid))
@@ -0,0 +1,525 @@
+import unittest
+import io
+import contextlib
+import random
+import collections
+import os
+import json
+import tempfile
+import shutil
+import subprocess
+from functools import partial
+from fractions import Fraction
+
+from migen import *
+from migen.fhdl.specials import READ_FIRST, WRITE_FIRST, NO_CHANGE
+
+from litex.gen.sim import *
+from litex.gen.sim.lxw import LXWWriter, LXWReader
+from litex.gen.sim.cosim import CosimModel
+
+from litex.soc.interconnect import wishbone
+
+try:
+    import numpy
+    from litex.gen.sim.batch import run_batch_simulation
+except ImportError:
+    numpy = None
+
+
+class ArithDUT(Module):
+    def __init__(self):
+        self.a = Signal((8, True))
+        self.b = Signal(8)
+        self.idx = Signal(3)
+        self.outputs = [Signal((12, True)) for i in range(7)]
+        self.array = Array(Signal(4, reset=i) for i in range(6))
+        self.word = Signal(16)
+
+        # # #
+
+        o = self.outputs
+        self.comb += [
+            o[0].eq(self.a*self.b),
+            o[1].eq(self.a - self.b),
+            o[2].eq(~self.b),
+            o[3].eq(Mux(self.a < 0, self.a >> 2, self.b << 1)),
+            o[4].eq(Cat(self.a[1:5], self.b[3], Replicate(self.b[0], 3))),
+            o[5].eq(self.array[self.idx]),
+            self.word[3:9].eq(self.a),
+            self.word[12:].eq(self.b),
+            Case(self.b[:4], dict([(i, o[6].eq(i*3)) for i in range(12)] +
+                                  [("default", o[6].eq(-1))]))
+        ]
+        self.sync += [
+            self.array[self.idx].eq(self.array[self.idx] + 1),
+            If(self.b[7],
+                Cat(self.idx, self.b[4:6]).eq(Cat(self.b[4:6], self.idx))
+            )
+        ]
+
+
+def arith_generator(dut, results, seed=42):
+    prng = random.Random(seed)
+    for i in range(256):
+        yield dut.a.eq(prng.randrange(-128, 128))
+        yield dut.b.eq(prng.randrange(256))
+        yield
+        results.append((yield dut.outputs + [dut.word, dut.idx]))
+
+
+def arith_results(dut, seed=42):
+    results = []
+    yield from arith_generator(dut, results, seed)
+    return results
+
+
+def failing_generator(dut):
+    yield
+    raise ValueError
+
+
+class MemoryDUT(Module):
+    def __init__(self):
+        self.mem = Memory(32, 100, init=[i*7 for i in range(40)])
+        self.specials += self.mem
+        self.ports = []
+        for kwargs in [dict(write_capable=True, we_granularity=8, mode=READ_FIRST),
+                       dict(write_capable=True, mode=WRITE_FIRST, has_re=True),
+                       dict(write_capable=True, mode=NO_CHANGE),
+                       dict(async_read=True),
+                       dict(mode=WRITE_FIRST)]:
+            port = self.mem.get_port(**kwargs)
+            self.specials += port
+            self.ports.append(port)
+
+
+def memory_generator(dut, results, seed=42, n=256):
+    prng = random.Random(seed)
+    for i in range(n):
+        for port in dut.ports:
+            yield port.adr.eq(prng.randrange(128))
+            if port.we is not None:
+                yield port.we.eq(prng.randrange(2**len(port.we)))
+                yield port.dat_w.eq(prng.randrange(2**32))
+            if port.re is not None:
+                yield port.re.eq(prng.randrange(2))
+        if i % 16 == 0:
+            yield dut.mem[prng.randrange(100)].eq(prng.randrange(2**32))
+        yield
+        results.append((yield [port.dat_r for port in dut.ports] + [dut.mem[i % 100]]))
+
+
+def run_memory(**kwargs):
+    dut = MemoryDUT()
+    results = []
+    run_simulation(dut, memory_generator(dut, results), **kwargs)
+    return results
+
+
+def vcd_changes(filename):
+    # header, and value changes by time regardless of their order
+    header = []
+    changes = dict()
+    t = None
+    with open(filename) as f:
+        for line in f.read().splitlines():
+            if line.startswith("#"):
+                t = int(line[1:])
+                changes.setdefault(t, set())
+            elif t is None:
+                header.append(line)
+            else:
+                changes[t].add(line)
+    return header, changes
+
+
+def run_arith(seed=42, **kwargs):
+    dut = ArithDUT()
+    results = []
+    run_simulation(dut, arith_generator(dut, results, seed), **kwargs)
+    return results
+
+
+class TestSim(unittest.TestCase):
+    def test_compiled(self):
+        self.assertEqual(run_arith(compiled=True, propagation="fixpoint"),
+                         run_arith(compiled=False, propagation="fixpoint"))
+
+    def test_event_propagation(self):
+        reference = run_arith(compiled=False, propagation="fixpoint")
+        self.assertEqual(run_arith(compiled=False, propagation="event"), reference)
+        self.assertEqual(run_arith(compiled=True, propagation="event"), reference)
+
+    def test_event_propagation_chain(self):
+        chain = [Signal(8) for i in range(8)]
+        dut = Module()
+        # declared in reverse order of evaluation
+        for i in reversed(range(1, len(chain))):
+            dut.comb += chain[i].eq(chain[i - 1] + 1)
+        def generator():
+            for i in range(16):
+                yield chain[0].eq(i)
+                yield
+                self.assertEqual((yield chain[-1]), i + len(chain) - 1)
+                # comb driven signals are restored by their driver
+                yield chain[3].eq(0)
+                yield
+                self.assertEqual((yield chain[3]), i + 3)
+        run_simulation(dut, generator())
+
+    def test_levelized_propagation(self):
+        reference = run_arith(compiled=False, propagation="fixpoint")
+        self.assertEqual(run_arith(compiled=False, propagation="levelized"), reference)
+        self.assertEqual(run_arith(compiled=True, propagation="levelized"), reference)
+
+    def test_levelized_loop(self):
+        a = Signal(name="loop_a")
+        b = Signal(name="loop_b")
+        dut = Module()
+        dut.comb += [a.eq(~b), b.eq(a)]
+        with self.assertRaisesRegex(ValueError, "loop_a, loop_b"):
+            Simulator(dut, [], propagation="levelized")
+
+    def test_vcd(self):
+        # enough signals to use all printable characters in VCD codes
+        chain = [Signal(8) for i in range(128)]
+        dut = Module()
+        for i in range(1, len(chain)):
+            dut.comb += chain[i].eq(chain[i - 1] + 1)
+        def generator():
+            yield chain[0].eq(1)
+            yield
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "chain.vcd")
+            run_simulation(dut, generator(), vcd_name=filename)
+            with open(filename) as f:
+                lines = f.read().splitlines()
+        codes = [l.split()[3] for l in lines if l.startswith("$var")]
+        self.assertIn("{", codes)
+        self.assertEqual(len(codes), len(chain) + 1)
+        last = codes[len(chain) - 1]
+        self.assertEqual([l for l in lines if l.endswith(" " + last)][-1],
+                         "b{:08b} {}".format(len(chain), last))
+
+    def test_native_memories(self):
+        reference = run_memory(native_memories=False, compiled=False)
+        self.assertEqual(run_memory(compiled=False), reference)
+        self.assertEqual(run_memory(compiled=True), reference)
+        self.assertEqual(run_memory(compiled=True, propagation="levelized"), reference)
+
+    def test_memory_trace(self):
+        # memory words are traced by default
+        mem = Memory(8, 4, name="mem")
+        port = mem.get_port(write_capable=True)
+        dut = Module()
+        dut.specials += mem, port
+        def generator():
+            yield port.adr.eq(2)
+            yield port.dat_w.eq(0x5a)
+            yield port.we.eq(1)
+            yield
+            yield port.we.eq(0)
+            yield
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "memory.vcd")
+            run_simulation(dut, generator(), vcd_name=filename)
+            header, changes = vcd_changes(filename)
+        codes = {l.split()[4]: l.split()[3] for l in header if l.startswith("$var")}
+        self.assertIn("b01011010 " + codes["mem_data_2"],
+                      set.union(*changes.values()))
+
+    def test_native_memories_lazy(self):
+        dut = wishbone.SRAM(256*1024*1024)
+        def generator():
+            for i in range(16):
+                yield from dut.bus.write(i*2**20, i)
+            for i in range(16):
+                self.assertEqual((yield from dut.bus.read(i*2**20)), i)
+        with Simulator(dut, generator()) as s:
+            s.run()
+            pages = s.evaluator.memory(dut.mem).pages
+            self.assertEqual(len([p for p in pages if p is not None]), 16)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "profile.json")
+            self.assertEqual(run_arith(profile_json=filename), run_arith())
+            with open(filename) as f:
+                profile = json.load(f)
+        calls = collections.Counter()
+        for entry in profile["entries"]:
+            calls[entry["kind"]] += entry["calls"]
+        self.assertEqual(calls["sync"], 257)
+        self.assertEqual(calls["generator"], 4*256 + 1)
+        self.assertGreater(calls["comb"], 0)
+        # one propagation per clock edge, plus the initial one
+        self.assertEqual(sum(profile["deltas"].values()), 257 + 256 + 1)
+
+    def test_clocks(self):
+        dut = Module()
+        counters = {cd: Signal(16) for cd in ("sys", "odd", "frac")}
+        dut.sync += counters["sys"].eq(counters["sys"] + 1)
+        dut.sync.odd += counters["odd"].eq(counters["odd"] + 1)
+        dut.sync.frac += counters["frac"].eq(counters["frac"] + 1)
+        dut.clock_domains += [ClockDomain(cd) for cd in ("sys", "odd", "frac", "idle")]
+        results = []
+        def generator():
+            # starts at the first rising edge of sys (5)
+            yield Delay(700)
+            results.append((yield [counters["sys"], counters["odd"], counters["frac"]]))
+        clocks = {"sys": 10, "odd": 7, "frac": (2.5, 0.5), "idle": 3}
+        with Simulator(dut, generator(), clocks=clocks) as s:
+            self.assertNotIn("idle", s.time.clocks)
+            s.run()
+        # rising edges are at 3.5 + 7k for odd, 0.75 + 2.5k for frac
+        self.assertEqual(results, [[70, 101, 282]])
+
+    def test_vcd_timescale(self):
+        def generator():
+            for i in range(4):
+                yield
+        with tempfile.TemporaryDirectory() as d:
+            filenames = [os.path.join(d, name) for name in ("odd.vcd", "odd.lxw", "lxw.vcd")]
+            for filename in filenames[:2]:
+                dut = Module()
+                counter = Signal(8, name="counter")
+                dut.sync += counter.eq(counter + 1)
+                with Simulator(dut, generator(), clocks={"sys": 3}, vcd_name=filename) as s:
+                    s.run()
+                self.assertEqual(s.time.elapsed, Fraction(27, 2))
+            header, changes = vcd_changes(filenames[0])
+            reader = LXWReader(filenames[1])
+            self.assertEqual(reader.end, Fraction(27, 2))
+            self.assertEqual(reader.values_at(Fraction(3, 2))[0], 1)
+            reader.write_vcd(filenames[2])
+            self.assertEqual(vcd_changes(filenames[2]), (header, changes))
+        # clock edges every 1.5ns
+        self.assertEqual(header[0], "$timescale 100ps $end")
+        self.assertEqual(sorted(changes), [15*i for i in range(10)])
+
+    def test_fast_forward(self):
+        def run(fast_forward):
+            dut = Module()
+            load = Signal(name="load")
+            count = Signal(16, name="count")
+            done = Signal(name="done")
+            dut.sync += [
+                If(load,
+                    count.eq(1000)
+                ).Elif(count != 0,
+                    count.eq(count - 1)
+                ),
+                done.eq(count == 1)
+            ]
+            results = []
+            def generator():
+                yield load.eq(1)
+                yield
+                yield load.eq(0)
+                yield WaitUntil(done)
+                results.append((s.time.now, (yield count)))
+                yield Wait(100000)
+                results.append((s.time.now, (yield done)))
+                yield Delay(55)
+                yield WaitUntil(count, 0)
+                results.append(s.time.now)
+            s = Simulator(dut, generator(), fast_forward=fast_forward)
+            cycles = []
+            sync = s.sync["sys"]
+            def counted_sync():
+                cycles.append(s.time.now)
+                sync()
+            s.sync["sys"] = counted_sync
+            with s:
+                s.run()
+            return results, len(cycles)
+        results, cycles = run(False)
+        self.assertEqual(results, [(10025, 0), (1010025, 0), 1010080])
+        self.assertEqual(cycles, 101008)
+        results, cycles = run(True)
+        self.assertEqual(results, [(10025, 0), (1010025, 0), 1010080])
+        # only the count down is evaluated
+        self.assertLess(cycles, 1010)
+
+    def test_fast_forward_display(self):
+        # cycles printing are not skipped
+        def run(fast_forward):
+            dut = Module()
+            x = Signal(reset=1)
+            dut.sync += If(x, Display("tick"))
+            def generator():
+                yield Wait(5)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                run_simulation(dut, generator(), fast_forward=fast_forward)
+            return output.getvalue()
+        self.assertEqual(run(True), run(False))
+        self.assertEqual(run(True).count("tick"), 6)
+
+    @unittest.skipIf(shutil.which("gcc") is None, "gcc is not available")
+    def test_cosim(self):
+        # C model with the interface of the Verilator wrappers: pins are
+        # a, clk, w and count, sum, wide, in the order of the instance ports
+        source = """
+#include <stdint.h>
+#include <stdlib.h>
+struct model { uint32_t clk, count; };
+void *litex_cosim_new(void) { return calloc(1, sizeof(struct model)); }
+void litex_cosim_delete(void *p) { free(p); }
+void litex_cosim_step(void *p, const uint32_t *in, uint32_t *out)
+{
+    struct model *m = p;
+    if(in[1] && !m->clk) m->count++;
+    m->clk = in[1];
+    out[0] = m->count & 0xffff;
+    out[1] = (in[0] + (in[2] & 0xff)) & 0x1ff;
+    out[2] = ~in[2]; out[3] = ~in[3]; out[4] = ~in[4] & 0xff;
+}
+"""
+        class CModelCosim:
+            def __init__(self, directory):
+                self.directory = directory
+
+            def build(self, instances):
+                instance, = instances
+                c_file = os.path.join(self.directory, "model.c")
+                library = os.path.join(self.directory, "model.so")
+                with open(c_file, "w") as f:
+                    f.write(source)
+                subprocess.check_call(["gcc", "-shared", "-fPIC", "-o", library, c_file])
+                inputs = [instance.get_io(name) for name in ("a", "clk", "w")]
+                outputs = [instance.get_io(name) for name in ("count", "sum", "wide")]
+                return CosimModel(library, inputs, outputs)
+
+        dut = Module()
+        a = Signal(8, name="a")
+        w = Signal(72, name="w")
+        count = Signal(16, name="count")
+        total = Signal(9, name="total")
+        wide = Signal(72, name="wide")
+        dut.sync += a.eq(a + 3)
+        dut.specials += Instance("model", i_clk=ClockSignal(), i_a=a, i_w=w,
+                                 o_count=count, o_sum=total, o_wide=wide)
+        results = []
+        def generator():
+            prng = random.Random(42)
+            for i in range(20):
+                yield w.eq(prng.randrange(2**72))
+                yield
+                results.append((yield [a, w, count, total, wide]))
+        with tempfile.TemporaryDirectory() as directory:
+            run_simulation(dut, generator(), cosim=CModelCosim(directory))
+        for i, (a_value, w_value, count_value, total_value, wide_value) in enumerate(results):
+            self.assertEqual(count_value, i + 1)
+            self.assertEqual(total_value, a_value + (w_value & 0xff))
+            self.assertEqual(wide_value, ~w_value & (2**72 - 1))
+
+    def test_checkpoint(self):
+        for compiled in (True, False):
+            dut = MemoryDUT()
+            reference = []
+            def generator():
+                yield from memory_generator(dut, reference, 1, 100)
+                yield
+                yield from memory_generator(dut, reference, 2, 100)
+            run_simulation(dut, generator(), compiled=compiled)
+
+            with tempfile.TemporaryDirectory() as d:
+                filename = os.path.join(d, "checkpoint")
+                results = []
+                dut = MemoryDUT()
+                with Simulator(dut, memory_generator(dut, results, 1, 100),
+                               compiled=compiled) as s:
+                    s.run()
+                    s.save_checkpoint(filename)
+                dut = MemoryDUT()
+                with Simulator(dut, memory_generator(dut, results, 2, 100),
+                               compiled=compiled) as s:
+                    s.restore_checkpoint(filename)
+                    s.run()
+                with self.assertRaisesRegex(ValueError, "does not match"):
+                    Simulator(ArithDUT(), []).restore_checkpoint(filename)
+            self.assertEqual(results, reference)
+
+    def test_trace_filter(self):
+        dut = Module()
+        counter = Signal(8, name="counter")
+        dut.sync += counter.eq(counter + 1)
+        dut.submodules.sub = sub = Module()
+        doubled = Signal(9, name="doubled")
+        parity = Signal(name="parity")
+        sub.comb += [doubled.eq(counter*2), parity.eq(counter[0])]
+        def generator():
+            for i in range(40):
+                yield
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "trace.vcd")
+            run_simulation(dut, generator(), vcd_name=filename,
+                           trace_include=sub, trace_exclude="*parity",
+                           trace_window=(10, 20))
+            header, changes = vcd_changes(filename)
+        self.assertEqual([l.split()[4] for l in header if l.startswith("$var")],
+                         ["counter", "doubled"])
+        code = header[1].split()[3]
+        values = sorted(int(l.split()[0][1:], 2) for t in changes.values()
+                        for l in t if l.endswith(" " + code))
+        self.assertEqual(values, [2*i for i in range(10, 20)])
+
+    def test_lxw(self):
+        with tempfile.TemporaryDirectory() as d:
+            filenames = [os.path.join(d, name) for name in ("arith.vcd", "arith.lxw", "lxw.vcd")]
+            self.assertEqual(run_arith(vcd_name=filenames[0]),
+                             run_arith(vcd_name=filenames[1]))
+            LXWReader(filenames[1]).write_vcd(filenames[2])
+            self.assertEqual(vcd_changes(filenames[0]), vcd_changes(filenames[2]))
+
+    def test_lxw_seek(self):
+        prng = random.Random(42)
+        signals = [Signal((prng.randrange(1, 70), True)) for i in range(16)]
+        late = Signal(4, reset=5)
+        history = []
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "seek.lxw")
+            writer = LXWWriter(filename, block_size=64)
+            writer.init(signals)
+            values = [0]*len(signals)
+            for t in range(0, 5000, 5):
+                for i in prng.sample(range(len(signals)), 3):
+                    nbits = len(signals[i])
+                    values[i] = prng.randrange(-2**(nbits - 1), 2**(nbits - 1))
+                    writer.set(signals[i], values[i])
+                if t == 2500:
+                    writer.set(late, 3)
+                history.append([v & (2**len(s) - 1) for v, s in zip(values, signals)])
+                writer.delay(5)
+            writer.close()
+            reader = LXWReader(filename)
+            self.assertGreater(len(reader.blocks), 10)
+            self.assertEqual(reader.end, 5000)
+            for t in (0, 4, 5, 1234, 2495, 2500, 4995, 6000):
+                expected = history[min(t, 4995)//5] + [3 if t >= 2500 else 5]
+                self.assertEqual(reader.values_at(t), expected)
+            self.assertEqual([t for t, changes in reader.changes(1000, 1100)],
+                             list(range(1000, 1100, 5)))
+
+    @unittest.skipIf(numpy is None, "NumPy is not available")
+    def test_batch(self):
+        seeds = range(8)
+        dut = ArithDUT()
+        results = [[] for seed in seeds]
+        run_batch_simulation(dut, [arith_generator(dut, r, seed)
+                                   for r, seed in zip(results, seeds)])
+        for r, seed in zip(results, seeds):
+            self.assertEqual(r, run_arith(seed))
+
+    def test_parallel(self):
+        seeds = range(4)
+        factories = [partial(arith_results, seed=seed) for seed in seeds]
+        factories.append(failing_generator)
+        results = run_simulations_parallel(ArithDUT, factories, max_workers=2)
+        for result, seed in zip(results, seeds):
+            self.assertFalse(result.failed)
+            self.assertEqual(result.returns, run_arith(seed))
+        self.assertTrue(results[-1].failed)
+        self.assertIn("ValueError", results[-1].traceback)
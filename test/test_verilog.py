@@ -0,0 +1,163 @@
+import os
+import re
+import unittest
+import collections
+import tempfile
+
+from migen import *
+from migen.fhdl.tools import group_by_targets
+
+from litex.gen.fhdl import verilog
+from litex.build.xilinx import vivado
+from litex.soc.interconnect import stream
+
+
+class VerilogDUT(Module):
+    def __init__(self, n=4):
+        self.ios = set()
+        for i in range(n):
+            fifo = stream.SyncFIFO([("data", 16)], 8)
+            converter = stream.StrideConverter([("data", 16)], [("data", 8)])
+            setattr(self.submodules, "fifo{}".format(i), fifo)
+            setattr(self.submodules, "converter{}".format(i), converter)
+            self.comb += fifo.source.connect(converter.sink)
+            self.ios |= {fifo.sink.valid, fifo.sink.ready, fifo.sink.data,
+                         converter.source.valid, converter.source.ready,
+                         converter.source.data}
+
+
+def strip_banner(source):
+    return source.split("\n", 3)[3]
+
+
+def multi_driven(source):
+    # nets of hierarchical output driven both in a module and by one of its
+    # instances, or by several instances
+    outputs = dict()
+    for name, text in verilog.split_modules(source):
+        outputs[name] = set(re.findall(r"^\toutput (?:reg )?(?:\[[^\]]*\] )?(\w+)", text, re.MULTILINE))
+    r = []
+    for name, text in verilog.split_modules(source):
+        drivers = collections.Counter()
+        local = set(re.findall(r"^assign (\w+)", text, re.MULTILINE))
+        local |= set(re.findall(r"^\s+(\w+)(?:\[[^\]]*\])? <?= ", text, re.MULTILINE))
+        drivers.update(local)
+        for definition, connections in re.findall(r"^(\w+) \w+\(\n((?:\t\..*\n)*)\);", text, re.MULTILINE):
+            for port, net in re.findall(r"\.(\w+)\((\w+)\)", connections):
+                if port in outputs.get(definition, ()):
+                    drivers[net] += 1
+        r += [(name, net) for net, n in drivers.items() if n > 1]
+    return r
+
+
+class TestVerilog(unittest.TestCase):
+    def test_group_by_targets(self):
+        dut = VerilogDUT()
+        comb = dut.get_fragment().comb
+        groups = verilog._group_by_targets(comb, verilog._TargetSets())
+        self.assertEqual([(targets, [id(s) for s in statements]) for targets, statements in groups],
+                         [(targets, [id(s) for s in statements])
+                          for targets, statements in group_by_targets(comb)])
+
+    def test_hierarchy(self):
+        dut = VerilogDUT()
+        output = verilog.convert(dut, dut.ios, hierarchy=True)
+        source = output.main_source
+        # the fifos and converters are emitted once, and instantiated 4 times
+        self.assertEqual(source.count("\nmodule "), output.definitions)
+        self.assertLess(output.definitions, output.modules)
+        for i in range(4):
+            self.assertIn("\nSyncFIFO_1 fifo{}(\n".format(i), source)
+            self.assertIn("\nStrideConverter converter{}(\n".format(i), source)
+        top = source[source.index("\nmodule top("):]
+        for sig in dut.ios:
+            self.assertIn(output.ns.get_name(sig), top)
+        self.assertIn("StrideConverter", [d for d, instances, size in output.duplicates
+                                          if instances == 4])
+        self.assertEqual(multi_driven(source), [])
+
+    def test_hierarchy_shared_targets(self):
+        # submodules with signals also driven by the parent stay flattened
+        class Sub(Module):
+            def __init__(self):
+                self.a = Signal(4)
+                self.x = Signal(8)
+                self.cnt = Signal(8)
+                self.comb += self.x[0:4].eq(self.a)
+                self.sync += self.cnt.eq(self.cnt + 1)
+
+        class Slice(Module):
+            def __init__(self):
+                self.b = Signal(4)
+                self.submodules.sub = Sub()
+                self.comb += self.sub.x[4:8].eq(self.b)
+                self.ios = {self.b, self.sub.a, self.sub.x}
+
+        class Override(Module):
+            def __init__(self):
+                self.clr = Signal()
+                self.submodules.sub = Sub()
+                self.sync += If(self.clr, self.sub.cnt.eq(0))
+                self.ios = {self.clr, self.sub.a, self.sub.x, self.sub.cnt}
+
+        for dut in (Slice(), Override()):
+            output = verilog.convert(dut, dut.ios, hierarchy=True)
+            self.assertEqual(output.modules, 1)
+            self.assertEqual(multi_driven(output.main_source), [])
+
+    def test_split_ooc_modules(self):
+        # the modules instantiated only by out of context ones leave the
+        # top level source
+        class Leaf(Module):
+            def __init__(self, width):
+                self.i = Signal(width)
+                self.o = Signal(width)
+                self.sync += self.o.eq(self.i + 1)
+
+        class Mid(Module):
+            def __init__(self):
+                self.i = Signal(8)
+                self.o = Signal(8)
+                self.submodules.leaf = Leaf(8)
+                self.comb += self.leaf.i.eq(self.i)
+                self.sync += self.o.eq(self.leaf.o)
+
+        dut = Module()
+        dut.submodules.mid = Mid()
+        dut.submodules.leaf = Leaf(4)
+        ios = {dut.mid.i, dut.mid.o, dut.leaf.i, dut.leaf.o}
+        output = verilog.convert(dut, ios, hierarchy=True)
+        with tempfile.TemporaryDirectory() as build_dir:
+            output.write(os.path.join(build_dir, "top.v"))
+            self.assertEqual(vivado._split_ooc_modules(build_dir, "top", "top.v", ["Mid"]), ["Mid"])
+            modules = []
+            for filename in ("top.v", "top_Mid.v"):
+                with open(os.path.join(build_dir, filename)) as f:
+                    modules.append(re.findall(r"^module (\w+)", f.read(), re.MULTILINE))
+        self.assertEqual(modules, [["Mid", "Leaf_1", "top"], ["Leaf", "Mid"]])
+
+    def test_parallel(self):
+        min_blocks = verilog._parallel_min_blocks
+        verilog._parallel_min_blocks = 1
+        try:
+            for regular_comb in (True, False):
+                outputs = []
+                for jobs in (1, 2):
+                    dut = VerilogDUT()
+                    outputs.append(verilog.convert(dut, dut.ios, regular_comb=regular_comb,
+                                                   jobs=jobs))
+                self.assertEqual(strip_banner(outputs[0].main_source),
+                                 strip_banner(outputs[1].main_source))
+        finally:
+            verilog._parallel_min_blocks = min_blocks
+
+    def test_streaming(self):
+        dut = VerilogDUT()
+        reference = verilog.convert(dut, dut.ios)
+        with tempfile.TemporaryDirectory() as build_dir:
+            dut = VerilogDUT()
+            filename = os.path.join(build_dir, "top.v")
+            output = verilog.convert(dut, dut.ios, output=filename)
+            with open(filename) as f:
+                self.assertEqual(strip_banner(f.read()), strip_banner(reference.main_source))
+            self.assertTrue(output.file.closed)